@@ -4,32 +4,52 @@ MeetVoice - Application Simple avec 30 Questions d'Inscription
 API FastAPI ultra-simple pour les questions d'inscription avec synthèse vocale
 """
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Request
+from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, validator
 from typing import Optional, List
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager, contextmanager
 import edge_tts
 import asyncio
+import base64
+import codecs
+import email.utils
 # import io  # Supprimé - plus utilisé
 import os
-from groq import Groq
+import hashlib
+import math
+import heapq
+import mmap
+import random
+import struct
+import time
+import unicodedata
+import groq
+from groq import AsyncGroq
 import google.generativeai as genai
 import requests
 import aiohttp
 import json
-from datetime import datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 import re
+import sqlite3
+import sys
+import threading
+import uuid
 
 # Charger les variables d'environnement
 load_dotenv()
 
 # Configuration Groq (prioritaire - ultra-rapide)
+# Client asynchrone : un appel lent ne bloque pas la boucle d'événements (connexions réutilisées)
 groq_api_key = os.getenv("GROQ_API_KEY")
 if not groq_api_key:
     raise ValueError("GROQ_API_KEY non trouvée dans le fichier .env")
-groq_client = Groq(api_key=groq_api_key)
+groq_client = AsyncGroq(api_key=groq_api_key)
 
 # Configuration Gemini (fallback)
 gemini_api_key = os.getenv("GOOGLE_API_KEY")
@@ -37,6 +57,17 @@ if not gemini_api_key:
     raise ValueError("GOOGLE_API_KEY non trouvée dans le fichier .env")
 genai.configure(api_key=gemini_api_key)
 
+# Modèles Gemini instanciés une seule fois (réutilisés par generate_content_async)
+gemini_models = {}
+
+def get_gemini_model(model_name: str) -> genai.GenerativeModel:
+    """Modèle Gemini partagé (créé à la première utilisation)"""
+    model = gemini_models.get(model_name)
+    if model is None:
+        model = genai.GenerativeModel(model_name)
+        gemini_models[model_name] = model
+    return model
+
 # Modèle de données pour la description
 class UserProfile(BaseModel):
     prenom: str
@@ -59,9 +90,6 @@ class IARequest(BaseModel):
 
 # ❌ Modèle TTSRequest supprimé - WebSocket uniquement
 
-# Stockage temporaire des conversations (en production: Redis/DB)
-conversation_memory = {}
-
 # Voix françaises disponibles (liste complète et à jour)
 FRENCH_VOICES = [
     "fr-FR-DeniseNeural",           # Féminine
@@ -107,6 +135,15 @@ AI_COSTS = {
     "groq": 0.0     # gratuit
 }
 
+# Tarifs texte par IA (en dollars pour 1M tokens : entrée, sortie)
+AI_TOKEN_PRICES = {
+    "gpt-4o": (2.5, 10.0),
+    "deepinfra-qwen": (0.35, 0.40),
+    "deepinfra": (0.35, 0.40),   # Fallback DeepInfra (même modèle Qwen par défaut)
+    "gemini": (0.0, 0.0),        # gratuit
+    "groq": (0.0, 0.0)           # gratuit
+}
+
 # Limites de budget par expertise (en dollars par mois)
 BUDGET_LIMITS = {
     "psychology": 10.0,    # 🧠 Limite psychologie
@@ -117,67 +154,489 @@ BUDGET_LIMITS = {
     "images": 10.0         # 🎨 Limite images
 }
 
-# Tracking des coûts (en mémoire - à persister en production)
-cost_tracker = {
-    "psychology": 0.0,
-    "development": 0.0,
-    "sexology": 0.0,
-    "seduction": 0.0,
-    "amical": 0.0,
-    "images": 0.0,
-    "last_reset": datetime.now().strftime("%Y-%m")
-}
+# Dépenses du mois : registre SQLite partagé entre workers (cost_ledger, section REGISTRE DES COÛTS)
 
-# Voix spécialisées par type d'expertise
+# Voix spécialisées par type d'expertise (par ordre de préférence, validées au démarrage par VoiceRegistry)
 EXPERTISE_VOICES = {
-    "psychology": "fr-CH-ArianeNeural",        # 🧠 Psychologie → Voix douce et rassurante (femme suisse)
-    "sexology": "fr-FR-VivienneMultilingualNeural",  # ❤️ Sexologie → Voix féminine confiante et ouverte
-    "seduction": "fr-FR-DeniseNeural",         # 💋 Séduction → Voix charismatique (femme)
-    "development": "fr-FR-HenriNeural",           # 🌟 Développement → Voix masculine jeune et accessible
-    "amical": "fr-FR-DeniseNeural",            # 😊 Amical → Voix chaleureuse et bienveillante (défaut)
-    "default": "fr-FR-DeniseNeural"            # 💬 Général → Voix par défaut (femme)
+    "psychology": ["fr-CH-ArianeNeural", "fr-FR-EloiseNeural"],          # 🧠 Psychologie → Voix douce et rassurante (femme suisse)
+    "sexology": ["fr-FR-VivienneMultilingualNeural", "fr-FR-DeniseNeural"],  # ❤️ Sexologie → Voix féminine confiante et ouverte
+    "seduction": ["fr-FR-DeniseNeural"],         # 💋 Séduction → Voix charismatique (femme)
+    "development": ["fr-FR-HenriNeural", "fr-FR-RemyMultilingualNeural"],  # 🌟 Développement → Voix masculine jeune et accessible
+    "amical": ["fr-FR-DeniseNeural"],            # 😊 Amical → Voix chaleureuse et bienveillante (défaut)
+    "default": ["fr-FR-DeniseNeural"]            # 💬 Général → Voix par défaut (femme)
 }
 
-def clean_text_for_speech(text: str) -> str:
-    """Nettoie le texte pour la synthèse vocale en supprimant le formatage Markdown"""
-    # Supprimer le formatage gras **texte**
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+# Sujet détecté automatiquement → expertise (et donc voix)
+TOPIC_EXPERTISE = {
+    "confiance": "psychology",           # Confiance → Psychologie
+    "stress_social": "psychology",       # Stress social → Psychologie
+    "communication": "seduction",        # Communication → Séduction
+    "rendez-vous": "seduction",          # Rendez-vous → Séduction
+    "developpement_personnel": "development"  # Développement → Développement
+}
+
+# Voix des personnages du jeu de rôle (par ordre de préférence)
+ROLEPLAY_PERSONA_VOICES = {
+    "jeune_extravertie": ["fr-FR-EloiseNeural"],                                 # Jeune et dynamique
+    "douce": ["fr-CH-ArianeNeural", "fr-FR-EloiseNeural"],                       # Plus douce et romantique
+    "mature": ["fr-FR-DeniseNeural"],                                            # Plus mature et confiante
+    "sophistiquee": ["fr-FR-JosephineNeural", "fr-FR-VivienneMultilingualNeural"],  # Élégante et cultivée
+    "chaleureuse": ["fr-CA-SylvieNeural", "fr-FR-DeniseNeural"],                 # Accent québécois chaleureux
+    "default": ["fr-FR-CoralieNeural", "fr-FR-EloiseNeural"]                     # Voix naturelle par défaut
+}
+
+# Passes Markdown → parole, précompilées (appliquées dans cet ordre)
+SPEECH_BOLD_PATTERN = re.compile(r'\*\*(.*?)\*\*')
+SPEECH_ITALIC_PATTERN = re.compile(r'\*(.*?)\*')
+SPEECH_BULLET_PATTERN = re.compile(r'^[\s]*[-•*]\s*', re.MULTILINE)
+SPEECH_NUMBERED_PATTERN = re.compile(r'(\s|^)(\d+)\.\s*')
+SPEECH_LINK_PATTERN = re.compile(r'\[([^\]]+)\]\([^\)]+\)')
+SPEECH_CODE_PATTERN = re.compile(r'`([^`]+)`')
+SPEECH_TITLE_PATTERN = re.compile(r'^#+\s*', re.MULTILINE)
 
-    # Supprimer le formatage italique *texte*
-    text = re.sub(r'\*(.*?)\*', r'\1', text)
+def clean_text_for_speech(text: str) -> str:
+    """Nettoie le texte pour la synthèse vocale en supprimant le formatage Markdown
+    (une passe n'est exécutée que si son caractère déclencheur est présent)"""
+    # Supprimer le formatage gras **texte** puis italique *texte*
+    if "*" in text:
+        text = SPEECH_BOLD_PATTERN.sub(r'\1', text)
+        text = SPEECH_ITALIC_PATTERN.sub(r'\1', text)
 
     # Supprimer les puces mais garder les numéros
-    text = re.sub(r'^[\s]*[-•*]\s*', '', text, flags=re.MULTILINE)
-    # Remplacer "1." par "1," pour une lecture plus naturelle (début de ligne OU après espace)
-    text = re.sub(r'(\s|^)(\d+)\.\s*', r'\1\2, ', text)
+    if "-" in text or "•" in text or "*" in text:
+        text = SPEECH_BULLET_PATTERN.sub('', text)
+
+    # Remplacer "1." par "1," pour une lecture plus naturelle (début de texte OU après espace)
+    if "." in text:
+        text = SPEECH_NUMBERED_PATTERN.sub(r'\1\2, ', text)
 
     # Supprimer les liens [texte](url)
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    if "](" in text:
+        text = SPEECH_LINK_PATTERN.sub(r'\1', text)
 
     # Supprimer les codes `code`
-    text = re.sub(r'`([^`]+)`', r'\1', text)
+    if "`" in text:
+        text = SPEECH_CODE_PATTERN.sub(r'\1', text)
 
     # Supprimer les titres ### Titre
-    text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
+    if "#" in text:
+        text = SPEECH_TITLE_PATTERN.sub('', text)
+
+    # Espaces multiples et sauts de ligne → un seul espace, sans espaces aux extrémités
+    return " ".join(text.split())
+
+# Points de coupe possibles : fin d'une suite d'espaces, avant un caractère visible
+SPEECH_CUT_PATTERN = re.compile(r'\s+(?=\S)')
+# Caractères qui font évoluer l'état des marqueurs : suites d'astérisques, fins de ligne, code
+SPEECH_MARKER_PATTERN = re.compile(r'\*+|\n|`')
+
+class SpeechTextNormalizer:
+    """clean_text_for_speech incrémental : le texte nettoyé est rendu au fil des fragments reçus.
+    La concaténation des sorties de feed() puis flush() est identique à clean_text_for_speech(texte complet).
+    Le tampon retenu n'est parcouru qu'une fois : l'état des marqueurs (gras/italique de la ligne,
+    liens, code) avance avec les fragments, et seul le préfixe finalement coupé est nettoyé"""
+
+    # Nombre de points de coupe essayés par fragment (du plus récent au plus ancien)
+    MAX_CUT_CANDIDATES = 8
+    # Taille minimale du tampon avant de chercher une coupe (évite de nettoyer mot par mot)
+    MIN_CUT_CHARS = 48
+
+    def __init__(self):
+        self._buffer = ""
+        self._emitted = False
+        self._reset_scan()
+
+    def _reset_scan(self):
+        """État du parcours pour un tampon qui commence à une coupe sûre (ou vide)"""
+        self._scanned = 0           # Tampon parcouru jusqu'ici (dernier point de coupe examiné)
+        self._committed = 0         # Début du segment dont le gras/italique n'est pas encore résolu
+        self._open_bracket = False  # "[" sans "]" dans le texte résolu
+        self._open_link = False     # "](" sans ")" dans le texte résolu
+        self._backticks = 0
+        self._code_blocked = False  # Dernier nettoyage refusé (code ouvert) : attendre un nouveau "`"
+        self._reset_line()
+
+    def _reset_line(self):
+        # Gras/italique de la ligne en cours, tels que les verraient les passes **...** puis *...*
+        self._bold_open = False
+        self._bold_first_star = None  # Contenu du gras ouvert : None si vide, sinon commence par "*"
+        self._bold_last_star = False
+        self._bold_stars = 0
+        self._stars = 0               # Astérisques restant après la passe gras (appariées par l'italique)
+        self._last_star = False
+        self._double = False          # "**" reformé par la passe gras : jamais retiré par l'italique
+
+    def feed(self, fragment: str) -> str:
+        """Ajoute un fragment et retourne le texte nettoyé déjà définitif (éventuellement vide)"""
+        previous_length = len(self._buffer)
+        self._buffer += fragment
+        if len(self._buffer) < self.MIN_CUT_CHARS:
+            return ""
+
+        # Seuls les points de coupe apportés par le fragment sont examinés ; le parcours reprend
+        # là où il s'était arrêté (jamais avant le dernier point examiné)
+        start = max(previous_length - 1, self._scanned)
+        cuts = [match.end() for match in SPEECH_CUT_PATTERN.finditer(self._buffer, start)]
+
+        safe_cuts = []
+        for cut in cuts[-self.MAX_CUT_CANDIDATES:]:
+            self._scan(cut)
+            if self._is_safe_cut(self._buffer[cut]):
+                safe_cuts.append(cut)
+
+        if self._code_blocked:
+            return ""
+
+        for cut in reversed(safe_cuts[-self.MAX_CUT_CANDIDATES:]):
+            cleaned = clean_text_for_speech(self._buffer[:cut])
+            if "`" in cleaned:
+                # Code `...` pas encore refermé : les coupes suivantes le sont aussi tant qu'aucun "`" n'arrive
+                self._code_blocked = True
+                continue
+
+            self._buffer = self._buffer[cut:]
+            self._reset_scan()
+            return self._emit(cleaned)
+
+        return ""
+
+    def flush(self) -> str:
+        """Nettoie et retourne le reste du texte"""
+        cleaned = clean_text_for_speech(self._buffer)
+        self._buffer = ""
+        self._reset_scan()
+        return self._emit(cleaned)
+
+    def _emit(self, cleaned: str) -> str:
+        if not cleaned:
+            return ""
+        if self._emitted:
+            cleaned = " " + cleaned
+        self._emitted = True
+        return cleaned
+
+    def _is_safe_cut(self, next_char: str) -> bool:
+        """Vrai si aucune passe de nettoyage ne peut chevaucher la coupe (état parcouru jusqu'à la coupe)"""
+        # Gras/italique : les astérisques s'apparient sur une même ligne ; la coupe est refusée
+        # seulement si un marqueur de la ligne reste ouvert (il pourrait se refermer après la coupe)
+        if self._bold_open or self._double or self._stars % 2:
+            return False
+
+        # Ligne résolue jusqu'à la coupe : son gras/italique ne changera plus
+        self._commit(self._scanned)
+
+        # Début de puce, de titre ou de numéro ("1." dépend de l'espace déjà consommé avant),
+        # ou de lien/code dont le contenu (ex: "#") se retrouverait en début de texte
+        if next_char.isdigit() or next_char in "-•*#[`":
+            return False
+
+        # Lien [texte](url) ou code pas encore refermé
+        return not (self._open_bracket or self._open_link or self._backticks % 2)
+
+    def _scan(self, end: int):
+        """Avance l'état des marqueurs jusqu'à `end` (point de coupe, donc précédé d'un espace)"""
+        position = self._scanned
+        for match in SPEECH_MARKER_PATTERN.finditer(self._buffer, position, end):
+            if match.start() > position:
+                self._plain_text()
+            marker = match.group()
+            if marker == "\n":
+                self._commit(match.end())
+            elif marker == "`":
+                self._backticks += 1
+                self._code_blocked = False
+                self._plain_text()
+            else:
+                self._scan_stars(len(marker))
+            position = match.end()
+
+        if end > position:
+            self._plain_text()
+        self._scanned = end
+
+    def _plain_text(self):
+        if self._bold_open:
+            if self._bold_first_star is None:
+                self._bold_first_star = False
+            self._bold_last_star = False
+        else:
+            self._last_star = False
+
+    def _scan_stars(self, count: int):
+        """Suite d'astérisques, comme la passe **(.*?)** : un "**" ouvre, le "**" suivant referme"""
+        index = 0
+        while index < count:
+            if index + 1 < count:
+                if self._bold_open:
+                    self._close_bold()
+                else:
+                    self._bold_open = True
+                    self._bold_first_star = None
+                    self._bold_last_star = False
+                    self._bold_stars = 0
+                index += 2
+                continue
+
+            if self._bold_open:
+                if self._bold_first_star is None:
+                    self._bold_first_star = True
+                self._bold_last_star = True
+                self._bold_stars += 1
+            else:
+                self._double = self._double or self._last_star
+                self._last_star = True
+                self._stars += 1
+            index += 1
+
+    def _close_bold(self):
+        """Gras refermé : son contenu rejoint le texte de la ligne vu par la passe italique"""
+        self._bold_open = False
+        if self._bold_first_star is None:
+            return
+        self._double = self._double or (self._last_star and self._bold_first_star)
+        self._last_star = self._bold_last_star
+        self._stars += self._bold_stars
+
+    def _commit(self, end: int):
+        """Résout gras/italique du segment jusqu'à `end` (fin de ligne ou coupe sûre) et met à jour
+        l'état des liens ; vérifié après gras/italique (retirer "**" peut accoler "]" et "(")"""
+        segment = self._buffer[self._committed:end]
+        self._committed = end
+        self._reset_line()
+
+        if "[" not in segment and "]" not in segment and ")" not in segment:
+            return
+        if "*" in segment:
+            segment = SPEECH_ITALIC_PATTERN.sub(r'\1', SPEECH_BOLD_PATTERN.sub(r'\1', segment))
+
+        bracket = segment.rfind("[")
+        closing = segment.rfind("]")
+        if bracket != closing:
+            self._open_bracket = bracket > closing
+        link = segment.rfind("](")
+        if link != -1:
+            self._open_link = segment.find(")", link + 2) == -1
+        elif ")" in segment:
+            self._open_link = False
+
+# ================================
+# 🔤 LEXIQUE ET DÉTECTION DES MOTS-CLÉS (MULTI-MOTIFS)
+# ================================
+
+# Lexique central : catégorie → mots-clés (recherchés comme sous-chaînes, sans majuscules ni accents)
+KEYWORD_LEXICON = {
+    # IA Coach : type de demande
+    "simple_question": (
+        "bonjour", "salut", "hello", "coucou", "bonsoir",
+        "comment ça va", "comment vas-tu", "ça va", "comment allez-vous",
+        "quelle heure", "quel jour", "quelle date",
+        "merci", "au revoir", "à bientôt", "bye"
+    ),
+    "detailed_request": (
+        "explique", "détaille", "développe", "peux-tu expliquer", "comment faire",
+        "dis-moi plus", "raconte-moi", "j'aimerais savoir", "peux-tu me dire",
+        "comment ça marche", "pourquoi", "donne-moi des conseils", "aide-moi",
+        "j'ai besoin", "peux-tu m'aider", "comment puis-je", "que faire"
+    ),
+    "greeting": ("salut", "bonjour", "hello", "coucou", "bonsoir", "hey", "hi"),
+
+    # IA Coach : sujets de spécialité (priorité : COACH_TOPICS)
+    "topic:confiance": ("confiance", "estime de soi", "complexe", "timide", "sûr de moi"),
+    "topic:rendez-vous": ("rendez-vous", "premier rendez", "date", "sortir avec", "rencontrer"),
+    "topic:stress_social": ("stress social", "anxiété sociale", "timidité", "parler en public", "groupe"),
+    "topic:communication": ("communication", "parler", "écouter", "conversation", "charisme"),
+    "topic:developpement_personnel": (
+        "développement personnel", "motivation", "objectifs", "habitudes", "croissance", "bien-être",
+        "épanouissement", "réussir", "améliorer ma vie", "changer ma vie", "personnel", "développement", "développer"
+    ),
+
+    # Analyse multi-phrases : émotions et indices de contexte
+    "emotion:stress": ("stress", "stressé", "anxieux", "angoisse", "panique", "tendu"),
+    "emotion:tristesse": ("triste", "déprimé", "mal", "difficile", "dur", "peine"),
+    "emotion:colère": ("énervé", "furieux", "agacé", "irrité", "fâché"),
+    "emotion:joie": ("content", "heureux", "super", "génial", "parfait", "excellent"),
+    "emotion:confusion": ("comprends pas", "perdu", "confus", "compliqué", "bizarre"),
+    "context:relationship_context": ("copain", "copine", "relation", "couple", "ensemble"),
+    "context:work_context": ("travail", "boulot", "collègue", "patron", "bureau"),
+    "context:family_context": ("famille", "parents", "frère", "sœur", "enfant"),
+    "context:social_context": ("amis", "sortir", "soirée", "groupe", "social"),
+
+    # Actions demandées à l'IA Coach (jamais servies depuis le cache des réponses)
+    "action:profile_update": ("modifier profil", "changer profil"),
+    "action:event_creation": ("créer événement", "organiser"),
+    "action:social_post": ("poster", "publier"),
+    "action:image_generation": ("image", "photo", "dessiner"),
+    "action:internet_search": ("rechercher", "chercher sur internet"),
+    "search": ("chercher",),
+    "profile": ("profil",),
+
+    # Jeu de rôle : ton du message de l'utilisateur
+    "roleplay:positive": ("super", "génial", "cool", "sympa", "bien", "parfait", "excellent", "merci"),
+    "roleplay:negative": ("nul", "ennuyeux", "bizarre", "pas terrible", "bof"),
+    "roleplay:compliment": ("belle", "jolie", "sympa", "cool", "génial", "super", "parfait"),
+    "roleplay:personal": ("moi", "je", "mon", "ma", "mes"),
+    "roleplay:refusal": ("non", "pas vraiment", "bof", "mouais", "pas terrible"),
+    "roleplay:inappropriate": ("sexe", "coucher", "nue", "corps")
+}
+
+def build_accent_table() -> dict:
+    """Table de repli (1 caractère → 1 caractère) : lettres accentuées → lettre de base, apostrophes
+    typographiques → apostrophe droite ; les positions du texte replié sont celles du texte d'origine"""
+    table = {ord("’"): "'", ord("‘"): "'", ord("ʼ"): "'"}
+    for code in range(0xC0, 0x250):
+        decomposed = unicodedata.normalize("NFD", chr(code))
+        if len(decomposed) > 1 and all(unicodedata.combining(char) for char in decomposed[1:]):
+            table[code] = decomposed[0]
+    return table
+
+ACCENT_TABLE = build_accent_table()
+
+def fold_text(text: str) -> str:
+    """Minuscules sans accents (comparaison du lexique)"""
+    return text.lower().translate(ACCENT_TABLE)
+
+class KeywordMatches:
+    """Résultat d'un passage du détecteur : occurrences (début, fin, mot-clé) par catégorie"""
+
+    __slots__ = ("hits",)
+
+    def __init__(self, hits: dict):
+        self.hits = hits
+
+    def has(self, category: str) -> bool:
+        return category in self.hits
 
-    # Nettoyer les espaces multiples
-    text = re.sub(r'\s+', ' ', text)
+    def count(self, category: str) -> int:
+        """Nombre de mots-clés distincts de la catégorie présents dans le message"""
+        return len({keyword for _, _, keyword in self.hits.get(category, ())})
+
+    def offsets(self, category: str, before: Optional[int] = None) -> list:
+        return [(start, end) for start, end, _ in self.hits.get(category, ()) if before is None or end <= before]
+
+    def first(self, categories) -> Optional[str]:
+        """Première catégorie présente, dans l'ordre de priorité donné"""
+        for category in categories:
+            if category in self.hits:
+                return category
+        return None
+
+    def categories(self, prefix: str, before: Optional[int] = None) -> list:
+        """Catégories d'une famille (ex. "emotion:") présentes, dans l'ordre du lexique"""
+        return [
+            category[len(prefix):] for category in KEYWORD_LEXICON
+            if category.startswith(prefix) and self.offsets(category, before)
+        ]
+
+class KeywordMatcher:
+    """Détection multi-motifs de tout le lexique en un seul passage : les mots-clés forment un trie
+    compilé en une expression régulière (parcours en C, sans les dizaines de `in` par message) ; chaque
+    position candidate donne la plus longue correspondance, et ses préfixes qui sont aussi des mots-clés
+    complètent les occurrences chevauchantes (comme Aho-Corasick). Les derniers messages analysés sont
+    mémorisés : tous les consommateurs d'un même message partagent le même passage"""
+
+    def __init__(self, lexicon: dict, cache_size: int):
+        self.cache_size = cache_size
+        self._recent = OrderedDict()
+        self.counters = {"scans": 0, "cache_hits": 0}
+
+        categories_by_keyword = {}
+        for category, keywords in lexicon.items():
+            for keyword in keywords:
+                categories_by_keyword.setdefault(fold_text(keyword), []).append(category)
+        self.keyword_count = len(categories_by_keyword)
+
+        # Mot-clé le plus long trouvé à une position → tous les mots-clés qui commencent là
+        self._expansions = {
+            keyword: [
+                (len(prefix), prefix, tuple(categories_by_keyword[prefix]))
+                for prefix in categories_by_keyword if keyword.startswith(prefix)
+            ]
+            for keyword in categories_by_keyword
+        }
+        self._pattern = re.compile(self._compile_trie(categories_by_keyword))
+
+    @staticmethod
+    def _compile_trie(keywords) -> str:
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        def compile_node(node: dict) -> str:
+            branches = [re.escape(char) + compile_node(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ""
+            body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+            # Fin de mot-clé possible ici : la suite est optionnelle (gourmande = plus longue correspondance)
+            return f"(?:{body})?" if "" in node else body
+
+        return compile_node(trie)
+
+    def scan(self, text: str) -> KeywordMatches:
+        """Toutes les occurrences du lexique dans le message (positions dans le texte d'origine)"""
+        matches = self._recent.get(text)
+        if matches is not None:
+            self._recent.move_to_end(text)
+            self.counters["cache_hits"] += 1
+            return matches
+
+        self.counters["scans"] += 1
+        folded = fold_text(text)
+        hits = {}
+        search = self._pattern.search
+        position = 0
+        while True:
+            match = search(folded, position)
+            if not match:
+                break
+            start = match.start()
+            for length, keyword, categories in self._expansions[match.group()]:
+                for category in categories:
+                    hits.setdefault(category, []).append((start, start + length, keyword))
+            position = start + 1
+
+        matches = KeywordMatches(hits)
+        self._recent[text] = matches
+        if len(self._recent) > self.cache_size:
+            self._recent.popitem(last=False)
+        return matches
+
+    def get_stats(self) -> dict:
+        return {
+            "keywords": self.keyword_count,
+            "categories": len(KEYWORD_LEXICON),
+            "cached_messages": len(self._recent),
+            **self.counters
+        }
 
-    # Nettoyer les sauts de ligne multiples
-    text = re.sub(r'\n\s*\n', '. ', text)
+keyword_matcher = KeywordMatcher(KEYWORD_LEXICON, cache_size=int(os.getenv("KEYWORD_SCAN_CACHE_SIZE", "256")))
 
-    return text.strip()
+# Fin de phrase pour l'analyse multi-phrases
+SENTENCE_DELIMITER_RE = re.compile(r"[.!?] ")
 
 def analyze_multi_sentence_context(user_prompt: str) -> dict:
     """Analyse intelligente jusqu'à 5 phrases pour détecter contexte, émotion et intention"""
 
-    # Diviser en phrases (jusqu'à 5 maximum)
-    sentences = []
-    for delimiter in ['. ', '! ', '? ']:
-        user_prompt = user_prompt.replace(delimiter, '|SPLIT|')
+    # Diviser en phrases (jusqu'à 5 maximum) : les mots-clés des phrases suivantes sont ignorés
+    segments = []
+    start = 0
+    for boundary in SENTENCE_DELIMITER_RE.finditer(user_prompt):
+        segments.append((start, boundary.start()))
+        start = boundary.end()
+    segments.append((start, len(user_prompt)))
 
-    raw_sentences = user_prompt.split('|SPLIT|')
-    sentences = [s.strip() for s in raw_sentences if s.strip()][:5]  # Max 5 phrases
+    sentences = []
+    analyzed_end = len(user_prompt)
+    for start, end in segments:
+        sentence = user_prompt[start:end].strip()
+        if not sentence:
+            continue
+        if len(sentences) == 5:
+            analyzed_end = start
+            break
+        sentences.append(sentence)
 
     analysis = {
         "sentence_count": len(sentences),
@@ -188,19 +647,9 @@ def analyze_multi_sentence_context(user_prompt: str) -> dict:
         "needs_detailed_response": False
     }
 
-    # Analyse émotionnelle multi-phrases
-    emotional_keywords = {
-        "stress": ["stress", "stressé", "anxieux", "angoisse", "panique", "tendu"],
-        "tristesse": ["triste", "déprimé", "mal", "difficile", "dur", "peine"],
-        "colère": ["énervé", "furieux", "agacé", "irrité", "fâché"],
-        "joie": ["content", "heureux", "super", "génial", "parfait", "excellent"],
-        "confusion": ["comprends pas", "perdu", "confus", "compliqué", "bizarre"]
-    }
-
-    full_text = " ".join(sentences).lower()
-    for emotion, keywords in emotional_keywords.items():
-        if any(keyword in full_text for keyword in keywords):
-            analysis["emotional_indicators"].append(emotion)
+    # Analyse émotionnelle multi-phrases (lexique central, un seul passage sur le message)
+    matches = keyword_matcher.scan(user_prompt)
+    analysis["emotional_indicators"] = matches.categories("emotion:", analyzed_end)
 
     # Détection de complexité selon le nombre de phrases
     if len(sentences) >= 3:
@@ -210,28 +659,19 @@ def analyze_multi_sentence_context(user_prompt: str) -> dict:
         analysis["complexity_level"] = "medium"
 
     # Indices contextuels multi-phrases
-    context_patterns = {
-        "relationship_context": ["copain", "copine", "relation", "couple", "ensemble"],
-        "work_context": ["travail", "boulot", "collègue", "patron", "bureau"],
-        "family_context": ["famille", "parents", "frère", "sœur", "enfant"],
-        "social_context": ["amis", "sortir", "soirée", "groupe", "social"]
-    }
-
-    for context, keywords in context_patterns.items():
-        if any(keyword in full_text for keyword in keywords):
-            analysis["context_clues"].append(context)
+    analysis["context_clues"] = matches.categories("context:", analyzed_end)
 
     return analysis
 
-def get_best_ai_for_expertise(expertise: str = None, topic_detected: str = None) -> str:
-    """Sélectionne la meilleure IA selon l'expertise demandée"""
+async def get_best_ai_for_expertise(expertise: str = None, topic_detected: str = None, reservation: Optional[dict] = None) -> str:
+    """Sélectionne la meilleure IA selon l'expertise demandée (`reservation` : voir get_ai_with_budget_check)"""
 
     # Utiliser le mapping premium défini en haut du fichier
     # EXPERTISE_AI_MAPPING contient la configuration optimale
 
     # Priorité 1: Expertise explicite avec vérification budget
     if expertise:
-        best_ai = get_ai_with_budget_check(expertise)
+        best_ai = await get_ai_with_budget_check(expertise, reservation)
         print(f"🤖 IA sélectionnée pour expertise '{expertise}': {best_ai.upper()}")
         return best_ai
 
@@ -419,65 +859,103 @@ Ton ami s'appelle {user_ref}. Parle-lui comme tu parlerais à ton meilleur ami a
 IMPORTANT: Utilise le prénom SEULEMENT au début si nécessaire, puis utilise "tu" naturellement. Sois spontané et authentique."""
 
 async def stream_ia_response_chunks(prompt: str, session_id: str, expertise: str, user_name: str = None):
-    """Génère la réponse IA en streaming par chunks pour WebSocket"""
-
-    # Configuration streaming
-    chunk_size = int(os.getenv("WEBSOCKET_CHUNK_SIZE", "10"))
-    typing_delay = float(os.getenv("WEBSOCKET_TYPING_DELAY", "0.05"))
-
+    """Streame la réponse IA token par token pour WebSocket (text_chunk au fil de la génération) ;
+    le dernier message (is_complete) porte le texte final après limitation de longueur.
+    Un tour à la fois par session : le message attend la fin du tour en cours (ou est refusé si la file est pleine)"""
     try:
-        # Générer la réponse complète d'abord
-        full_response = await generate_ia_response_complete(prompt, session_id, expertise, user_name)
+        async with conversation_locks.hold(session_id):
+            async with aclosing(stream_ia_coach_turn(prompt, session_id, expertise, user_name)) as chunks:
+                async for chunk_data in chunks:
+                    yield chunk_data
+    except SessionBusy as e:
+        yield {
+            "type": "error",
+            "content": str(e),
+            "expertise": expertise,
+            "is_complete": True
+        }
 
-        # Diviser en chunks et streamer
-        words = full_response.split()
-        current_chunk = []
+async def stream_ia_coach_turn(prompt: str, session_id: str, expertise: str, user_name: str = None):
+    """Tour IA Coach en streaming (appelé sous le verrou de la session)"""
+    turn = await prepare_ia_coach_turn(prompt, session_id, expertise, user_name)
+    max_length = turn["max_response_length"]
+    parts = []
+    streamed_length = 0
+    service_used = None
+    cached = get_cached_ia_response(turn)
+    started = time.monotonic()
+    usage = {}
+    finalized = False
 
-        for word in words:
-            current_chunk.append(word)
+    try:
+        if cached:
+            # Réponse en cache : envoyée d'un bloc, sans appel IA
+            response, metadata = await finalize_ia_coach_turn(turn, cached["response"], cached["service_used"], cached)
+            yield {
+                "type": "text_chunk",
+                "content": response,
+                "expertise": expertise,
+                "is_complete": False
+            }
+            yield {
+                "type": "text_chunk",
+                "content": "",
+                "expertise": expertise,
+                "is_complete": True,
+                "full_text": response,
+                "metadata": metadata
+            }
+            return
 
-            # Envoyer chunk quand taille atteinte
-            if len(current_chunk) >= chunk_size:
-                chunk_text = " ".join(current_chunk)
+        async with aclosing(stream_with_best_ai(turn["system_prompt"], turn["best_ai"], usage, turn["generation_budget"])) as deltas:
+            async for service_used, delta in deltas:
+                parts.append(delta)
+                streamed_length += len(delta)
                 yield {
                     "type": "text_chunk",
-                    "content": chunk_text,
+                    "content": delta,
                     "expertise": expertise,
                     "is_complete": False
                 }
-                current_chunk = []
-                await asyncio.sleep(typing_delay)  # Simulation typing
 
-        # Envoyer le dernier chunk
-        if current_chunk:
-            chunk_text = " ".join(current_chunk)
-            yield {
-                "type": "text_chunk",
-                "content": chunk_text,
-                "expertise": expertise,
-                "is_complete": True
-            }
+                # Au-delà de la limite la suite serait tronquée : inutile de continuer à générer
+                if max_length and streamed_length > max_length:
+                    print(f"✂️ Limite de {max_length} caractères atteinte - arrêt du streaming")
+                    break
+
+        # Coût, troncature et mémoire une fois le flux terminé
+        finalized = True
+        response, metadata = await finalize_ia_coach_turn(turn, "".join(parts).strip(), service_used, usage=usage)
+        store_ia_response(turn, response, service_used, time.monotonic() - started, metadata["usage"])
 
     except Exception as e:
+        await record_ia_coach_error(session_id, e)
         yield {
             "type": "error",
             "content": f"Erreur streaming: {str(e)}",
             "expertise": expertise,
             "is_complete": True
         }
-
-async def generate_ia_response_complete(prompt: str, session_id: str, expertise: str, user_name: str = None) -> str:
-    """Version simplifiée qui utilise la fonction existante ia_coach_response"""
-
-    # Utiliser la fonction existante
-    response_text, _ = await ia_coach_response(
-        prompt,
-        session_id,
-        expertise,
-        user_name
-    )
-
-    return response_text
+        return
+
+    finally:
+        # Client parti ou erreur en cours de flux : les tokens déjà générés sont facturés
+        # (usage renvoyé par l'IA, sinon estimé à partir des morceaux reçus)
+        if not finalized and parts and service_used:
+            if "completion_tokens" not in usage:
+                complete_usage(service_used, usage, turn["system_prompt"], "".join(parts))
+            await record_ai_usage(expertise, session_id, service_used, usage, turn["budget_reservation"])
+        # Réponse en cache, erreur ou client parti : réservation non soldée rendue au budget
+        await release_budget(turn["budget_reservation"])
+
+    yield {
+        "type": "text_chunk",
+        "content": "",
+        "expertise": expertise,
+        "is_complete": True,
+        "full_text": response,
+        "metadata": metadata
+    }
 
 def get_ai_for_expertise(expertise: str = None) -> str:
     """Sélectionne la meilleure IA selon l'expertise"""
@@ -501,15 +979,146 @@ def get_image_ai_for_expertise(expertise: str = None) -> str:
 
     return selected_ai
 
-def reset_monthly_costs():
-    """Remet à zéro les coûts si on change de mois"""
-    current_month = datetime.now().strftime("%Y-%m")
-    if cost_tracker["last_reset"] != current_month:
-        print(f"🔄 Nouveau mois détecté, reset des coûts: {current_month}")
-        for key in cost_tracker:
-            if key != "last_reset":
-                cost_tracker[key] = 0.0
-        cost_tracker["last_reset"] = current_month
+# ================================
+# 🧾 REGISTRE DES COÛTS - SQLITE WAL PARTAGÉ ENTRE WORKERS
+# ================================
+
+class CostLedger:
+    """Dépenses du mois par catégorie (expertise ou "images") dans SQLite, partagées par tous les workers
+    du nœud. Avant un appel payant, son coût maximal est réservé (transaction BEGIN IMMEDIATE : vérification
+    et réservation atomiques entre processus) ; après l'appel, la réservation est soldée par le coût réel.
+    Une ligne par mois et par catégorie : l'historique est conservé, plus de remise à zéro"""
+
+    def __init__(self, path: str, reservation_ttl: float):
+        self.path = path
+        self.reservation_ttl = reservation_ttl
+        # Autocommit : les transactions sont ouvertes explicitement
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5.0, isolation_level=None)
+        self._db_lock = threading.Lock()
+        self.counters = {"reserved": 0, "rejected": 0, "settled": 0, "released": 0}
+
+        # WAL : lectures (/budget-status) sans bloquer les écritures des autres workers
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._db.execute("""CREATE TABLE IF NOT EXISTS cost_months (
+                month TEXT NOT NULL, category TEXT NOT NULL, spent REAL NOT NULL, calls INTEGER NOT NULL,
+                PRIMARY KEY (month, category))""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS cost_reservations (
+                id TEXT PRIMARY KEY, month TEXT NOT NULL, category TEXT NOT NULL, amount REAL NOT NULL, expires_at REAL NOT NULL)""")
+
+    @staticmethod
+    def current_month() -> str:
+        return datetime.now().strftime("%Y-%m")
+
+    @contextmanager
+    def _transaction(self, mode: str = "IMMEDIATE"):
+        """Transaction SQLite (IMMEDIATE : verrou d'écriture pris dès le début, DEFERRED : lecture cohérente)"""
+        with self._db_lock:
+            self._db.execute(f"BEGIN {mode}")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _totals(self, db, month: str, category: str) -> tuple[float, float]:
+        spent = db.execute(
+            "SELECT spent FROM cost_months WHERE month = ? AND category = ?", (month, category)
+        ).fetchone()
+        reserved = db.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM cost_reservations WHERE month = ? AND category = ?", (month, category)
+        ).fetchone()
+        return (spent[0] if spent else 0.0), reserved[0]
+
+    def reserve(self, category: str, amount: float, limit: float) -> Optional[str]:
+        """Réserve `amount` si la dépense du mois plus les réservations en cours le permettent ;
+        retourne l'identifiant de réservation, ou None si le budget est dépassé"""
+        month = self.current_month()
+        now = time.time()
+        with self._transaction() as db:
+            # Réservations de workers arrêtés en plein appel : libérées après expiration
+            db.execute("DELETE FROM cost_reservations WHERE expires_at < ?", (now,))
+            spent, reserved = self._totals(db, month, category)
+            if spent + reserved >= limit or spent + reserved + amount > limit:
+                self.counters["rejected"] += 1
+                print(f"⚠️ BUDGET DÉPASSÉ pour {category}: ${spent:.2f} dépensés + ${reserved:.2f} réservés (+${amount:.4f}) / ${limit:.2f}")
+                return None
+
+            reservation_id = uuid.uuid4().hex
+            db.execute(
+                "INSERT INTO cost_reservations VALUES (?, ?, ?, ?, ?)",
+                (reservation_id, month, category, amount, now + self.reservation_ttl)
+            )
+        self.counters["reserved"] += 1
+        return reservation_id
+
+    def settle(self, category: str, cost: float, reservation_id: Optional[str] = None) -> float:
+        """Ajoute le coût réel au mois (et solde la réservation) ; retourne la dépense du mois de la catégorie"""
+        month = self.current_month()
+        with self._transaction() as db:
+            if reservation_id:
+                db.execute("DELETE FROM cost_reservations WHERE id = ?", (reservation_id,))
+            db.execute(
+                """INSERT INTO cost_months VALUES (?, ?, ?, 1)
+                ON CONFLICT (month, category) DO UPDATE SET spent = spent + excluded.spent, calls = calls + 1""",
+                (month, category, cost)
+            )
+            spent = db.execute(
+                "SELECT spent FROM cost_months WHERE month = ? AND category = ?", (month, category)
+            ).fetchone()[0]
+        self.counters["settled"] += 1
+        return spent
+
+    def release(self, reservation_id: str):
+        """Annule une réservation non utilisée (réponse en cache, erreur, IA de repli gratuite)"""
+        with self._transaction() as db:
+            db.execute("DELETE FROM cost_reservations WHERE id = ?", (reservation_id,))
+        self.counters["released"] += 1
+
+    def get_spent(self, category: str) -> float:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT spent FROM cost_months WHERE month = ? AND category = ?", (self.current_month(), category)
+            ).fetchone()
+        return row[0] if row else 0.0
+
+    def get_month(self, month: Optional[str] = None) -> dict:
+        """Vue globale et cohérente (une transaction de lecture) : dépensé, réservé et appels par catégorie"""
+        month = month or self.current_month()
+        with self._transaction("DEFERRED") as db:
+            spent = db.execute("SELECT category, spent, calls FROM cost_months WHERE month = ?", (month,)).fetchall()
+            reserved = db.execute(
+                "SELECT category, SUM(amount), COUNT(*) FROM cost_reservations WHERE month = ? AND expires_at >= ? GROUP BY category",
+                (month, time.time())
+            ).fetchall()
+        categories = {category: {"spent": value, "calls": calls, "reserved": 0.0, "open_reservations": 0} for category, value, calls in spent}
+        for category, amount, count in reserved:
+            categories.setdefault(category, {"spent": 0.0, "calls": 0})
+            categories[category].update({"reserved": amount, "open_reservations": count})
+        return categories
+
+    def get_history(self) -> dict:
+        """Dépense totale et nombre d'appels de chaque mois enregistré"""
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT month, SUM(spent), SUM(calls) FROM cost_months GROUP BY month ORDER BY month"
+            ).fetchall()
+        return {month: {"spent": round(spent, 4), "calls": calls} for month, spent, calls in rows}
+
+    def get_stats(self) -> dict:
+        return {
+            "path": self.path,
+            "reservation_ttl_seconds": self.reservation_ttl,
+            **self.counters
+        }
+
+# Registre global (fichier partagé par les workers uvicorn du nœud)
+cost_ledger = CostLedger(
+    path=os.getenv("COST_LEDGER_PATH", "costs.db"),
+    reservation_ttl=float(os.getenv("COST_RESERVATION_TTL_SECONDS", "300"))
+)
 
 def estimate_cost(ai_name: str, tokens: int = 1000, is_image: bool = False) -> float:
     """Estime le coût d'une requête"""
@@ -519,47 +1128,45 @@ def estimate_cost(ai_name: str, tokens: int = 1000, is_image: bool = False) -> f
         cost_per_million = AI_COSTS.get(ai_name, 0.0)
         return (tokens / 1_000_000) * cost_per_million
 
-def add_cost(expertise: str, ai_name: str, tokens: int = 1000, is_image: bool = False):
-    """Ajoute un coût au tracker"""
-    reset_monthly_costs()
-
+async def add_cost(expertise: str, ai_name: str, tokens: int = 1000, is_image: bool = False, reservation: Optional[dict] = None):
+    """Ajoute un coût au registre (et solde la réservation prise avant l'appel)"""
     cost = estimate_cost(ai_name, tokens, is_image)
-    if is_image:
-        cost_tracker["images"] += cost
-        print(f"💰 Coût image ajouté: ${cost:.4f} | Total images: ${cost_tracker['images']:.2f}")
-    else:
-        cost_tracker[expertise] += cost
-        print(f"💰 Coût {expertise} ajouté: ${cost:.4f} | Total {expertise}: ${cost_tracker[expertise]:.2f}")
-
-def check_budget_limit(expertise: str, is_image: bool = False) -> bool:
-    """Vérifie si le budget est dépassé"""
-    reset_monthly_costs()
-
-    if is_image:
-        current_cost = cost_tracker["images"]
-        limit = BUDGET_LIMITS["images"]
-        category = "images"
-    else:
-        current_cost = cost_tracker[expertise]
-        limit = BUDGET_LIMITS.get(expertise, 10.0)
-        category = expertise
-
-    if current_cost >= limit:
-        print(f"⚠️ BUDGET DÉPASSÉ pour {category}: ${current_cost:.2f} >= ${limit:.2f}")
-        return False
-
-    remaining = limit - current_cost
-    print(f"💰 Budget {category}: ${current_cost:.2f}/${limit:.2f} (reste: ${remaining:.2f})")
-    return True
-
-def get_ai_with_budget_check(expertise: str = None) -> str:
-    """Sélectionne l'IA en tenant compte du budget"""
+    category = "images" if is_image else expertise
+    total = await asyncio.to_thread(cost_ledger.settle, category, cost, reservation.pop("id", None) if reservation else None)
+    print(f"💰 Coût {category} ajouté: ${cost:.4f} | Total {category}: ${total:.2f}")
+
+async def check_budget_limit(expertise: str, is_image: bool = False, amount: float = 0.0) -> Optional[str]:
+    """Réserve le coût maximal d'un appel sur le budget du mois (partagé entre workers) ;
+    retourne l'identifiant de réservation, ou None si le budget est dépassé.
+    Le registre est lu et écrit dans un thread : l'attente du verrou SQLite ne bloque pas la boucle"""
+    category = "images" if is_image else expertise
+    return await asyncio.to_thread(cost_ledger.reserve, category, amount, BUDGET_LIMITS.get(category, 10.0))
+
+async def release_budget(reservation: Optional[dict]):
+    """Libère la réservation d'un appel si elle n'a pas été soldée par le coût réel"""
+    reservation_id = reservation.pop("id", None) if reservation else None
+    if reservation_id:
+        await asyncio.to_thread(cost_ledger.release, reservation_id)
+
+async def get_ai_with_budget_check(expertise: str = None, reservation: Optional[dict] = None) -> str:
+    """Sélectionne l'IA en tenant compte du budget. Avec `reservation` ({"prompt", "generation_budget"}),
+    le coût maximal de l'appel à l'IA premium est réservé et l'identifiant ajouté (clé "id")"""
 
     if not expertise:
         expertise = "default"
 
-    # Vérifier le budget
-    if not check_budget_limit(expertise):
+    premium_ai = EXPERTISE_AI_MAPPING.get(expertise, "groq")
+    amount = 0.0
+    if reservation is not None:
+        amount = estimate_token_cost(
+            premium_ai,
+            token_estimator.estimate(premium_ai, reservation["prompt"]),
+            resolve_max_tokens(reservation.get("generation_budget"), premium_ai)
+        )
+
+    # Réserver le budget (atomique entre workers)
+    reservation_id = await check_budget_limit(expertise, amount=amount)
+    if not reservation_id:
         print(f"🔄 Budget dépassé pour {expertise}, basculement vers IA gratuite")
 
         # Fallback vers IA gratuite selon l'expertise
@@ -573,40 +1180,427 @@ def get_ai_with_budget_check(expertise: str = None) -> str:
         return fallback_ai
 
     # Budget OK, utiliser l'IA premium
-    return EXPERTISE_AI_MAPPING.get(expertise, "groq")
+    if reservation is not None:
+        reservation["id"] = reservation_id
+    else:
+        await asyncio.to_thread(cost_ledger.release, reservation_id)
+    return premium_ai
 
-def get_image_ai_with_budget_check(expertise: str = None) -> str:
-    """Sélectionne l'IA image en tenant compte du budget"""
+async def get_image_ai_with_budget_check(expertise: str = None, reservation: Optional[dict] = None) -> str:
+    """Sélectionne l'IA image en tenant compte du budget (prix de l'image premium réservé dans `reservation`)"""
 
-    if not check_budget_limit(expertise, is_image=True):
+    premium_ai = IMAGE_AI_MAPPING.get(expertise, "deepinfra")
+    reservation_id = await check_budget_limit(expertise, is_image=True, amount=estimate_cost(premium_ai, is_image=True))
+    if not reservation_id:
         print(f"🔄 Budget images dépassé, basculement vers DeepInfra")
         return "deepinfra"  # Moins cher que DALL-E 3
 
     # Budget OK, utiliser l'IA premium
-    return IMAGE_AI_MAPPING.get(expertise, "deepinfra")
+    if reservation is not None:
+        reservation["id"] = reservation_id
+    else:
+        await asyncio.to_thread(cost_ledger.release, reservation_id)
+    return premium_ai
+
+# ================================
+# 💰 COMPTABILITÉ DES TOKENS ET COÛTS IA
+# ================================
+
+class TokenEstimator:
+    """Estimation des tokens à partir du nombre de caractères quand l'IA ne renvoie pas d'usage :
+    ratio caractères/token par IA, recalibré (moyenne glissante) sur chaque usage réel reçu"""
+
+    def __init__(self, default_chars_per_token: float, smoothing: float):
+        self.default_chars_per_token = default_chars_per_token
+        self.smoothing = smoothing
+        self._ratios = {}
+        self._samples = {}
+
+    def chars_per_token(self, ai_name: Optional[str]) -> float:
+        return self._ratios.get(ai_name, self.default_chars_per_token)
+
+    def estimate(self, ai_name: Optional[str], text: str) -> int:
+        return max(1, round(len(text) / self.chars_per_token(ai_name))) if text else 0
+
+    def calibrate(self, ai_name: str, chars: int, tokens: int):
+        """Met à jour le ratio de l'IA avec un usage réel (prompt + réponse)"""
+        if chars <= 0 or tokens <= 0:
+            return
+        ratio = chars / tokens
+        previous = self._ratios.get(ai_name)
+        self._ratios[ai_name] = ratio if previous is None else previous + self.smoothing * (ratio - previous)
+        self._samples[ai_name] = self._samples.get(ai_name, 0) + 1
+
+    def get_stats(self) -> dict:
+        return {
+            "default_chars_per_token": self.default_chars_per_token,
+            "providers": {
+                ai_name: {"chars_per_token": round(ratio, 2), "samples": self._samples[ai_name]}
+                for ai_name, ratio in self._ratios.items()
+            }
+        }
+
+def estimate_token_cost(ai_name: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Coût d'un appel texte selon les tarifs entrée/sortie de l'IA"""
+    input_price, output_price = AI_TOKEN_PRICES.get(ai_name, (0.0, 0.0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+def complete_usage(ai_name: str, usage: dict, prompt: str, completion: str):
+    """Complète l'usage d'un appel : valeurs renvoyées par l'IA (et calibration de l'estimateur),
+    sinon estimation calibrée à partir des caractères du prompt et de la réponse"""
+    if usage.get("prompt_tokens") and usage.get("completion_tokens") is not None:
+        token_estimator.calibrate(ai_name, len(prompt) + len(completion), usage["prompt_tokens"] + usage["completion_tokens"])
+        usage["estimated"] = False
+        return
+
+    usage["prompt_tokens"] = token_estimator.estimate(ai_name, prompt)
+    usage["completion_tokens"] = token_estimator.estimate(ai_name, completion)
+    usage["estimated"] = True
+
+class UsageLedger:
+    """Journal des appels IA (tokens entrée/sortie, coût, usage réel ou estimé)
+    agrégé par expertise et par session (sessions les moins récentes évincées)"""
+
+    def __init__(self, max_entries: int, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._entries = deque(maxlen=max_entries)
+        self._expertises = {}
+        self._sessions = OrderedDict()
+
+    @staticmethod
+    def _new_totals() -> dict:
+        return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "estimated_calls": 0}
+
+    @staticmethod
+    def _add(totals: dict, entry: dict):
+        totals["calls"] += 1
+        totals["prompt_tokens"] += entry["prompt_tokens"]
+        totals["completion_tokens"] += entry["completion_tokens"]
+        totals["cost"] += entry["cost"]
+        totals["estimated_calls"] += entry["estimated"]
+
+    def record(self, entry: dict):
+        self._entries.append(entry)
+        self._add(self._expertises.setdefault(entry["expertise"], self._new_totals()), entry)
+
+        session_id = entry["session_id"]
+        if session_id:
+            totals = self._sessions.pop(session_id, None) or self._new_totals()
+            self._add(totals, entry)
+            self._sessions[session_id] = totals
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def get_session(self, session_id: str) -> Optional[dict]:
+        return self._sessions.get(session_id)
+
+    def get_stats(self) -> dict:
+        return {
+            "by_expertise": {
+                expertise: {**totals, "cost": round(totals["cost"], 6)}
+                for expertise, totals in self._expertises.items()
+            },
+            "tracked_sessions": len(self._sessions),
+            "recent": list(self._entries)[-10:],
+            "estimator": token_estimator.get_stats()
+        }
+
+token_estimator = TokenEstimator(
+    default_chars_per_token=float(os.getenv("AI_CHARS_PER_TOKEN", "3.5")),
+    smoothing=float(os.getenv("AI_CHARS_PER_TOKEN_SMOOTHING", "0.1"))
+)
+
+usage_ledger = UsageLedger(
+    max_entries=int(os.getenv("AI_USAGE_LEDGER_ENTRIES", "1000")),
+    max_sessions=int(os.getenv("AI_USAGE_LEDGER_SESSIONS", "5000"))
+)
+
+async def record_ai_usage(expertise: Optional[str], session_id: Optional[str], ai_name: str, usage: dict,
+                          reservation: Optional[dict] = None) -> dict:
+    """Comptabilise un appel IA texte : coût réel (tarifs entrée/sortie) ajouté au budget de l'expertise
+    (réservation soldée) et au journal d'usage ; retourne l'entrée enregistrée"""
+    expertise = expertise or "default"
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", 0)
+    cost = estimate_token_cost(ai_name, prompt_tokens, completion_tokens)
+
+    month_total = await asyncio.to_thread(cost_ledger.settle, expertise, cost, reservation.pop("id", None) if reservation else None)
+    entry = {
+        "timestamp": datetime.now().isoformat(),
+        "ai": ai_name,
+        "expertise": expertise,
+        "session_id": session_id,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "estimated": usage.get("estimated", True),
+        "cost": cost
+    }
+    usage_ledger.record(entry)
+
+    source = "estimé" if entry["estimated"] else "réel"
+    print(f"💰 Coût {expertise} ({ai_name}, usage {source}): {prompt_tokens}+{completion_tokens} tokens = ${cost:.5f} | Total {expertise}: ${month_total:.4f}")
+
+    # Tentatives parallèles (hedging) qui ont aussi abouti : tokens facturés par l'IA, comptés en plus
+    for hedged_ai, hedged_usage in usage.get("hedged", []):
+        await record_ai_usage(expertise, session_id, hedged_ai, hedged_usage)
+    return entry
+
+# ================================
+# 📏 BUDGETS DE GÉNÉRATION PAR CLASSE DE RÉPONSE
+# ================================
+
+# Classe de réponse décidée avant l'appel : longueur gardée (caractères, None = sans limite)
+# et arrêt au premier paragraphe pour les réponses courtes
+RESPONSE_CLASSES = {
+    "amical": {"max_chars": 200, "single_paragraph": True},
+    "priority": {"max_chars": None, "single_paragraph": False},
+    "simple": {"max_chars": 300, "single_paragraph": True},
+    "detailed": {"max_chars": 2000, "single_paragraph": False},
+    "short": {"max_chars": 800, "single_paragraph": False},
+    "roleplay": {"max_chars": 400, "single_paragraph": True}
+}
+
+# Le modèle ne doit pas écrire le tour suivant de la conversation
+GENERATION_STOP_SEQUENCES = ("\nUTILISATEUR:", "\nuser:", "\nLui:")
+# Marge de tokens au-delà de la longueur gardée (finir la phrase en cours)
+GENERATION_TOKEN_HEADROOM = float(os.getenv("GENERATION_TOKEN_HEADROOM", "1.3"))
+GENERATION_MIN_TOKENS = int(os.getenv("GENERATION_MIN_TOKENS", "48"))
+
+def get_default_max_tokens() -> int:
+    """Plafond global : RESPONSE_MAX_WORDS (~1.33 tokens par mot français)"""
+    return int(int(os.getenv("RESPONSE_MAX_WORDS", "500")) * 1.33)
+
+def get_response_class(expertise: Optional[str], topic_detected: Optional[str],
+                       is_simple_question: bool, wants_detailed_explanation: bool) -> str:
+    """Classe de réponse d'un tour de l'IA Coach (même priorité que l'ancienne limite de longueur)"""
+    if expertise == "amical":
+        return "amical"
+    if topic_detected in COACH_PRIORITY_TOPICS:
+        return "priority"
+    if is_simple_question:
+        return "simple"
+    if wants_detailed_explanation:
+        return "detailed"
+    return "short"
+
+def get_generation_budget(response_class: str) -> dict:
+    """Politique d'appel d'une classe de réponse : longueur gardée et séquences d'arrêt"""
+    policy = RESPONSE_CLASSES[response_class]
+    stop = ("\n\n",) + GENERATION_STOP_SEQUENCES if policy["single_paragraph"] else GENERATION_STOP_SEQUENCES
+    return {"response_class": response_class, "max_chars": policy["max_chars"], "stop": list(stop)}
+
+def resolve_max_tokens(budget: Optional[dict], ai_name: str) -> int:
+    """max_tokens pour une IA : longueur gardée convertie avec le ratio caractères/token calibré de l'IA,
+    plus une marge, sans dépasser le plafond global"""
+    default = get_default_max_tokens()
+    if not budget or not budget["max_chars"]:
+        return default
+    tokens = math.ceil(budget["max_chars"] / token_estimator.chars_per_token(ai_name) * GENERATION_TOKEN_HEADROOM)
+    return max(GENERATION_MIN_TOKENS, min(default, tokens))
+
+class GenerationBudgetTracker:
+    """Par classe de réponse : tokens autorisés, générés, et gaspillés (texte généré puis tronqué)"""
+
+    def __init__(self):
+        self._classes = {}
+
+    def record(self, response_class: str, max_tokens: Optional[int], completion_tokens: int,
+               generated_chars: int, kept_chars: int) -> int:
+        """Enregistre un tour généré ; retourne les tokens gaspillés (au prorata du texte coupé)"""
+        wasted_tokens = 0
+        if generated_chars > kept_chars and completion_tokens:
+            wasted_tokens = round(completion_tokens * (generated_chars - kept_chars) / generated_chars)
+
+        stats = self._classes.setdefault(response_class, {
+            "turns": 0,
+            "max_tokens": 0,
+            "completion_tokens": 0,
+            "wasted_tokens": 0,
+            "truncated": 0,
+            "hit_token_limit": 0
+        })
+        stats["turns"] += 1
+        stats["max_tokens"] += max_tokens or 0
+        stats["completion_tokens"] += completion_tokens
+        stats["wasted_tokens"] += wasted_tokens
+        stats["truncated"] += generated_chars > kept_chars
+        stats["hit_token_limit"] += bool(max_tokens) and completion_tokens >= max_tokens
+        return wasted_tokens
+
+    def get_stats(self) -> dict:
+        return {
+            response_class: {
+                **stats,
+                "avg_max_tokens": round(stats["max_tokens"] / stats["turns"], 1),
+                "avg_completion_tokens": round(stats["completion_tokens"] / stats["turns"], 1),
+                "truncation_rate": round(stats["truncated"] / stats["turns"], 3),
+                "waste_rate": round(stats["wasted_tokens"] / stats["completion_tokens"], 3) if stats["completion_tokens"] else 0.0
+            }
+            for response_class, stats in self._classes.items()
+        }
+
+generation_budgets = GenerationBudgetTracker()
+
+# ================================
+# 🎤 REGISTRE DES VOIX EDGE TTS
+# ================================
+
+VOICE_CATALOG_PATH = os.getenv("VOICE_CATALOG_PATH", "voices_catalog.json")
+
+async def fetch_voice_catalog() -> list:
+    """Récupère les voix françaises disponibles auprès d'Edge TTS (appel réseau)"""
+    voices = await edge_tts.list_voices()
+    return [
+        {
+            "ShortName": v.get("ShortName", v["Name"]),
+            "Gender": v.get("Gender"),
+            "Locale": v["Locale"],
+            "FriendlyName": v.get("FriendlyName")
+        }
+        for v in voices if v["Locale"].startswith("fr-")
+    ]
+
+def save_voice_catalog(path: str, voices: list):
+    """Écrit l'instantané du catalogue des voix (écriture atomique)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"updated_at": datetime.now().isoformat(), "voices": voices}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+class VoiceRegistry:
+    """Catalogue des voix (instantané disque, rafraîchi en arrière-plan) et correspondances
+    expertise / sujet / personnage → voix validées une fois, à la configuration"""
+
+    def __init__(self, snapshot_path: str, refresh_interval: float):
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.available = set(FRENCH_VOICES)
+        self.source = "builtin"
+        self.updated_at = None
+        self.expertise_voices = {}
+        self.topic_voices = {}
+        self.roleplay_voices = {}
+        self._refresh_task = None
+
+        self.load_snapshot()
+        self.resolve()
+
+    def load_snapshot(self) -> bool:
+        """Charge l'instantané disque (sans appel réseau) ; garde FRENCH_VOICES s'il est absent"""
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            available = {v["ShortName"] for v in snapshot["voices"]}
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"⚠️ Catalogue des voix illisible ({self.snapshot_path}): {e}")
+            return False
+
+        if not available:
+            return False
+
+        self.available = available
+        self.source = "snapshot"
+        self.updated_at = snapshot.get("updated_at")
+        print(f"🎤 Catalogue des voix chargé: {len(available)} voix françaises ({self.snapshot_path})")
+        return True
+
+    def is_available(self, voice: str) -> bool:
+        return voice in self.available
+
+    def _pick(self, key: str, candidates: list) -> str:
+        for voice in candidates:
+            if voice in self.available:
+                if voice != candidates[0]:
+                    print(f"⚠️ Voix {candidates[0]} indisponible pour '{key}' → {voice}")
+                return voice
+
+        print(f"⚠️ Aucune voix disponible pour '{key}' → {DEFAULT_VOICE}")
+        return DEFAULT_VOICE
+
+    def resolve(self):
+        """Calcule une fois toutes les correspondances vers des voix du catalogue"""
+        expertise_voices = {key: self._pick(key, candidates) for key, candidates in EXPERTISE_VOICES.items()}
+        self.topic_voices = {
+            topic: expertise_voices.get(expertise, expertise_voices["default"])
+            for topic, expertise in TOPIC_EXPERTISE.items()
+        }
+        self.roleplay_voices = {key: self._pick(key, candidates) for key, candidates in ROLEPLAY_PERSONA_VOICES.items()}
+        self.expertise_voices = expertise_voices
+
+    async def refresh(self):
+        """Récupère le catalogue à jour, met l'instantané à jour et recalcule les correspondances"""
+        voices = await fetch_voice_catalog()
+        if not voices:
+            raise RuntimeError("Catalogue Edge TTS vide")
+        save_voice_catalog(self.snapshot_path, voices)
+        self.load_snapshot()
+        self.resolve()
+
+    def _seconds_until_stale(self) -> float:
+        try:
+            age = time.time() - os.path.getmtime(self.snapshot_path)
+        except OSError:
+            return 0
+        return max(0, self.refresh_interval - age)
+
+    async def _refresh_loop(self):
+        delay = self._seconds_until_stale()
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"⚠️ Rafraîchissement du catalogue des voix impossible: {e}")
+            delay = self.refresh_interval
+
+    def start(self):
+        """Lance le rafraîchissement périodique en arrière-plan (désactivé si intervalle nul)"""
+        if self.refresh_interval > 0 and not self._refresh_task:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+    def get_mappings(self) -> dict:
+        return {
+            "catalog": {
+                "source": self.source,
+                "path": self.snapshot_path,
+                "updated_at": self.updated_at,
+                "voices": sorted(self.available)
+            },
+            "expertise": self.expertise_voices,
+            "topics": self.topic_voices,
+            "roleplay": self.roleplay_voices
+        }
+
+# Registre global des voix
+voice_registry = VoiceRegistry(
+    snapshot_path=VOICE_CATALOG_PATH,
+    refresh_interval=float(os.getenv("VOICE_CATALOG_REFRESH_HOURS", "24")) * 3600
+)
 
 def get_voice_for_expertise(expertise: str = None, topic_detected: str = None) -> str:
     """Détermine la voix à utiliser selon l'expertise et le sujet détecté"""
 
     # Priorité 1: Expertise explicite du front
     if expertise:
-        voice = EXPERTISE_VOICES.get(expertise, DEFAULT_VOICE)
+        voice = voice_registry.expertise_voices.get(expertise, DEFAULT_VOICE)
         print(f"🎤 Voix sélectionnée pour expertise '{expertise}': {voice}")
         return voice
 
     # Priorité 2: Sujet détecté automatiquement
     if topic_detected:
-        topic_to_expertise = {
-            "confiance": "psychology",           # Confiance → Psychologie
-            "stress_social": "psychology",       # Stress social → Psychologie
-            "communication": "seduction",        # Communication → Séduction
-            "rendez-vous": "seduction",          # Rendez-vous → Séduction
-            "developpement_personnel": "development"  # Développement → Développement
-        }
-
-        mapped_expertise = topic_to_expertise.get(topic_detected, "default")
-        voice = EXPERTISE_VOICES.get(mapped_expertise, DEFAULT_VOICE)
-        print(f"🎤 Voix sélectionnée pour sujet '{topic_detected}' → expertise '{mapped_expertise}': {voice}")
+        voice = voice_registry.topic_voices.get(topic_detected, voice_registry.expertise_voices["default"])
+        print(f"🎤 Voix sélectionnée pour sujet '{topic_detected}': {voice}")
         return voice
 
     # Priorité 3: Voix par défaut
@@ -641,8 +1635,40 @@ COACHING_TOPICS = [
     }
 ]
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Démarrage et arrêt de l'application (ressources partagées)"""
+    # Pack audio pré-généré des questions d'inscription (mémoire mappée)
+    load_inscription_audio_pack()
+
+    # Catalogue des voix : instantané déjà chargé, mise à jour en arrière-plan
+    voice_registry.start()
+
+    # Cache audio TTS : occupation disque calculée une fois, dans un thread
+    if tts_cache:
+        tts_cache.start()
+
+    # Conversations : écriture différée vers SQLite (backend sqlite)
+    conversation_store.start()
+
+    # Connexions HTTP vers les fournisseurs IA ouvertes à l'avance (sans bloquer le démarrage)
+    http_warmup = asyncio.create_task(
+        http_clients.warm_up(get_http_warmup_urls(), int(os.getenv("HTTP_WARMUP_CONNECTIONS", "2")))
+    )
+
+    yield
+
+    http_warmup.cancel()
+    await voice_registry.stop()
+    await conversation_store.stop()
+    await http_clients.close()
+    await groq_client.close()
+
+    if inscription_audio_pack:
+        inscription_audio_pack.close()
+
 # Application FastAPI
-app = FastAPI(title="MeetVoice Questions", version="1.0")
+app = FastAPI(title="MeetVoice Questions", version="1.0", lifespan=lifespan)
 
 # Configuration CORS
 app.add_middleware(
@@ -691,277 +1717,1940 @@ QUESTIONS = [
     "Fantastique ! Merci d'avoir pris le temps de remplir ce formulaire. Votre inscription est maintenant en cours de traitement et vous devriez bientôt pouvoir découvrir MeetVoice !"
 ]
 
+# ================================
+# 🎵 CACHE AUDIO TTS - LRU MÉMOIRE + STOCKAGE DISQUE
+# ================================
 
+class TTSAudioCache:
+    """Cache audio adressé par contenu (voix + texte nettoyé) : LRU en mémoire devant un stockage disque"""
+
+    def __init__(self, cache_dir: str, memory_max_bytes: int, disk_max_bytes: int, max_age_seconds: float):
+        self.cache_dir = cache_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.max_age_seconds = max_age_seconds
+
+        # clé -> (audio, timestamp de création)
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None  # Calculé une fois au démarrage (scan dans un thread), puis tenu à jour
+        self._disk_task = None  # scan ou éviction disque en cours (thread)
+        self._replace_lock = threading.Lock()  # écritures disque faites dans des threads
+
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "expired": 0
+        }
 
-async def generate_audio(text: str, voice: str = None) -> bytes:
-    """Génère l'audio TTS avec Edge TTS"""
-    try:
-        # Nettoyer le texte pour la synthèse vocale (supprimer Markdown)
-        clean_text = clean_text_for_speech(text)
-        print(f"🧹 Texte nettoyé: {clean_text[:100]}..." if len(clean_text) > 100 else f"🧹 Texte nettoyé: {clean_text}")
+    @staticmethod
+    def make_key(voice: str, clean_text: str) -> str:
+        """Clé de contenu : SHA-256 de la voix et du texte déjà nettoyé"""
+        return hashlib.sha256(f"{voice}\n{clean_text}".encode("utf-8")).hexdigest()
 
-        # Utilise la voix spécifiée ou la voix par défaut
-        selected_voice = voice if voice else DEFAULT_VOICE
+    def _path(self, key: str) -> str:
+        # Répartition sur 256 sous-répertoires pour éviter les dossiers géants
+        return os.path.join(self.cache_dir, key[:2], f"{key}.mp3")
 
-        # Validation de la voix
-        if selected_voice not in FRENCH_VOICES:
-            print(f"⚠️ Voix {selected_voice} non supportée dans generate_audio → {DEFAULT_VOICE}")
-            selected_voice = DEFAULT_VOICE
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.max_age_seconds > 0 and now - created_at > self.max_age_seconds
 
-        print(f"🎵 Edge TTS avec voix: {selected_voice}")
-        communicate = edge_tts.Communicate(clean_text, selected_voice)
-        audio_data = b""
+    def _remember(self, key: str, audio_data: bytes, created_at: float):
+        """Ajoute une entrée en mémoire et évince les moins récemment utilisées"""
+        if len(audio_data) > self.memory_max_bytes:
+            return
 
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                audio_data += chunk["data"]
+        previous = self._memory.pop(key, None)
+        if previous:
+            self._memory_bytes -= len(previous[0])
+
+        self._memory[key] = (audio_data, created_at)
+        self._memory_bytes += len(audio_data)
+
+        while self._memory_bytes > self.memory_max_bytes and self._memory:
+            _, (evicted_audio, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted_audio)
+            self.counters["memory_evictions"] += 1
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Retourne l'audio en cache ou None (LRU mémoire sur la boucle, lecture disque dans un thread)"""
+        now = time.time()
+
+        entry = self._memory.get(key)
+        if entry:
+            audio_data, created_at = entry
+            if not self._is_expired(created_at, now):
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return audio_data
+
+            del self._memory[key]
+            self._memory_bytes -= len(audio_data)
+            self.counters["expired"] += 1
+
+        found = await asyncio.to_thread(self._read_disk, key, now)
+        if found == "expired":
+            self.counters["expired"] += 1
+        elif found:
+            audio_data, created_at = found
+            self._remember(key, audio_data, created_at)
+            self.counters["disk_hits"] += 1
+            return audio_data
+
+        self.counters["misses"] += 1
+        return None
+
+    def _read_disk(self, key: str, now: float):
+        """Lecture disque (thread) : (audio, date de création), "expired" (fichier supprimé) ou None"""
+        path = self._path(key)
+        try:
+            created_at = os.path.getmtime(path)
+            if self._is_expired(created_at, now):
+                self._remove_file(path)
+                return "expired"
+            with open(path, "rb") as f:
+                audio_data = f.read()
+            if audio_data:
+                return audio_data, created_at
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"⚠️ Lecture cache TTS impossible: {e}")
+        return None
 
+    async def put(self, key: str, audio_data: bytes):
+        """Enregistre l'audio en mémoire, puis sur disque dans un thread (écriture atomique)"""
         if not audio_data:
-            print("⚠️ Aucune donnée audio générée")
-            return b""
+            return
 
-        print(f"✅ Audio généré: {len(audio_data)} bytes")
-        return audio_data
+        now = time.time()
+        self._remember(key, audio_data, now)
+        self.counters["stores"] += 1
 
-    except Exception as e:
-        print(f"❌ Erreur TTS: {e}")
-        print(f"❌ Type d'erreur: {type(e).__name__}")
-        return b""
+        replaced_bytes = await asyncio.to_thread(self._write_disk, key, audio_data)
+        if replaced_bytes is None:
+            return
 
-async def generate_with_best_ai(prompt: str, preferred_ai: str = "groq") -> tuple[str, str]:
-    """Génère avec l'IA préférée selon l'expertise, avec fallback"""
+        if self._disk_bytes is None:
+            # Total pas encore connu (scan de démarrage en cours ou hors serveur)
+            self._run_disk_task(self._scan_disk_usage_into_total)
+            return
 
-    # Limite de mots depuis .env
-    max_words = int(os.getenv("RESPONSE_MAX_WORDS", "500"))
-    max_tokens = int(max_words * 1.33)  # ~1.33 tokens par mot français
+        # Fichier existant remplacé (même phrase écrite deux fois) : seule la différence compte
+        self._disk_bytes += len(audio_data) - replaced_bytes
+        if self._disk_bytes > self.disk_max_bytes:
+            self._run_disk_task(self.evict_disk)
 
-    if preferred_ai == "claude-3.5-sonnet":
-        # Tentative 1: Claude 3.5 Sonnet (excellent pour psychologie/développement)
+    def _write_disk(self, key: str, audio_data: bytes) -> Optional[int]:
+        """Écriture atomique (thread) : taille du fichier remplacé (0 si nouveau), None en cas d'échec"""
+        path = self._path(key)
+        # Nom temporaire propre au thread : deux écritures de la même clé peuvent se croiser
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(audio_data)
+            # Taille remplacée et remplacement indissociables : sinon deux écritures croisées comptent 0 chacune
+            with self._replace_lock:
+                try:
+                    replaced_bytes = os.path.getsize(path)
+                except FileNotFoundError:
+                    replaced_bytes = 0
+                os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"⚠️ Écriture cache TTS impossible: {e}")
+            self._remove_file(tmp_path)
+            return None
+        return replaced_bytes
+
+    def _remove_file(self, path: str) -> int:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
+
+    def _list_disk_entries(self) -> list:
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".mp3"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_disk_usage(self) -> int:
+        return sum(size for _, size, _ in self._list_disk_entries())
+
+    def _scan_disk_usage_into_total(self):
+        self._disk_bytes = self._scan_disk_usage()
+        if self._disk_bytes > self.disk_max_bytes:
+            self.evict_disk()
+
+    def _run_disk_task(self, work):
+        """Parcours du répertoire hors boucle d'événements (un seul à la fois) ; direct sans boucle (scripts)"""
         try:
-            print("🎭 Tentative avec Claude 3.5 Sonnet (empathique et nuancé)...")
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            work()
+            return
+        if self._disk_task is None or self._disk_task.done():
+            self._disk_task = loop.create_task(asyncio.to_thread(work))
+
+    def start(self):
+        """Total disque de référence calculé une fois au démarrage, dans un thread"""
+        self._run_disk_task(self._scan_disk_usage_into_total)
+
+    def evict_disk(self):
+        """Supprime les fichiers expirés puis les plus anciens jusqu'à 90% du budget disque
+        (parcours complet : exécuté dans un thread)"""
+        now = time.time()
+        entries = sorted(self._list_disk_entries())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.disk_max_bytes * 0.9)
+        removed = 0
+
+        for mtime, size, path in entries:
+            if not self._is_expired(mtime, now) and total <= target:
+                break
+            if self._remove_file(path):
+                total -= size
+                removed += size
+                self.counters["disk_evictions"] += 1
+
+        # Écritures faites pendant le parcours conservées dans le total
+        self._disk_bytes = total if self._disk_bytes is None else max(0, self._disk_bytes - removed)
+
+    def get_stats(self) -> dict:
+        """Compteurs hit/miss et occupation du cache"""
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        lookups = hits + self.counters["misses"]
 
-            anthropic_key = os.getenv("ANTHROPIC_API_KEY")
-            if anthropic_key and anthropic_key != "your_claude_key_here":
-                # TODO: Implémenter l'appel Claude API
-                print("🔄 Claude non encore implémenté, fallback vers Gemini")
-                preferred_ai = "gemini"
-            else:
-                print("⚠️ Clé Claude manquante, fallback vers Gemini")
-                preferred_ai = "gemini"
+        return {
+            **self.counters,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_max_bytes": self.memory_max_bytes,
+            "disk_bytes": self._disk_bytes,
+            "disk_max_bytes": self.disk_max_bytes,
+            "max_age_seconds": self.max_age_seconds
+        }
 
-        except Exception as e:
-            print(f"❌ Erreur Claude: {str(e)}")
-            preferred_ai = "gemini"
+# Cache TTS global (désactivable via TTS_CACHE_ENABLED=false)
+tts_cache = None
+if os.getenv("TTS_CACHE_ENABLED", "true").lower() == "true":
+    tts_cache = TTSAudioCache(
+        cache_dir=os.getenv("TTS_CACHE_DIR", ".tts_cache"),
+        memory_max_bytes=int(float(os.getenv("TTS_CACHE_MEMORY_MB", "64")) * 1024 * 1024),
+        disk_max_bytes=int(float(os.getenv("TTS_CACHE_DISK_MB", "1024")) * 1024 * 1024),
+        max_age_seconds=float(os.getenv("TTS_CACHE_MAX_AGE_DAYS", "30")) * 86400
+    )
 
-    if preferred_ai == "gpt-4o":
-        # Tentative: GPT-4o (excellent pour séduction avec GPTs)
-        try:
-            print("🤖 Tentative avec GPT-4o (accès GPTs spécialisés)...")
+# ================================
+# 🚦 ORDONNANCEUR TTS - PRIORITÉS ET CONTRE-PRESSION
+# ================================
 
-            openai_key = os.getenv("OPENAI_API_KEY")
-            if openai_key and openai_key != "your_openai_key_here":
+# Priorités (plus petit = servi en premier)
+TTS_PRIORITY_INTERACTIVE = 0  # /ws/ia et roleplay : un utilisateur attend la voix
+TTS_PRIORITY_PREFETCH = 1     # questions d'inscription générées à la volée
+TTS_PRIORITY_BATCH = 2        # pré-génération du pack audio
 
-                headers = {
-                    "Authorization": f"Bearer {openai_key}",
-                    "Content-Type": "application/json"
-                }
+TTS_PRIORITY_NAMES = {
+    TTS_PRIORITY_INTERACTIVE: "interactive",
+    TTS_PRIORITY_PREFETCH: "prefetch",
+    TTS_PRIORITY_BATCH: "batch"
+}
+
+class TTSQueueFull(Exception):
+    """File d'attente TTS saturée : l'appelant répond en texte seul"""
+
+class TTSScheduler:
+    """Limite le nombre de synthèses Edge TTS simultanées, les demandes en attente sont servies par priorité"""
+
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiters = []  # tas de [priorité, ordre d'arrivée, future]
+        self._arrivals = 0
+
+        # Statistiques
+        self.rejected = 0
+        self.peak_queued = 0
+        self.served = {name: 0 for name in TTS_PRIORITY_NAMES.values()}
+        self.wait_total = {name: 0.0 for name in TTS_PRIORITY_NAMES.values()}
+        self.wait_max = {name: 0.0 for name in TTS_PRIORITY_NAMES.values()}
+
+    @asynccontextmanager
+    async def slot(self, priority: int = TTS_PRIORITY_INTERACTIVE):
+        """Réserve une place de synthèse ; fournit le temps d'attente en file (secondes)"""
+        wait = await self._acquire(priority)
+        try:
+            yield wait
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: int) -> float:
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self._record(priority, 0.0)
+            return 0.0
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            print(f"🚦 File TTS pleine ({len(self._waiters)} en attente) - demande {TTS_PRIORITY_NAMES[priority]} rejetée")
+            raise TTSQueueFull(f"File TTS pleine ({len(self._waiters)} demandes en attente)")
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, self._arrivals, future]
+        self._arrivals += 1
+        heapq.heappush(self._waiters, entry)
+        self.peak_queued = max(self.peak_queued, len(self._waiters))
 
-                data = {
-                    "model": "gpt-4o",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.7,
-                    "max_tokens": max_tokens
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Place attribuée juste avant l'annulation : on la rend
+                self._release()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+        wait = time.monotonic() - started
+        self._record(priority, wait)
+        print(f"⏳ TTS {TTS_PRIORITY_NAMES[priority]}: {wait * 1000:.0f} ms d'attente en file")
+        return wait
+
+    def _release(self):
+        # La place passe directement au prochain demandeur (le compteur actif ne change pas)
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def _record(self, priority: int, wait: float):
+        name = TTS_PRIORITY_NAMES[priority]
+        self.served[name] += 1
+        self.wait_total[name] += wait
+        self.wait_max[name] = max(self.wait_max[name], wait)
+
+    def get_stats(self) -> dict:
+        """Occupation et temps d'attente par priorité"""
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queued": len(self._waiters),
+            "peak_queued": self.peak_queued,
+            "rejected": self.rejected,
+            "priorities": {
+                name: {
+                    "served": self.served[name],
+                    "avg_wait_ms": round(self.wait_total[name] / self.served[name] * 1000, 1) if self.served[name] else 0.0,
+                    "max_wait_ms": round(self.wait_max[name] * 1000, 1)
                 }
+                for name in TTS_PRIORITY_NAMES.values()
+            }
+        }
 
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        "https://api.openai.com/v1/chat/completions",
-                        headers=headers,
-                        json=data,
-                        timeout=aiohttp.ClientTimeout(total=30)
-                    ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            if result.get("choices") and result["choices"][0].get("message"):
-                                content = result["choices"][0]["message"]["content"]
-                                print("✅ Succès avec GPT-4o")
-                                # Le tracking sera fait dans ia_coach_response
-                                return content.strip(), "gpt-4o"
-                        else:
-                            print(f"❌ Erreur GPT-4o: {response.status}")
-            else:
-                print("⚠️ Clé OpenAI manquante, fallback vers Groq")
-                preferred_ai = "groq"
+# Ordonnanceur TTS global (partagé par toutes les connexions)
+tts_scheduler = TTSScheduler(
+    max_concurrent=int(os.getenv("TTS_MAX_CONCURRENT", "8")),
+    max_queue=int(os.getenv("TTS_MAX_QUEUE", "64"))
+)
 
-        except Exception as e:
-            print(f"❌ Erreur GPT-4o: {str(e)}")
-            preferred_ai = "groq"
+# Morceaux audio tamponnés par synthèse quand le client lit moins vite qu'Edge TTS ne produit ;
+# tampon plein : la lecture d'Edge TTS attend le client et la place reste occupée (contre-pression)
+TTS_STREAM_BUFFER_CHUNKS = int(os.getenv("TTS_STREAM_BUFFER_CHUNKS", "256"))
 
+# ================================
+# 🔗 SINGLE-FLIGHT - FUSION DES REQUÊTES IDENTIQUES EN COURS
+# ================================
 
+class SingleFlight:
+    """Les appels concurrents de même empreinte attendent une seule tâche et partagent son résultat.
+    Les attentes sont comptées : l'appel amont n'est annulé que lorsque le dernier demandeur s'en va"""
+
+    def __init__(self, name: str):
+        self.name = name
+        # empreinte -> {"task": tâche amont, "waiters": nombre de demandeurs}
+        self._calls = {}
+        self.counters = {
+            "calls": 0,
+            "coalesced": 0,
+            "cancelled": 0
+        }
 
-    if preferred_ai == "deepinfra-qwen":
-        # Tentative: DeepInfra Qwen 2.5-72B (excellent pour development et sexology)
-        try:
-            print("🧠 Tentative avec DeepInfra Qwen 2.5-72B (intelligence premium)...")
+    @staticmethod
+    def fingerprint(*parts) -> str:
+        """Empreinte SHA-256 des paramètres d'une requête"""
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _forget(self, key: str, call: dict):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key: str, factory):
+        """Exécute `factory()` ou rejoint l'appel identique déjà en cours"""
+        call = self._calls.get(key)
+        if call is None:
+            call = {"task": asyncio.create_task(factory()), "waiters": 0}
+            self._calls[key] = call
+            call["task"].add_done_callback(lambda _, key=key, call=call: self._forget(key, call))
+            self.counters["calls"] += 1
+        else:
+            self.counters["coalesced"] += 1
+            print(f"🔗 {self.name}: requête identique déjà en cours - résultat partagé")
 
-            deepinfra_key = os.getenv("DEEPINFRA_API_KEY")
-            if deepinfra_key and deepinfra_key != "your_deepinfra_key_here":
+        call["waiters"] += 1
+        try:
+            # shield : l'annulation d'un demandeur n'atteint pas la tâche partagée
+            return await asyncio.shield(call["task"])
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not call["task"].done():
+                # Plus personne n'attend le résultat : on annule l'appel amont
+                call["task"].cancel()
+                self._forget(key, call)
+                self.counters["cancelled"] += 1
+
+    def get_stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            **self.counters
+        }
 
-                headers = {
-                    "Authorization": f"Bearer {deepinfra_key}",
-                    "Content-Type": "application/json"
-                }
+# Fusion des synthèses TTS, descriptions et images identiques
+tts_flights = SingleFlight("TTS")
+description_flights = SingleFlight("Description")
+image_flights = SingleFlight("Image")
 
-                data = {
-                    "model": "Qwen/Qwen2.5-72B-Instruct",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.7,
-                    "max_tokens": max_tokens
-                }
+# ================================
+# 🔒 SÉRIALISATION DES TOURS PAR SESSION - VERROUS RAYÉS
+# ================================
 
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        "https://api.deepinfra.com/v1/openai/chat/completions",
-                        headers=headers,
-                        json=data,
-                        timeout=aiohttp.ClientTimeout(total=30)
-                    ) as response:
-                        if response.status == 200:
-                            result = await response.json()
-                            if result.get("choices") and result["choices"][0].get("message"):
-                                content = result["choices"][0]["message"]["content"]
-                                print("✅ Succès avec DeepInfra Qwen 2.5-72B")
-                                return content.strip(), "deepinfra-qwen"
-                        else:
-                            print(f"❌ Erreur DeepInfra: {response.status}")
+class SessionBusy(Exception):
+    """Trop de tours en attente pour une même session : le message est refusé"""
+
+class StripedSessionLocks:
+    """Un tour à la fois par session (historique lu puis complété autour de l'appel IA).
+    Les sessions se partagent un nombre fixe de verrous (hachage de l'identifiant) : la table reste
+    bornée et les sessions différentes avancent en parallèle. Au-delà de `max_queued` tours en attente
+    pour une session, les nouveaux messages sont refusés au lieu d'empiler des appels IA"""
+
+    def __init__(self, name: str, stripes: int, max_queued: int):
+        self.name = name
+        self.max_queued = max_queued
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+        # session -> tours en cours ou en attente (entrée supprimée à zéro)
+        self._depth = {}
+        self.counters = {
+            "turns": 0,
+            "contended": 0,
+            "rejected": 0
+        }
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def pending(self, key: str) -> int:
+        """Tours en cours ou en attente pour une session"""
+        return self._depth.get(key, 0)
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        """Réserve le tour de la session ; fournit le temps d'attente (secondes)"""
+        depth = self._depth.get(key, 0)
+        if depth > self.max_queued:
+            self.counters["rejected"] += 1
+            print(f"🔒 {self.name} {key}: {depth - 1} tours déjà en attente - message refusé")
+            raise SessionBusy(f"Trop de messages en attente pour cette session ({depth - 1} en attente)")
+
+        self._depth[key] = depth + 1
+        lock = self._locks[hash(key) % len(self._locks)]
+        started = time.monotonic()
+        try:
+            async with lock:
+                wait = time.monotonic() - started
+                self.counters["turns"] += 1
+                if depth or wait > 0.001:
+                    self.counters["contended"] += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                yield wait
+        finally:
+            remaining = self._depth[key] - 1
+            if remaining:
+                self._depth[key] = remaining
             else:
-                print("⚠️ Clé DeepInfra manquante, fallback vers Gemini/Groq")
-                preferred_ai = "gemini" if "development" in prompt.lower() else "groq"
+                del self._depth[key]
 
-        except Exception as e:
-            print(f"❌ Erreur DeepInfra Qwen: {str(e)}")
-            preferred_ai = "gemini" if "development" in prompt.lower() else "groq"
+    def get_stats(self) -> dict:
+        return {
+            "stripes": len(self._locks),
+            "max_queued": self.max_queued,
+            "active_sessions": len(self._depth),
+            "locked_stripes": sum(lock.locked() for lock in self._locks),
+            **self.counters,
+            "avg_wait_ms": round(self.wait_total / self.counters["turns"] * 1000, 1) if self.counters["turns"] else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 1)
+        }
 
-    if preferred_ai == "gemini":
-        # Tentative: Gemini (excellent pour psychologie/développement)
-        try:
-            print("🧠 Tentative avec Gemini (empathique et motivant)...")
+# Tours IA Coach (par session_id) et messages du jeu de rôle (par simulation_id)
+SESSION_LOCK_STRIPES = int(os.getenv("SESSION_LOCK_STRIPES", "1024"))
+SESSION_MAX_QUEUED_TURNS = int(os.getenv("SESSION_MAX_QUEUED_TURNS", "2"))
+conversation_locks = StripedSessionLocks("Conversation", SESSION_LOCK_STRIPES, SESSION_MAX_QUEUED_TURNS)
+simulation_locks = StripedSessionLocks("Simulation", SESSION_LOCK_STRIPES, SESSION_MAX_QUEUED_TURNS)
+
+# ================================
+# 🎵 GÉNÉRATION AUDIO EDGE TTS
+# ================================
 
-            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-            model = genai.GenerativeModel('gemini-1.5-flash')
+def prepare_tts_request(text: str, voice: str = None, is_clean: bool = False) -> tuple[str, str]:
+    """Nettoie le texte et valide la voix avant synthèse (is_clean : texte déjà passé par SpeechTextNormalizer)"""
+    # Nettoyer le texte pour la synthèse vocale (supprimer Markdown)
+    clean_text = text if is_clean else clean_text_for_speech(text)
+    print(f"🧹 Texte nettoyé: {clean_text[:100]}..." if len(clean_text) > 100 else f"🧹 Texte nettoyé: {clean_text}")
+
+    # Utilise la voix spécifiée ou la voix par défaut
+    selected_voice = voice if voice else DEFAULT_VOICE
+
+    # Validation de la voix (catalogue Edge TTS)
+    if not voice_registry.is_available(selected_voice):
+        print(f"⚠️ Voix {selected_voice} non supportée dans generate_audio → {DEFAULT_VOICE}")
+        selected_voice = DEFAULT_VOICE
+
+    return clean_text, selected_voice
+
+async def synthesize_audio_stream(clean_text: str, selected_voice: str, priority: int = TTS_PRIORITY_INTERACTIVE):
+    """Synthèse Edge TTS d'un texte déjà préparé (cache TTS puis ordonnanceur)"""
+    # Cache TTS : les phrases déjà prononcées ne repassent pas par Edge TTS
+    cache_key = None
+    if tts_cache:
+        cache_key = TTSAudioCache.make_key(selected_voice, clean_text)
+        cached_audio = await tts_cache.get(cache_key)
+        if cached_audio:
+            print(f"⚡ Audio servi depuis le cache TTS: {len(cached_audio)} bytes")
+            yield cached_audio
+            return
 
-            response = model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=max_tokens,
-                    temperature=0.7,
-                )
-            )
+    # Le flux Edge TTS est lu par une tâche qui remplit un tampon borné : la place de l'ordonnanceur
+    # est rendue dès la fin de la synthèse, sans attendre que le client ait tout lu
+    audio_queue = asyncio.Queue(maxsize=TTS_STREAM_BUFFER_CHUNKS)
 
-            if response.text:
-                print("✅ Succès avec Gemini")
-                return response.text.strip(), "gemini"
+    async def read_edge_stream():
+        try:
+            async with tts_scheduler.slot(priority):
+                print(f"🎵 Edge TTS avec voix: {selected_voice}")
+                communicate = edge_tts.Communicate(clean_text, selected_voice)
 
+                async for chunk in communicate.stream():
+                    if chunk["type"] == "audio" and chunk["data"]:
+                        await audio_queue.put(chunk["data"])
         except Exception as e:
-            print(f"❌ Erreur Gemini: {str(e)}")
+            # Transmise au client (TTSQueueFull, erreur Edge TTS)
+            await audio_queue.put(e)
+        else:
+            await audio_queue.put(None)
+
+    reader = asyncio.create_task(read_edge_stream())
+    audio_chunks = []
+    try:
+        while True:
+            item = await audio_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            audio_chunks.append(item)
+            yield item
+    finally:
+        # Client parti avant la fin : synthèse abandonnée, place rendue
+        reader.cancel()
+
+    # Mise en cache uniquement si la synthèse est allée jusqu'au bout
+    if tts_cache and audio_chunks:
+        await tts_cache.put(cache_key, b"".join(audio_chunks))
+
+async def generate_audio_stream(text: str, voice: str = None, priority: int = TTS_PRIORITY_INTERACTIVE, is_clean: bool = False):
+    """Génère l'audio TTS en streaming : chaque morceau Edge TTS est transmis dès sa réception
+    (lève TTSQueueFull si l'ordonnanceur TTS est saturé)"""
+    clean_text, selected_voice = prepare_tts_request(text, voice, is_clean)
+
+    async with aclosing(synthesize_audio_stream(clean_text, selected_voice, priority)) as chunks:
+        async for chunk in chunks:
+            yield chunk
+
+async def synthesize_audio(clean_text: str, selected_voice: str, priority: int) -> bytes:
+    """Synthèse complète (tâche partagée par les demandes identiques)"""
+    return b"".join([chunk async for chunk in synthesize_audio_stream(clean_text, selected_voice, priority)])
+
+async def generate_audio(text: str, voice: str = None, priority: int = TTS_PRIORITY_INTERACTIVE, is_clean: bool = False) -> bytes:
+    """Génère l'audio TTS avec Edge TTS (avec cache par voix + texte nettoyé)
+    Les synthèses identiques en cours sont fusionnées (la priorité du premier demandeur s'applique) ;
+    TTSQueueFull est propagée pour que l'appelant réponde en texte seul"""
+    clean_text, selected_voice = prepare_tts_request(text, voice, is_clean)
 
-    # Tentative 2 ou par défaut: Groq (ultra-rapide)
     try:
-        print("🚀 Tentative avec Groq (ultra-rapide)...")
-
-        response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=max_tokens,
-            top_p=0.8
+        audio_data = await tts_flights.do(
+            TTSAudioCache.make_key(selected_voice, clean_text),
+            lambda: synthesize_audio(clean_text, selected_voice, priority)
         )
 
-        if response.choices[0].message.content:
-            print("✅ Succès avec Groq")
-            return response.choices[0].message.content.strip(), "groq"
+        if not audio_data:
+            print("⚠️ Aucune donnée audio générée")
+            return b""
+
+        print(f"✅ Audio généré: {len(audio_data)} bytes")
+        return audio_data
+
+    except TTSQueueFull:
+        raise
+    except Exception as e:
+        print(f"❌ Erreur TTS: {e}")
+        print(f"❌ Type d'erreur: {type(e).__name__}")
+        return b""
+
+# ================================
+# 📦 PACK AUDIO PRÉ-GÉNÉRÉ DES QUESTIONS D'INSCRIPTION
+# ================================
+
+# Format : MAGIC (8 octets) | taille de l'index (uint64 LE) | index JSON | données MP3 concaténées
+AUDIO_PACK_MAGIC = b"MVPACK01"
+AUDIO_PACK_HEADER = struct.Struct("<8sQ")
+AUDIO_PACK_PATH = os.getenv("INSCRIPTION_AUDIO_PACK", "inscription_audio.pack")
+
+def audio_pack_text_key(voice: str, text: str) -> str:
+    """Empreinte du texte prononcé (identique à la clé du cache TTS)"""
+    return TTSAudioCache.make_key(voice, clean_text_for_speech(text))
+
+def write_audio_pack(path: str, rendered: list) -> dict:
+    """Écrit un pack audio à partir de tuples (voix, numéro, texte, audio)"""
+    entries = {}
+    offset = 0
+    for voice, numero, text, audio_data in rendered:
+        entries[f"{voice}|{numero}"] = {
+            "offset": offset,
+            "length": len(audio_data),
+            "etag": hashlib.sha256(audio_data).hexdigest(),
+            "text_key": audio_pack_text_key(voice, text)
+        }
+        offset += len(audio_data)
+
+    index = json.dumps({
+        "version": 1,
+        "created_at": datetime.now().isoformat(),
+        "entries": entries
+    }, separators=(",", ":")).encode("utf-8")
+
+    # Écriture atomique : les workers qui ont déjà mappé l'ancien pack ne sont pas impactés
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(AUDIO_PACK_HEADER.pack(AUDIO_PACK_MAGIC, len(index)))
+        f.write(index)
+        for _, _, _, audio_data in rendered:
+            f.write(audio_data)
+    os.replace(tmp_path, path)
+
+    return {"entries": len(entries), "audio_bytes": offset, "path": path}
+
+async def build_inscription_audio_pack(path: str = AUDIO_PACK_PATH, voices: list = None, concurrency: int = 4) -> dict:
+    """Pré-génère toutes les questions d'inscription pour toutes les voix dans un seul fichier indexé"""
+    voices = voices or FRENCH_VOICES
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def render(voice: str, numero: int, text: str):
+        async with semaphore:
+            audio_data = await generate_audio(text, voice, TTS_PRIORITY_BATCH)
+        if not audio_data:
+            raise RuntimeError(f"Audio vide pour la question {numero} ({voice})")
+        print(f"🎵 Q{numero} - {voice}: {len(audio_data)} bytes")
+        return voice, numero, text, audio_data
+
+    rendered = await asyncio.gather(*[
+        render(voice, numero, text)
+        for voice in voices
+        for numero, text in enumerate(QUESTIONS, start=1)
+    ])
+
+    return write_audio_pack(path, rendered)
 
+class InscriptionAudioPack:
+    """Pack audio mappé en mémoire, servi sans repasser par le service TTS"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+
+        magic, index_length = AUDIO_PACK_HEADER.unpack_from(self._mmap, 0)
+        if magic != AUDIO_PACK_MAGIC:
+            self.close()
+            raise ValueError(f"Pack audio invalide: {path}")
+
+        data_start = AUDIO_PACK_HEADER.size + index_length
+        index = json.loads(self._mmap[AUDIO_PACK_HEADER.size:data_start].decode("utf-8"))
+        self.created_at = index.get("created_at")
+
+        # (voix, numéro) -> (début, fin, etag) ; les entrées dont le texte a changé sont ignorées
+        self.entries = {}
+        self.stale_entries = 0
+        for entry_key, entry in index["entries"].items():
+            voice, numero = entry_key.rsplit("|", 1)
+            numero = int(numero)
+            if not (1 <= numero <= len(QUESTIONS)) or entry["text_key"] != audio_pack_text_key(voice, QUESTIONS[numero - 1]):
+                self.stale_entries += 1
+                continue
+            start = data_start + entry["offset"]
+            self.entries[(voice, numero)] = (start, start + entry["length"], f'"{entry["etag"]}"')
+
+    def get(self, voice: str, numero: int) -> Optional[tuple]:
+        """Retourne (début, fin, etag) de l'audio dans le pack, ou None"""
+        return self.entries.get((voice, numero))
+
+    def read(self, start: int, end: int) -> bytes:
+        return self._mmap[start:end]
+
+    def close(self):
+        if getattr(self, "_mmap", None) is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+inscription_audio_pack = None
+
+def load_inscription_audio_pack(path: str = AUDIO_PACK_PATH):
+    """Mappe le pack audio au démarrage (absent = génération TTS à la demande)"""
+    global inscription_audio_pack
+
+    if not os.path.exists(path):
+        print(f"⚠️ Pack audio d'inscription absent ({path}) - génération TTS à la demande")
+        return None
+
+    try:
+        inscription_audio_pack = InscriptionAudioPack(path)
+        print(f"📦 Pack audio d'inscription chargé: {len(inscription_audio_pack.entries)} entrées"
+              + (f" ({inscription_audio_pack.stale_entries} obsolètes ignorées)" if inscription_audio_pack.stale_entries else ""))
     except Exception as e:
-        print(f"❌ Erreur Groq: {str(e)}")
+        print(f"❌ Erreur chargement pack audio: {e}")
+        inscription_audio_pack = None
+
+    return inscription_audio_pack
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Comparaison faible des ETags pour If-None-Match"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def parse_byte_range(range_header: str, size: int) -> Optional[tuple]:
+    """Parse un en-tête Range (une seule plage) → (début, fin exclusive) ; None si ignoré"""
+    if not range_header.startswith("bytes=") or "," in range_header:
+        return None
+
+    start_text, _, end_text = range_header[6:].strip().partition("-")
+    try:
+        if not start_text:
+            # Suffixe : les N derniers octets
+            suffix_length = int(end_text)
+            if suffix_length <= 0:
+                raise HTTPException(status_code=416, detail="Plage invalide", headers={"Content-Range": f"bytes */{size}"})
+            return max(0, size - suffix_length), size
+
+        start = int(start_text)
+        end = int(end_text) + 1 if end_text else size
+    except ValueError:
+        return None
+
+    # Dernier octet avant le premier : plage invalide, ignorée (RFC 9110 §14.2) → réponse 200 complète
+    if end_text and end <= start:
+        return None
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Plage non satisfaisable", headers={"Content-Range": f"bytes */{size}"})
+
+    return start, min(end, size)
+
+# ================================
+# 🌐 CLIENTS HTTP MUTUALISÉS (KEEP-ALIVE PAR HÔTE)
+# ================================
 
-    # Fallback final: DeepInfra
+OPENAI_API_URL = "https://api.openai.com"
+DEEPINFRA_API_URL = "https://api.deepinfra.com"
+
+class HTTPClientPool:
+    """Sessions aiohttp longue durée, une par hôte : connexions TCP/TLS réutilisées (keep-alive)
+    et résolutions DNS mises en cache entre les requêtes"""
+
+    def __init__(self, limit_per_host: int, keepalive_timeout: float, dns_cache_ttl: int):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._sessions = {}
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session(self, url: str) -> aiohttp.ClientSession:
+        """Session de l'hôte de l'URL (créée à la première utilisation)"""
+        origin = self._origin(url)
+        session = self._sessions.get(origin)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit_per_host,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[origin] = session
+        return session
+
+    async def warm_up(self, urls: list, connections: int):
+        """Ouvre des connexions à l'avance (DNS + TCP + TLS) pour que le premier tour n'attende pas"""
+        async def open_connection(url: str):
+            try:
+                async with self.session(url).head(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                    await response.release()
+            except Exception as e:
+                print(f"⚠️ Préchauffage HTTP impossible pour {url}: {e}")
+
+        await asyncio.gather(*[open_connection(url) for url in urls for _ in range(connections)])
+        if urls:
+            print(f"🌐 Connexions HTTP préchauffées: {', '.join(self._origin(url) for url in urls)}")
+
+    async def close(self):
+        """Ferme toutes les sessions (arrêt de l'application)"""
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+# Pool HTTP global (partagé par tous les appels fournisseurs IA et backend)
+http_clients = HTTPClientPool(
+    limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20")),
+    keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60")),
+    dns_cache_ttl=int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300"))
+)
+
+def get_http_warmup_urls() -> list:
+    """Hôtes à préchauffer au démarrage : seulement ceux réellement configurés"""
+    urls = []
+    if os.getenv("OPENAI_API_KEY", "your_openai_key_here") != "your_openai_key_here":
+        urls.append(OPENAI_API_URL)
+    if os.getenv("DEEPINFRA_API_KEY", "your_deepinfra_key_here") != "your_deepinfra_key_here":
+        urls.append(DEEPINFRA_API_URL)
+    if os.getenv("API_BACKEND_URL"):
+        urls.append(os.getenv("API_BACKEND_URL"))
+    return urls
+
+# ================================
+# 🚦 REGISTRE DES FOURNISSEURS IA - ADAPTATEURS ET LIMITES DE DÉBIT
+# ================================
+
+class ProviderHTTPError(Exception):
+    """Réponse HTTP en erreur d'une IA (statut et Retry-After conservés pour le suivi de santé et le recul)"""
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+class ProviderRateLimited(Exception):
+    """Appel non envoyé : quota local épuisé ou pause après 429 trop longue (repli immédiat)"""
+
+RATE_LIMIT_RESET_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+RATE_LIMIT_RESET_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Délai d'un en-tête Retry-After (secondes ou date HTTP)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        print("🔄 Fallback vers DeepInfra...")
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Durée des en-têtes x-ratelimit-reset-* ("2m59.56s", "7.66s", "120ms" ou secondes)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = RATE_LIMIT_RESET_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * RATE_LIMIT_RESET_UNITS[unit] for amount, unit in parts)
+
+def estimate_request_tokens(ai_name: str, prompt: str, max_tokens: int) -> int:
+    """Tokens comptés par le fournisseur pour ses quotas : prompt (estimation calibrée) + réponse maximale"""
+    return token_estimator.estimate(ai_name, prompt) + max_tokens
+
+class TokenBucket:
+    """Seau à jetons : `capacity` jetons rechargés en continu sur `period` secondes (0 = illimité).
+    Une réservation peut rendre le solde négatif : l'attente correspond alors au déficit"""
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period if capacity else 0.0
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Secondes à attendre avant de pouvoir consommer `amount` jetons"""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        deficit = min(amount, self.capacity) - self._tokens
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def consume(self, amount: float):
+        if self.capacity:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        """Rend des jetons réservés mais non consommés (sans dépasser la capacité)"""
+        if self.capacity and amount > 0:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + min(amount, self.capacity))
+
+    def get_stats(self) -> Optional[dict]:
+        if not self.capacity:
+            return None
+        self._refill()
+        return {"capacity": self.capacity, "available": round(self._tokens, 1)}
+
+class ProviderAdapter:
+    """Interface commune d'une IA (complete / stream) avec sa propre concurrence,
+    ses seaux à jetons (requêtes/minute, tokens/minute, requêtes/jour) et sa pause après 429"""
+
+    def __init__(self, name: str, label: str, max_concurrent: int,
+                 requests_per_minute: int, tokens_per_minute: int, requests_per_day: int):
+        self.name = name
+        self.label = label
+        self.max_concurrent = max_concurrent
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.requests_minute = TokenBucket(requests_per_minute, 60)
+        self.tokens_minute = TokenBucket(tokens_per_minute, 60)
+        self.requests_day = TokenBucket(requests_per_day, 86400)
+
+        self.blocked_until = 0.0
+        self.consecutive_rate_limits = 0
+        self.in_flight = 0
+        self.last_headers = {}
+        self.counters = {
+            "calls": 0,
+            "delayed": 0,
+            "rejected": 0,
+            "rate_limited": 0
+        }
+
+    def is_configured(self) -> bool:
+        return True
+
+    async def complete(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None,
+                       generation: Optional[dict] = None) -> str:
+        """Réponse complète ; `usage` reçoit prompt_tokens / completion_tokens si l'IA les renvoie,
+        `stop` : séquences qui terminent la génération, `generation` : réglages propres à l'appel
+        (model, top_p, top_k), appliqués s'ils existent pour cette IA"""
+        raise NotImplementedError
+
+    def stream(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None):
+        """Générateur asynchrone de fragments de texte (usage rempli en fin de flux si disponible)"""
+        raise NotImplementedError
+
+    @asynccontextmanager
+    async def reserve(self, tokens: int):
+        """Réserve un appel : courte attente si le quota se libère bientôt, sinon ProviderRateLimited
+        (le repli vers l'IA suivante se fait avant que le fournisseur ne rejette la requête)"""
+        wait = max(
+            self.blocked_until - time.monotonic(),
+            self.requests_minute.wait_time(1),
+            self.requests_day.wait_time(1),
+            self.tokens_minute.wait_time(tokens)
+        )
+        if wait > AI_RATE_LIMIT_MAX_WAIT:
+            self.counters["rejected"] += 1
+            raise ProviderRateLimited(f"{self.name}: limite de débit, disponible dans {wait:.1f}s")
 
+        self.requests_minute.consume(1)
+        self.requests_day.consume(1)
+        self.tokens_minute.consume(tokens)
+        try:
+            if wait > 0:
+                self.counters["delayed"] += 1
+                print(f"🚦 {self.name}: attente de {wait:.2f}s (limite de débit)")
+                await asyncio.sleep(wait)
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=AI_RATE_LIMIT_MAX_WAIT)
+        except asyncio.TimeoutError:
+            # Appel jamais envoyé : la réservation entière revient au quota
+            self.refund(tokens, request_count=1)
+            self.counters["rejected"] += 1
+            raise ProviderRateLimited(f"{self.name}: {self.max_concurrent} appels déjà en cours")
+        except asyncio.CancelledError:
+            self.refund(tokens, request_count=1)
+            raise
+
+        self.in_flight += 1
+        self.counters["calls"] += 1
+        try:
+            yield
+        except Exception as e:
+            status = get_error_status(e)
+            retry_after = getattr(e, "retry_after", None)
+            if status == 429 or (status == 503 and retry_after is not None):
+                # Requête rejetée par le fournisseur : rien n'a été consommé
+                self.refund(tokens, request_count=1)
+                self.note_rate_limited(retry_after)
+            raise
+        else:
+            self.consecutive_rate_limits = 0
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def refund(self, tokens: float, request_count: int = 0):
+        """Rend au quota la part inutilisée d'une réservation (réponse plus courte que max_tokens,
+        appel jamais envoyé ou rejeté)"""
+        self.tokens_minute.refund(tokens)
+        if request_count:
+            self.requests_minute.refund(request_count)
+            self.requests_day.refund(request_count)
+
+    def note_rate_limited(self, retry_after: Optional[float]):
+        """Pause après un rejet : Retry-After s'il est fourni, sinon recul exponentiel avec gigue"""
+        self.consecutive_rate_limits += 1
+        self.counters["rate_limited"] += 1
+        if retry_after is None:
+            backoff = min(AI_BACKOFF_MAX_SECONDS, AI_BACKOFF_BASE_SECONDS * 2 ** (self.consecutive_rate_limits - 1))
+            retry_after = random.uniform(backoff / 2, backoff)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        print(f"🚦 {self.name}: limite de débit atteinte - pause de {retry_after:.1f}s")
+
+    def update_from_headers(self, headers):
+        """En-têtes x-ratelimit-* : quota épuisé → pause jusqu'à sa réinitialisation"""
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            self.last_headers[f"remaining_{kind}"] = remaining
+            try:
+                exhausted = float(remaining) <= 0
+            except ValueError:
+                continue
+            reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if exhausted and reset:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+                print(f"🚦 {self.name}: quota de {kind} épuisé - pause de {reset:.1f}s")
+
+    def get_stats(self) -> dict:
+        return {
+            "label": self.label,
+            "configured": self.is_configured(),
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "paused_for_seconds": round(max(0.0, self.blocked_until - time.monotonic()), 1),
+            "requests_per_minute": self.requests_minute.get_stats(),
+            "tokens_per_minute": self.tokens_minute.get_stats(),
+            "requests_per_day": self.requests_day.get_stats(),
+            "last_headers": self.last_headers,
+            **self.counters
+        }
+
+class OpenAICompatibleAdapter(ProviderAdapter):
+    """IA appelée via l'API chat/completions compatible OpenAI (GPT-4o, DeepInfra)"""
+
+    def __init__(self, name: str, label: str, url: str, api_key_env: str, model: str, **limits):
+        super().__init__(name, label, **limits)
+        self.url = url
+        self.api_key_env = api_key_env
+        self.model = model
+
+    @property
+    def api_key(self) -> Optional[str]:
+        return os.getenv(self.api_key_env)
+
+    def is_configured(self) -> bool:
+        return bool(self.api_key) and not self.api_key.startswith("your_")
+
+    def _request(self, prompt: str, max_tokens: int, stream: bool, stop: Optional[list], generation: Optional[dict] = None):
         headers = {
-            "Authorization": f"Bearer {os.getenv('DEEPINFRA_API_KEY')}",
+            "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
 
         data = {
-            "model": os.getenv("DEEPINFRA_MODEL", "Qwen/Qwen2.5-72B-Instruct"),
+            "model": self.model,
             "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": max_tokens,
-            "temperature": 0.7
+            "temperature": 0.7,
+            "max_tokens": max_tokens
         }
+        data.update({key: value for key, value in (generation or {}).items() if key in ("model", "top_p")})
+        if stop:
+            data["stop"] = stop[:4]  # 4 séquences maximum (API OpenAI)
+        if stream:
+            data["stream"] = True
+            data["stream_options"] = {"include_usage": True}
+
+        return http_clients.session(self.url).post(
+            self.url,
+            headers=headers,
+            json=data,
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+
+    def _check_response(self, response):
+        self.update_from_headers(response.headers)
+        if response.status != 200:
+            raise ProviderHTTPError(response.status, parse_retry_after(response.headers.get("Retry-After")))
+
+    async def complete(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None,
+                       generation: Optional[dict] = None) -> str:
+        async with self._request(prompt, max_tokens, stream=False, stop=stop, generation=generation) as response:
+            self._check_response(response)
+            result = await response.json()
+
+        usage.update(read_openai_usage(result.get("usage")))
+        return result["choices"][0]["message"]["content"]
+
+    async def stream(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None):
+        """Streaming SSE (chat/completions avec stream=true, usage dans le dernier événement)"""
+        parser = SSEDeltaParser()
+        try:
+            async with self._request(prompt, max_tokens, stream=True, stop=stop) as response:
+                self._check_response(response)
+
+                async for chunk in response.content.iter_any():
+                    for delta in parser.feed(chunk):
+                        yield delta
+                    if parser.done:
+                        return
+
+                for delta in parser.flush():
+                    yield delta
+        finally:
+            usage.update(read_openai_usage(parser.usage))
+
+class GroqAdapter(ProviderAdapter):
+    """Groq (client asynchrone ; réponse brute pour lire les en-têtes de quota)"""
+
+    def __init__(self, name: str, label: str, model: str, **limits):
+        super().__init__(name, label, **limits)
+        self.model = model
+
+    async def _create(self, prompt: str, max_tokens: int, stream: bool, stop: Optional[list], generation: Optional[dict] = None):
+        generation = generation or {}
+        try:
+            raw = await groq_client.chat.completions.with_raw_response.create(
+                model=generation.get("model", self.model),
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.7,
+                max_tokens=max_tokens,
+                top_p=generation.get("top_p", 0.8),
+                stop=stop[:4] if stop else None,
+                stream=stream
+            )
+        except groq.APIStatusError as e:
+            self.update_from_headers(e.response.headers)
+            raise ProviderHTTPError(e.status_code, parse_retry_after(e.response.headers.get("retry-after"))) from e
+
+        self.update_from_headers(raw.headers)
+        return await raw.parse()
+
+    async def complete(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None,
+                       generation: Optional[dict] = None) -> str:
+        response = await self._create(prompt, max_tokens, stream=False, stop=stop, generation=generation)
+        usage.update(read_openai_usage(getattr(response, "usage", None)))
+        return response.choices[0].message.content
+
+    async def stream(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None):
+        stream = await self._create(prompt, max_tokens, stream=True, stop=stop)
+        async for chunk in stream:
+            # Usage dans le dernier morceau (x_groq.usage)
+            chunk_usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if chunk_usage:
+                usage.update(read_openai_usage(chunk_usage))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+class GeminiAdapter(ProviderAdapter):
+    """Gemini (generate_content_async ; pas d'en-têtes de quota, 429 = ResourceExhausted)"""
+
+    def __init__(self, name: str, label: str, model: str, **limits):
+        super().__init__(name, label, **limits)
+        self.model = model
+
+    def _generate(self, prompt: str, max_tokens: int, stream: bool, stop: Optional[list], generation: Optional[dict] = None):
+        generation = generation or {}
+        return get_gemini_model(generation.get("model", self.model)).generate_content_async(
+            prompt,
+            generation_config=genai.types.GenerationConfig(
+                max_output_tokens=max_tokens,
+                temperature=0.7,
+                top_p=generation.get("top_p"),
+                top_k=generation.get("top_k"),
+                stop_sequences=stop[:5] if stop else None
+            ),
+            stream=stream
+        )
+
+    async def complete(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None,
+                       generation: Optional[dict] = None) -> str:
+        response = await self._generate(prompt, max_tokens, stream=False, stop=stop, generation=generation)
+        usage.update(read_gemini_usage(response))
+        return response.text
+
+    async def stream(self, prompt: str, max_tokens: int, usage: dict, stop: Optional[list] = None):
+        response = await self._generate(prompt, max_tokens, stream=True, stop=stop)
+        async for chunk in response:
+            usage.update(read_gemini_usage(chunk))
+            if chunk.text:
+                yield chunk.text
+
+def read_openai_usage(usage) -> dict:
+    """Champs usage (prompt_tokens / completion_tokens) d'une réponse OpenAI, DeepInfra ou Groq"""
+    if not usage:
+        return {}
+    if not isinstance(usage, dict):
+        usage = {"prompt_tokens": getattr(usage, "prompt_tokens", None), "completion_tokens": getattr(usage, "completion_tokens", None)}
+    return {key: usage[key] for key in ("prompt_tokens", "completion_tokens") if usage.get(key) is not None}
+
+def read_gemini_usage(response) -> dict:
+    """usage_metadata d'une réponse Gemini (absent des anciennes versions du SDK)"""
+    metadata = getattr(response, "usage_metadata", None)
+    if not metadata or not getattr(metadata, "prompt_token_count", None):
+        return {}
+    return {
+        "prompt_tokens": metadata.prompt_token_count,
+        "completion_tokens": getattr(metadata, "candidates_token_count", 0) or 0
+    }
+
+class ProviderRegistry:
+    """IA disponibles par nom (chaîne de repli, hedging et streaming passent par ici)"""
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post("https://api.deepinfra.com/v1/openai/chat/completions",
-                                   headers=headers, json=data, timeout=30) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    content = result["choices"][0]["message"]["content"]
-                    print("✅ Succès avec DeepInfra")
-                    return content.strip(), "deepinfra"
+    def __init__(self):
+        self._adapters = {}
 
+    def register(self, adapter: ProviderAdapter) -> ProviderAdapter:
+        self._adapters[adapter.name] = adapter
+        return adapter
+
+    def get(self, ai_name: str) -> ProviderAdapter:
+        return self._adapters[ai_name]
+
+    def get_stats(self) -> dict:
+        return {ai_name: adapter.get_stats() for ai_name, adapter in self._adapters.items()}
+
+def get_provider_limits(ai_name: str, max_concurrent: int, rpm: int, tpm: int, rpd: int) -> dict:
+    """Limites d'une IA, surchargeables par AI_<NOM>_MAX_CONCURRENT / _RPM / _TPM / _RPD (0 = illimité)"""
+    prefix = f"AI_{ai_name.upper().replace('-', '_')}"
+    return {
+        "max_concurrent": int(os.getenv(f"{prefix}_MAX_CONCURRENT", str(max_concurrent))),
+        "requests_per_minute": int(os.getenv(f"{prefix}_RPM", str(rpm))),
+        "tokens_per_minute": int(os.getenv(f"{prefix}_TPM", str(tpm))),
+        "requests_per_day": int(os.getenv(f"{prefix}_RPD", str(rpd)))
+    }
+
+# Attente maximale avant de basculer sur l'IA suivante, et recul après 429 sans Retry-After
+AI_RATE_LIMIT_MAX_WAIT = float(os.getenv("AI_RATE_LIMIT_MAX_WAIT", "1.5"))
+AI_BACKOFF_BASE_SECONDS = float(os.getenv("AI_BACKOFF_BASE_SECONDS", "2"))
+AI_BACKOFF_MAX_SECONDS = float(os.getenv("AI_BACKOFF_MAX_SECONDS", "60"))
+
+ai_providers = ProviderRegistry()
+ai_providers.register(OpenAICompatibleAdapter(
+    "gpt-4o", "🤖 GPT-4o",
+    url=f"{OPENAI_API_URL}/v1/chat/completions", api_key_env="OPENAI_API_KEY", model="gpt-4o",
+    **get_provider_limits("gpt-4o", max_concurrent=20, rpm=500, tpm=30000, rpd=0)
+))
+ai_providers.register(OpenAICompatibleAdapter(
+    "deepinfra-qwen", "🧠 DeepInfra Qwen 2.5-72B",
+    url=f"{DEEPINFRA_API_URL}/v1/openai/chat/completions", api_key_env="DEEPINFRA_API_KEY", model="Qwen/Qwen2.5-72B-Instruct",
+    **get_provider_limits("deepinfra-qwen", max_concurrent=50, rpm=0, tpm=0, rpd=0)
+))
+ai_providers.register(GeminiAdapter(
+    "gemini", "🧠 Gemini", model="gemini-1.5-flash",
+    **get_provider_limits("gemini", max_concurrent=10, rpm=15, tpm=1000000, rpd=1500)
+))
+ai_providers.register(GroqAdapter(
+    "groq", "🚀 Groq", model="llama-3.1-8b-instant",
+    **get_provider_limits("groq", max_concurrent=10, rpm=30, tpm=6000, rpd=14400)
+))
+# Fallback final: DeepInfra
+ai_providers.register(OpenAICompatibleAdapter(
+    "deepinfra", "🔄 DeepInfra",
+    url=f"{DEEPINFRA_API_URL}/v1/openai/chat/completions", api_key_env="DEEPINFRA_API_KEY",
+    model=os.getenv("DEEPINFRA_MODEL", "Qwen/Qwen2.5-72B-Instruct"),
+    **get_provider_limits("deepinfra", max_concurrent=50, rpm=0, tpm=0, rpd=0)
+))
+
+# ================================
+# 🤖 APPELS FOURNISSEURS IA - REPLI ET HEDGING
+# ================================
+
+def get_ai_fallback_chain(preferred_ai: str, prompt: str) -> list:
+    """Ordre des IA essayées, avec la même logique de repli que generate_with_best_ai"""
+    chain = []
+
+    if preferred_ai in ("gpt-4o", "deepinfra-qwen") and ai_providers.get(preferred_ai).is_configured():
+        chain.append(preferred_ai)
+
+    # Claude n'est pas encore implémenté : repli vers Gemini
+    if preferred_ai in ("claude-3.5-sonnet", "gemini") or (preferred_ai == "deepinfra-qwen" and "development" in prompt.lower()):
+        chain.append("gemini")
+
+    return chain + ["groq", "deepinfra"]
+
+class ProviderCircuitOpen(Exception):
+    """IA écartée : son circuit est ouvert (ou une sonde est déjà en cours)"""
+
+def get_error_status(error: Exception) -> Optional[int]:
+    """Statut HTTP d'une erreur fournisseur (aiohttp, Groq, Google), None si inconnu"""
+    for attribute in ("status", "status_code", "code"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return int(value)
+    return None
+
+async def call_ai(ai_name: str, prompt: str, max_tokens: int, usage: Optional[dict] = None,
+                  stop: Optional[list] = None, generation: Optional[dict] = None) -> str:
+    """Appelle une IA via son adaptateur (limites de débit) et mesure sa latence (réponse vide = échec) ;
+    chaque résultat alimente le suivi de santé et le disjoncteur de l'IA.
+    `usage` reçoit les tokens consommés (réels ou estimés) et le max_tokens demandé,
+    `generation` les réglages propres à l'appel (voir ProviderAdapter.complete)"""
+    adapter = ai_providers.get(ai_name)
+    provider_health.before_call(ai_name)
+    call_usage = {"max_tokens": max_tokens}
+
+    try:
+        async with adapter.reserve(estimate_request_tokens(ai_name, prompt, max_tokens)):
+            started = time.monotonic()
+            content = await adapter.complete(prompt, max_tokens, call_usage, stop, generation)
+
+        if not content or not content.strip():
+            raise RuntimeError("Réponse vide")
+
+    except (asyncio.CancelledError, ProviderRateLimited):
+        # Appel perdant d'un hedging ou jamais envoyé (limite de débit) : ni succès ni échec
+        provider_health.release(ai_name)
+        raise
     except Exception as e:
-        print(f"❌ Erreur DeepInfra: {str(e)}")
+        provider_health.record_failure(ai_name, e)
+        raise
+
+    provider_latency.record(ai_name, time.monotonic() - started)
+    provider_health.record_success(ai_name)
+    complete_usage(ai_name, call_usage, prompt, content)
+    # La réservation comptait max_tokens de réponse : l'écart revient au seau tokens/minute
+    adapter.refund(max_tokens - call_usage["completion_tokens"])
+    if usage is not None:
+        usage.update(call_usage)
+    return content.strip()
+
+class ProviderLatencyTracker:
+    """Latences récentes des appels réussis par IA (fenêtre glissante) et délais du premier fragment
+    des flux (first_token) ; le délai de hedging est un percentile de ces mesures"""
+
+    def __init__(self, window: int, percentile: float, first_token_percentile: float, min_samples: int,
+                 default_delay: float, min_delay: float):
+        self.window = window
+        self.percentile = percentile
+        self.first_token_percentile = first_token_percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self._samples = {}
+        self._first_token_samples = {}
+        self.hedges_launched = 0
+        self.hedge_wins = 0
+
+    def record(self, ai_name: str, seconds: float, first_token: bool = False):
+        by_ai = self._first_token_samples if first_token else self._samples
+        samples = by_ai.get(ai_name)
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            by_ai[ai_name] = samples
+        samples.append(seconds)
+
+    def get_percentile(self, ai_name: str, percentile: float, first_token: bool = False) -> Optional[float]:
+        """Percentile (rang le plus proche) des latences récentes, None si trop peu de mesures"""
+        samples = sorted((self._first_token_samples if first_token else self._samples).get(ai_name, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, round(percentile / 100 * (len(samples) - 1)))]
+
+    def hedge_delay(self, ai_name: str, first_token: bool = False) -> float:
+        """Temps d'attente avant de lancer l'IA suivante en parallèle
+        (first_token : délai d'arrivée du premier fragment d'un flux)"""
+        latency = self.get_percentile(ai_name, self.first_token_percentile if first_token else self.percentile, first_token)
+        return self.default_delay if latency is None else max(self.min_delay, latency)
+
+    def get_stats(self) -> dict:
+        return {
+            "hedging_enabled": AI_HEDGING_ENABLED,
+            "hedge_percentile": self.percentile,
+            "first_token_hedge_percentile": self.first_token_percentile,
+            "hedges_launched": self.hedges_launched,
+            "hedge_wins": self.hedge_wins,
+            "providers": {
+                ai_name: {
+                    "samples": len(samples),
+                    "p50_ms": round(latency * 1000) if (latency := self.get_percentile(ai_name, 50)) is not None else None,
+                    "p95_ms": round(latency * 1000) if (latency := self.get_percentile(ai_name, 95)) is not None else None,
+                    "hedge_delay_ms": round(self.hedge_delay(ai_name) * 1000)
+                }
+                for ai_name, samples in self._samples.items()
+            },
+            "first_token": {
+                ai_name: {
+                    "samples": len(samples),
+                    "p50_ms": round(latency * 1000) if (latency := self.get_percentile(ai_name, 50, True)) is not None else None,
+                    "p95_ms": round(latency * 1000) if (latency := self.get_percentile(ai_name, 95, True)) is not None else None,
+                    "hedge_delay_ms": round(self.hedge_delay(ai_name, True) * 1000)
+                }
+                for ai_name, samples in self._first_token_samples.items()
+            }
+        }
+
+# Hedging (optionnel) : IA suivante lancée en parallèle si la première tarde
+AI_HEDGING_ENABLED = os.getenv("AI_HEDGING_ENABLED", "false").lower() == "true"
+
+provider_latency = ProviderLatencyTracker(
+    window=int(os.getenv("AI_LATENCY_WINDOW", "200")),
+    percentile=float(os.getenv("AI_HEDGE_PERCENTILE", "90")),
+    first_token_percentile=float(os.getenv("AI_STREAM_HEDGE_PERCENTILE", "95")),
+    min_samples=int(os.getenv("AI_HEDGE_MIN_SAMPLES", "10")),
+    default_delay=float(os.getenv("AI_HEDGE_DEFAULT_DELAY", "2.5")),
+    min_delay=float(os.getenv("AI_HEDGE_MIN_DELAY", "0.3"))
+)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+class ProviderHealthTracker:
+    """Santé des IA (taux d'erreur, 429, échecs consécutifs) et disjoncteur par IA :
+    - fermé : l'IA est appelée normalement
+    - ouvert : l'IA est sautée pendant `open_seconds` (délai doublé à chaque sonde ratée)
+    - semi-ouvert : un seul appel sonde ; succès → fermé, échec → ouvert"""
+
+    def __init__(self, window: int, min_calls: int, error_rate_threshold: float,
+                 failure_threshold: int, open_seconds: float, max_open_seconds: float):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate_threshold
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self._providers = {}
+
+    def _get(self, ai_name: str) -> dict:
+        health = self._providers.get(ai_name)
+        if health is None:
+            health = {
+                "state": CIRCUIT_CLOSED,
+                "outcomes": deque(maxlen=self.window),
+                "consecutive_failures": 0,
+                "calls": 0,
+                "errors": 0,
+                "rate_limited": 0,
+                "last_error": None,
+                "open_until": 0.0,
+                "open_duration": self.open_seconds,
+                "probe_in_flight": False,
+                "times_opened": 0
+            }
+            self._providers[ai_name] = health
+        return health
+
+    def _refresh_state(self, health: dict):
+        if health["state"] == CIRCUIT_OPEN and time.monotonic() >= health["open_until"]:
+            health["state"] = CIRCUIT_HALF_OPEN
+            health["probe_in_flight"] = False
+
+    def _open(self, ai_name: str, health: dict, reason: str):
+        if health["state"] == CIRCUIT_HALF_OPEN:
+            # Sonde ratée : on attend plus longtemps avant la prochaine
+            health["open_duration"] = min(self.max_open_seconds, health["open_duration"] * 2)
+        health["state"] = CIRCUIT_OPEN
+        health["open_until"] = time.monotonic() + health["open_duration"]
+        health["probe_in_flight"] = False
+        health["times_opened"] += 1
+        print(f"🔌 Circuit ouvert pour {ai_name} ({reason}) - ignorée pendant {health['open_duration']:.0f}s")
+
+    def is_available(self, ai_name: str) -> bool:
+        """L'IA peut être appelée maintenant (circuit fermé, ou semi-ouvert sans sonde en cours)"""
+        health = self._get(ai_name)
+        self._refresh_state(health)
+        if health["state"] == CIRCUIT_HALF_OPEN:
+            return not health["probe_in_flight"]
+        return health["state"] == CIRCUIT_CLOSED
+
+    def route(self, chain: list) -> list:
+        """Retire de la chaîne de repli les IA dont le circuit est ouvert ;
+        si toutes le sont, celle qui se rétablit le plus tôt passe en semi-ouvert pour une sonde"""
+        available = [ai_name for ai_name in chain if self.is_available(ai_name)]
+        if available or not chain:
+            if len(available) < len(chain):
+                print(f"🔌 IA ignorées (circuit ouvert): {', '.join(a for a in chain if a not in available)}")
+            return available
+
+        ai_name = min(chain, key=lambda name: self._get(name)["open_until"])
+        health = self._get(ai_name)
+        if health["state"] == CIRCUIT_OPEN:
+            health["state"] = CIRCUIT_HALF_OPEN
+            health["probe_in_flight"] = False
+        print(f"🔌 Toutes les IA ont un circuit ouvert - sonde anticipée sur {ai_name}")
+        return [ai_name]
+
+    def before_call(self, ai_name: str):
+        """Réserve l'appel ; en semi-ouvert, un seul appel sonde à la fois"""
+        if not self.is_available(ai_name):
+            raise ProviderCircuitOpen(f"Circuit ouvert pour {ai_name}")
+        health = self._get(ai_name)
+        if health["state"] == CIRCUIT_HALF_OPEN:
+            health["probe_in_flight"] = True
+
+    def release(self, ai_name: str):
+        """Appel annulé avant sa fin : libère la sonde sans compter de résultat"""
+        self._get(ai_name)["probe_in_flight"] = False
+
+    def record_success(self, ai_name: str):
+        health = self._get(ai_name)
+        health["calls"] += 1
+        health["outcomes"].append(True)
+        health["consecutive_failures"] = 0
+
+        if health["state"] != CIRCUIT_CLOSED:
+            print(f"✅ Circuit refermé pour {ai_name}")
+            # Repart d'une fenêtre propre pour ne pas rouvrir sur d'anciennes erreurs
+            health["outcomes"].clear()
+            health["outcomes"].append(True)
+        health["state"] = CIRCUIT_CLOSED
+        health["open_duration"] = self.open_seconds
+        health["probe_in_flight"] = False
+
+    def record_failure(self, ai_name: str, error: Exception):
+        health = self._get(ai_name)
+        status = get_error_status(error)
+        health["calls"] += 1
+        health["errors"] += 1
+        health["outcomes"].append(False)
+        health["consecutive_failures"] += 1
+        health["last_error"] = str(error)[:200]
+
+        if status == 429:
+            # Limite de débit : la pause est gérée par l'adaptateur (Retry-After / recul), pas par le disjoncteur
+            health["rate_limited"] += 1
+            health["probe_in_flight"] = False
+            return
+
+        if health["state"] == CIRCUIT_HALF_OPEN:
+            self._open(ai_name, health, "sonde en échec")
+            return
+
+        outcomes = health["outcomes"]
+        error_rate = outcomes.count(False) / len(outcomes)
+        if health["consecutive_failures"] >= self.failure_threshold:
+            self._open(ai_name, health, f"{health['consecutive_failures']} échecs consécutifs")
+        elif len(outcomes) >= self.min_calls and error_rate >= self.error_rate_threshold:
+            self._open(ai_name, health, f"taux d'erreur {error_rate:.0%}")
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        providers = {}
+        for ai_name, health in self._providers.items():
+            self._refresh_state(health)
+            outcomes = health["outcomes"]
+            p50 = provider_latency.get_percentile(ai_name, 50)
+            p95 = provider_latency.get_percentile(ai_name, 95)
+            providers[ai_name] = {
+                "state": health["state"],
+                "error_rate": round(outcomes.count(False) / len(outcomes), 3) if outcomes else 0.0,
+                "recent_calls": len(outcomes),
+                "consecutive_failures": health["consecutive_failures"],
+                "calls": health["calls"],
+                "errors": health["errors"],
+                "rate_limited": health["rate_limited"],
+                "times_opened": health["times_opened"],
+                "retry_in_seconds": round(max(0.0, health["open_until"] - now), 1) if health["state"] == CIRCUIT_OPEN else 0,
+                "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000) if p95 is not None else None,
+                "last_error": health["last_error"]
+            }
+        return providers
+
+provider_health = ProviderHealthTracker(
+    window=int(os.getenv("AI_HEALTH_WINDOW", "50")),
+    min_calls=int(os.getenv("AI_CIRCUIT_MIN_CALLS", "10")),
+    error_rate_threshold=float(os.getenv("AI_CIRCUIT_ERROR_RATE", "0.5")),
+    failure_threshold=int(os.getenv("AI_CIRCUIT_FAILURE_THRESHOLD", "5")),
+    open_seconds=float(os.getenv("AI_CIRCUIT_OPEN_SECONDS", "30")),
+    max_open_seconds=float(os.getenv("AI_CIRCUIT_MAX_OPEN_SECONDS", "300"))
+)
+
+async def generate_hedged(chain: list, prompt: str, budget: Optional[dict] = None, usage: Optional[dict] = None) -> tuple[str, str]:
+    """Hedging : si l'IA en cours n'a pas répondu dans le percentile de ses latences récentes,
+    la suivante est lancée en parallèle ; la première réponse gagne et les autres sont annulées.
+    Chaque tentative a son propre usage : `usage` reçoit celui du gagnant, et les tentatives qui ont
+    aussi abouti (tokens consommés malgré tout) sont listées dans usage["hedged"] pour record_ai_usage"""
+    pending = {}
+    attempts = {}
+    next_index = 0
+    last_launched = None
+
+    def launch():
+        nonlocal next_index, last_launched
+        last_launched = chain[next_index]
+        next_index += 1
+        print(f"{ai_providers.get(last_launched).label} - tentative...")
+        attempt_usage = {}
+        task = asyncio.create_task(call_ai(
+            last_launched, prompt, resolve_max_tokens(budget, last_launched), attempt_usage, budget and budget["stop"]
+        ))
+        pending[task] = last_launched
+        attempts[task] = attempt_usage
+
+    try:
+        while pending or next_index < len(chain):
+            if not pending:
+                launch()
+
+            delay = provider_latency.hedge_delay(last_launched) if next_index < len(chain) else None
+            done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                print(f"⏱️ {last_launched} sans réponse après {delay:.2f}s → {chain[next_index]} lancé en parallèle")
+                provider_latency.hedges_launched += 1
+                launch()
+                continue
+
+            for task in done:
+                ai_name = pending.pop(task)
+                try:
+                    content = task.result()
+                except Exception as e:
+                    print(f"❌ Erreur {ai_name}: {str(e)}")
+                    continue
+
+                if pending:
+                    provider_latency.hedge_wins += ai_name != chain[0]
+                    print(f"🏁 {ai_name} a répondu en premier - annulation de {', '.join(pending.values())}")
+                print(f"✅ Succès avec {ai_name}")
+                if usage is not None:
+                    usage.update(attempts[task])
+                return content, ai_name
+    finally:
+        # Les appels perdants sont annulés ; ceux qui ont abouti quand même (terminés avec le gagnant,
+        # ou avant l'annulation) restent à comptabiliser
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        completed = [
+            (pending[task], attempts[task]) for task in pending
+            if not task.cancelled() and task.exception() is None
+        ]
+        if completed:
+            print(f"💸 Tentatives perdantes ayant abouti: {', '.join(name for name, _ in completed)}")
+            if usage is not None:
+                usage["hedged"] = completed
+
+    return "❌ Désolé, tous les services IA sont temporairement indisponibles.", "error"
+
+async def generate_with_best_ai(prompt: str, preferred_ai: str = "groq", usage: Optional[dict] = None,
+                                budget: Optional[dict] = None) -> tuple[str, str]:
+    """Génère avec l'IA préférée selon l'expertise, avec fallback (et hedging si activé) ;
+    `usage` reçoit les tokens de l'appel gagnant, `budget` (classe de réponse) fixe max_tokens et
+    les séquences d'arrêt de chaque IA (sinon plafond RESPONSE_MAX_WORDS)"""
+    chain = get_ai_fallback_chain(preferred_ai, prompt)
+    if chain[0] != preferred_ai:
+        print(f"🔄 {preferred_ai} indisponible (non implémenté ou clé manquante), fallback vers {chain[0]}")
+    chain = provider_health.route(chain)
+
+    if AI_HEDGING_ENABLED:
+        return await generate_hedged(chain, prompt, budget, usage)
+
+    for ai_name in chain:
+        try:
+            print(f"{ai_providers.get(ai_name).label} - tentative...")
+            content = await call_ai(ai_name, prompt, resolve_max_tokens(budget, ai_name), usage, budget and budget["stop"])
+            print(f"✅ Succès avec {ai_name}")
+            # Le tracking sera fait par l'appelant (record_ai_usage)
+            return content, ai_name
+
+        except Exception as e:
+            print(f"❌ Erreur {ai_name}: {str(e)}")
 
     return "❌ Désolé, tous les services IA sont temporairement indisponibles.", "error"
 
 async def generate_description_with_fallback(prompt: str) -> tuple[str, str]:
-    """Génère une description avec Groq en priorité, Gemini en fallback"""
+    """Génère une description (les demandes identiques en cours partagent le même appel IA)"""
+    return await description_flights.do(
+        SingleFlight.fingerprint(prompt),
+        lambda: generate_description_with_providers(prompt)
+    )
 
-    # Tentative 1: Groq (ultra-rapide)
-    try:
-        print("🚀 Tentative avec Groq (ultra-rapide)...")
-
-        response = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=1000,
-            top_p=0.8
-        )
+# Réglages historiques des descriptions de profil (Groq garde son top_p par défaut)
+DESCRIPTION_GENERATION = {
+    "groq": {},
+    "gemini": {"model": "gemini-1.5-flash-latest", "top_p": 0.8, "top_k": 40}
+}
 
-        description = response.choices[0].message.content.strip()
-        print("✅ Succès avec Groq")
-        return description, "groq"
+async def generate_description_with_providers(prompt: str) -> tuple[str, str]:
+    """Génère une description avec Groq en priorité, Gemini en fallback
+    (quotas Groq suivis par le registre : bascule vers Gemini avant le 429)"""
+    errors = []
 
-    except Exception as groq_error:
-        print(f"❌ Groq échoué: {str(groq_error)}")
+    for ai_name, generation in DESCRIPTION_GENERATION.items():
+        try:
+            print(f"{ai_providers.get(ai_name).label} - tentative (description)...")
+            description = await call_ai(ai_name, prompt, 1000, generation=generation)
+            print(f"✅ Succès avec {ai_name}")
+            return description, ai_name
 
-        # Si erreur 429 (limite dépassée) ou autre erreur Groq
-        if "429" in str(groq_error) or "rate_limit" in str(groq_error).lower():
-            print("⚠️ Limite Groq atteinte (6000 req/jour) - Basculement vers Gemini...")
-        else:
-            print("⚠️ Erreur Groq - Basculement vers Gemini...")
+        except Exception as e:
+            print(f"❌ {ai_name} échoué: {str(e)}")
+            errors.append(f"{ai_name}: {e}")
+
+    raise Exception(f"Tous les services IA ont échoué. {', '.join(errors)}")
+
+# ================================
+# 📡 STREAMING DES RÉPONSES IA (TOKEN PAR TOKEN)
+# ================================
+
+class SSEDeltaParser:
+    """Parseur incrémental des flux SSE au format OpenAI (OpenAI, DeepInfra) :
+    les octets reçus deviennent des fragments de texte dès qu'un événement est complet"""
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._data = []
+        self.done = False
+        self.usage = None
+
+    def feed(self, chunk: bytes) -> list:
+        """Ajoute des octets reçus et retourne les fragments de texte des événements complets"""
+        self._buffer += self._decoder.decode(chunk)
+        deltas = []
+
+        while True:
+            newline = self._buffer.find("\n")
+            if newline == -1:
+                break
+            line = self._buffer[:newline].rstrip("\r")
+            self._buffer = self._buffer[newline + 1:]
+
+            if not line:
+                # Ligne vide = fin de l'événement
+                self._dispatch(deltas)
+            elif line.startswith("data:"):
+                value = line[5:]
+                self._data.append(value[1:] if value.startswith(" ") else value)
+            # Commentaires (":") et autres champs (event:, id:) ignorés
+
+        return deltas
+
+    def flush(self) -> list:
+        """Traite le dernier événement si le flux se termine sans ligne vide"""
+        self._buffer += self._decoder.decode(b"", final=True)
+        deltas = self.feed(b"\n\n") if self._buffer or self._data else []
+        return deltas
+
+    def _dispatch(self, deltas: list):
+        if not self._data:
+            return
+        data = "\n".join(self._data)
+        self._data = []
+
+        if data == "[DONE]":
+            self.done = True
+            return
+
+        try:
+            event = json.loads(data)
+        except ValueError:
+            print(f"⚠️ Événement SSE illisible: {data[:100]}")
+            return
+
+        if event.get("usage"):
+            self.usage = event["usage"]
 
-    # Tentative 2: Gemini (fallback)
+        for choice in event.get("choices") or []:
+            content = (choice.get("delta") or {}).get("content")
+            if content:
+                deltas.append(content)
+
+async def stream_from_provider(ai_name: str, prompt: str, budget: Optional[dict], usage: dict):
+    """Flux d'une IA : fragments de texte, avec réservation de débit, suivi de santé, délai du premier
+    fragment et usage (rempli aussi si le flux est arrêté). Ne produit rien si l'IA échoue avant
+    son premier fragment : l'appelant passe alors à l'IA suivante"""
     try:
-        print("🔄 Tentative avec Gemini (fallback)...")
+        provider_health.before_call(ai_name)
+    except ProviderCircuitOpen as e:
+        print(f"🔌 {str(e)}")
+        return
 
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.8,
-            "top_k": 40,
-            "max_output_tokens": 1000,
-        }
+    adapter = ai_providers.get(ai_name)
+    max_tokens = resolve_max_tokens(budget, ai_name)
+    usage["max_tokens"] = max_tokens
+    streamed = []
+
+    def settle_usage():
+        # Tokens facturés même si le flux est interrompu : usage renvoyé ou estimation du texte reçu
+        complete_usage(ai_name, usage, prompt, "".join(streamed))
+        adapter.refund(max_tokens - usage["completion_tokens"])
 
-        response = model.generate_content(prompt, generation_config=generation_config)
-        description = response.text.strip()
-        print("✅ Succès avec Gemini")
-        return description, "gemini"
+    try:
+        print(f"📡 Streaming avec {ai_name}...")
+        async with adapter.reserve(estimate_request_tokens(ai_name, prompt, max_tokens)):
+            requested = time.monotonic()
+            async with aclosing(adapter.stream(prompt, max_tokens, usage, budget and budget["stop"])) as deltas:
+                async for delta in deltas:
+                    if not streamed:
+                        provider_latency.record(ai_name, time.monotonic() - requested, first_token=True)
+                    streamed.append(delta)
+                    yield delta
+
+        if streamed:
+            print(f"✅ Streaming terminé avec {ai_name}")
+            provider_health.record_success(ai_name)
+            settle_usage()
+            return
+        print(f"⚠️ Réponse vide de {ai_name}")
+        provider_health.record_failure(ai_name, RuntimeError("Réponse vide"))
+
+    except ProviderRateLimited as e:
+        print(f"🚦 {str(e)}")
+        provider_health.release(ai_name)
+    except Exception as e:
+        print(f"❌ Erreur streaming {ai_name}: {str(e)}")
+        provider_health.record_failure(ai_name, e)
+        # Réponse partielle déjà envoyée au client : pas de repli possible
+        if streamed:
+            settle_usage()
+            raise
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client parti, flux arrêté (limite de longueur) ou perdant d'un hedging : pas un échec de l'IA
+        if streamed:
+            provider_health.record_success(ai_name)
+            settle_usage()
+        else:
+            provider_health.release(ai_name)
+        raise
+
+async def first_stream_delta(chain: list, prompt: str, budget: Optional[dict]):
+    """Premier fragment parmi les IA de la chaîne : l'IA suivante est lancée en parallèle si la première
+    n'a rien envoyé dans le percentile de ses délais de premier fragment (hedging) ; le premier flux
+    qui produit un fragment gagne, les autres sont fermés.
+    Retourne (ia, flux, usage, fragment), ou None si aucune IA n'a répondu"""
+    pending = {}
+    next_index = 0
+    last_launched = None
+
+    def launch():
+        nonlocal next_index, last_launched
+        last_launched = chain[next_index]
+        next_index += 1
+        attempt_usage = {}
+        deltas = stream_from_provider(last_launched, prompt, budget, attempt_usage)
+        pending[asyncio.ensure_future(anext(deltas))] = (last_launched, deltas, attempt_usage)
 
-    except Exception as gemini_error:
-        print(f"❌ Gemini aussi échoué: {str(gemini_error)}")
-        raise Exception(f"Tous les services IA ont échoué. Groq: {groq_error}, Gemini: {gemini_error}")
+    try:
+        while pending or next_index < len(chain):
+            if not pending:
+                launch()
+
+            delay = provider_latency.hedge_delay(last_launched, first_token=True) if AI_HEDGING_ENABLED and next_index < len(chain) else None
+            done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                print(f"⏱️ {last_launched} sans premier fragment après {delay:.2f}s → {chain[next_index]} lancé en parallèle")
+                provider_latency.hedges_launched += 1
+                launch()
+                continue
+
+            for task in done:
+                ai_name, deltas, attempt_usage = pending.pop(task)
+                try:
+                    delta = task.result()
+                except StopAsyncIteration:
+                    continue  # échec avant le premier fragment : IA suivante
+
+                if pending:
+                    provider_latency.hedge_wins += ai_name != chain[0]
+                    print(f"🏁 {ai_name} a streamé en premier - annulation de {', '.join(name for name, _, _ in pending.values())}")
+                return ai_name, deltas, attempt_usage, delta
+    finally:
+        # Flux perdants (ou tous, si l'appelant est annulé) : fermés, seul le gagnant est comptabilisé
+        for task, (_, deltas, _) in pending.items():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+            except Exception as e:
+                print(f"⚠️ Flux perdant interrompu: {str(e)}")
+            await deltas.aclose()
+
+    return None
+
+async def stream_with_best_ai(prompt: str, preferred_ai: str = "groq", usage: Optional[dict] = None,
+                             budget: Optional[dict] = None):
+    """Streaming avec l'IA préférée : produit des tuples (ia_utilisée, fragment).
+    Repli sur l'IA suivante tant qu'aucun fragment n'a été envoyé (et hedging sur le premier fragment
+    si activé) ; `usage` reçoit les tokens consommés (y compris si le flux est arrêté avant la fin),
+    `budget` fixe max_tokens et les séquences d'arrêt"""
+    first = await first_stream_delta(provider_health.route(get_ai_fallback_chain(preferred_ai, prompt)), prompt, budget)
+    if first is None:
+        raise RuntimeError("Tous les services IA sont temporairement indisponibles")
+
+    ai_name, deltas, stream_usage, delta = first
+    try:
+        yield ai_name, delta
+        async for delta in deltas:
+            yield ai_name, delta
+    finally:
+        # Fermeture du flux gagnant (usage complété même s'il est interrompu) puis transmission
+        await deltas.aclose()
+        if usage is not None:
+            usage.update(stream_usage)
 
 # Fonctions utilitaires pour l'IA Coach
 async def call_backend_api(method: str, endpoint: str, data: dict = None) -> dict:
@@ -970,16 +3659,16 @@ async def call_backend_api(method: str, endpoint: str, data: dict = None) -> dic
         backend_url = os.getenv("API_BACKEND_URL", "http://localhost:8000")
         url = f"{backend_url}/{endpoint.lstrip('/')}"
 
-        async with aiohttp.ClientSession() as session:
-            if method.upper() == "GET":
-                async with session.get(url) as response:
-                    return await response.json()
-            elif method.upper() == "POST":
-                async with session.post(url, json=data) as response:
-                    return await response.json()
-            elif method.upper() == "PATCH":
-                async with session.patch(url, json=data) as response:
-                    return await response.json()
+        session = http_clients.session(url)
+        if method.upper() == "GET":
+            async with session.get(url) as response:
+                return await response.json()
+        elif method.upper() == "POST":
+            async with session.post(url, json=data) as response:
+                return await response.json()
+        elif method.upper() == "PATCH":
+            async with session.patch(url, json=data) as response:
+                return await response.json()
     except Exception as e:
         print(f"❌ Erreur API backend: {str(e)}")
         return {"error": str(e)}
@@ -1010,22 +3699,22 @@ async def generate_image_dalle3(prompt: str) -> str:
             "quality": "standard"
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.openai.com/v1/images/generations",
-                headers=headers,
-                json=data,
-                timeout=aiohttp.ClientTimeout(total=60)
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    if result.get("data") and len(result["data"]) > 0:
-                        image_url = result["data"][0]["url"]
-                        print("✅ Image générée avec DALL-E 3")
-                        return image_url
-                else:
-                    print(f"❌ Erreur DALL-E 3: {response.status}")
-                    return await generate_image_deepinfra(prompt)
+        url = f"{OPENAI_API_URL}/v1/images/generations"
+        async with http_clients.session(url).post(
+            url,
+            headers=headers,
+            json=data,
+            timeout=aiohttp.ClientTimeout(total=60)
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                if result.get("data") and len(result["data"]) > 0:
+                    image_url = result["data"][0]["url"]
+                    print("✅ Image générée avec DALL-E 3")
+                    return image_url
+            else:
+                print(f"❌ Erreur DALL-E 3: {response.status}")
+                return await generate_image_deepinfra(prompt)
 
     except Exception as e:
         print(f"❌ Erreur DALL-E 3: {str(e)}")
@@ -1048,10 +3737,19 @@ async def generate_image_deepinfra(prompt: str) -> str:
         return f"❌ Erreur génération image: {str(e)}"
 
 async def generate_image_smart(prompt: str, expertise: str = "default", context: str = "") -> dict:
+    """Génération d'image (les demandes identiques en cours partagent la même génération et son coût)"""
+    result = await image_flights.do(
+        SingleFlight.fingerprint(prompt, expertise, context),
+        lambda: generate_image_with_budget(prompt, expertise, context)
+    )
+    return dict(result)
+
+async def generate_image_with_budget(prompt: str, expertise: str = "default", context: str = "") -> dict:
     """Génération d'image intelligente avec suggestions contextuelles et contrôle budget"""
 
-    # Sélection de l'IA optimale selon l'expertise et budget
-    image_ai = get_image_ai_with_budget_check(expertise)
+    # Sélection de l'IA optimale selon l'expertise et budget (prix de l'image réservé)
+    reservation = {}
+    image_ai = await get_image_ai_with_budget_check(expertise, reservation)
 
     # Amélioration du prompt selon l'expertise
     enhanced_prompt = enhance_image_prompt(prompt, expertise, context)
@@ -1063,8 +3761,8 @@ async def generate_image_smart(prompt: str, expertise: str = "default", context:
         else:
             image_url = await generate_image_deepinfra(enhanced_prompt)
 
-        # Tracking du coût
-        add_cost(expertise, image_ai, tokens=0, is_image=True)
+        # Tracking du coût (solde la réservation)
+        await add_cost(expertise, image_ai, tokens=0, is_image=True, reservation=reservation)
 
         # Suggestions contextuelles
         suggestions = generate_image_suggestions(expertise, context)
@@ -1077,7 +3775,7 @@ async def generate_image_smart(prompt: str, expertise: str = "default", context:
             "suggestions": suggestions,
             "expertise": expertise,
             "cost_info": {
-                "current_cost": cost_tracker.get("images", 0.0),
+                "current_cost": await asyncio.to_thread(cost_ledger.get_spent, "images"),
                 "budget_limit": BUDGET_LIMITS.get("images", 10.0)
             }
         }
@@ -1090,6 +3788,9 @@ async def generate_image_smart(prompt: str, expertise: str = "default", context:
             "suggestions": generate_image_suggestions(expertise, context)
         }
 
+    finally:
+        await release_budget(reservation)
+
 def enhance_image_prompt(prompt: str, expertise: str, context: str = "") -> str:
     """Améliore le prompt selon l'expertise et le contexte"""
 
@@ -1150,79 +3851,969 @@ def generate_image_suggestions(expertise: str, context: str = "") -> list:
             "Dessin de groupe d'amis",
             "Image motivante du jour"
         ]
-    }
+    }
+
+    return suggestions.get(expertise, [
+        "Image personnalisée selon vos goûts",
+        "Illustration de votre conversation",
+        "Création artistique unique",
+        "Design adapté à vos besoins"
+    ])
+
+# ================================
+# 🧩 GABARITS DU PROMPT SYSTÈME IA COACH
+# ================================
+
+# Sujets de spécialité par ordre de priorité (mots-clés : catégories "topic:" du lexique)
+COACH_TOPICS = ("confiance", "rendez-vous", "stress_social", "communication", "developpement_personnel")
+COACH_TOPIC_CATEGORIES = tuple(f"topic:{topic}" for topic in COACH_TOPICS)
+
+# Sujets prioritaires sans limite de caractères
+COACH_PRIORITY_TOPICS = ("confiance", "rendez-vous", "stress_social", "communication")
+
+# Focus par expertise quand les prompts spécialisés sont désactivés
+COACH_EXPERTISE_FOCUS = {
+    "psychology": "EXPERTISE RENFORCÉE: Psychologie, thérapie comportementale, développement personnel",
+    "sexology": "EXPERTISE RENFORCÉE: Sexologie, éducation sexuelle, intimité et bien-être sexuel",
+    "seduction": "EXPERTISE RENFORCÉE: Séduction, charisme, techniques de drague et attraction",
+    "development": "EXPERTISE RENFORCÉE: Développement personnel, motivation, objectifs et croissance",
+    "amical": """MODE AMICAL:
+- Réponses COURTES et naturelles (maximum 2-3 phrases)
+- Ton décontracté comme un ami proche
+- Évite les répétitions du prénom
+- Sois chaleureux mais concis"""
+}
+
+def analyze_coach_prompt(user_prompt: str) -> dict:
+    """Mots-clés du message : sujet de spécialité, question simple, demande détaillée, salutation"""
+    matches = keyword_matcher.scan(user_prompt)
+    topic_category = matches.first(COACH_TOPIC_CATEGORIES)
+
+    return {
+        "topic_detected": topic_category[len("topic:"):] if topic_category else None,
+        "is_simple_question": matches.has("simple_question"),
+        "wants_detailed_explanation": matches.has("detailed_request"),
+        "user_greeted": matches.has("greeting")
+    }
+
+def compile_system_prompt_template(expertise: str, user_name: Optional[str], specialized: bool,
+                                   is_simple_question: bool, wants_detailed_explanation: bool) -> tuple[str, str]:
+    """Parties statiques du prompt système (tête, fin) : tout sauf sujet, salutation, historique, heure et message"""
+    if specialized:
+        specialized_system = get_specialized_prompt_system(expertise, user_name)
+    else:
+        specialized_system = f"""Tu es un IA Coach expert en séduction, sexologie et psychologie. Tu es un ami bienveillant.
+PERSONNALITÉ: Chaleureux, empathique, sans jugement, expert relations/sexualité.
+{COACH_EXPERTISE_FOCUS.get(expertise, "")}"""
+
+    head = f"""{specialized_system}
+
+SUJETS DE SPÉCIALITÉ (reconnais ces thèmes et adapte tes réponses):
+💙 CONFIANCE EN SOI: Techniques d'estime de soi, affirmation personnelle, surmonter les complexes
+🗓️ PREMIER RENDEZ-VOUS: Comportement, conversation, gestion du stress, faire bonne impression
+👥 STRESS SOCIAL: Anxiété sociale, timidité, prise de parole, interactions sociales
+💬 COMMUNICATION: Écoute active, expression des émotions, langage corporel, charisme
+🌟 DÉVELOPPEMENT PERSONNEL: Motivation, objectifs, habitudes, croissance personnelle, bien-être
+😊 MODE AMICAL: Conversations décontractées, conseils bienveillants, écoute amicale
+
+STYLE DE RÉPONSE:
+{
+    "- RÉPONSE COURTE (1-2 phrases max) pour cette question simple" if is_simple_question
+    else "- RÉPONSE DÉTAILLÉE avec explications complètes, exemples et conseils pratiques" if wants_detailed_explanation
+    else "- Réponse COMPLÈTE mais concise (300-500 caractères) avec conseils utiles"
+}
+- Conversationnel et naturel
+- RÈGLE ABSOLUE: Ne salue (Salut/Bonjour) que si l'utilisateur salue ET que c'est le début de conversation
+- Si l'utilisateur pose directement une question, réponds directement sans aucune salutation
+- En cours de conversation, ne répète JAMAIS de salutation même si l'utilisateur re-salue
+- Ne commence JAMAIS ta réponse par "Bonjour !" ou "Salut !" si vous êtes déjà en conversation
+- Utilise le contexte de la conversation précédente pour maintenir la fluidité
+- Aucun tabou sur la sexualité (éducatif et respectueux)
+- DONNE des conseils CONCRETS et UTILES
+{"- DÉVELOPPE en détail avec exemples et conseils pratiques" if wants_detailed_explanation else "- EXPLIQUE suffisamment pour être utile, propose d'expliquer plus si besoin"}
+
+"""
+    tail = f"""
+
+{"Réponds de manière courte et naturelle." if is_simple_question else "Réponds de manière empathique et détaillée."}"""
+
+    return head, tail
+
+def assemble_system_prompt(template: tuple[str, str], topic_detected: Optional[str], greeting_instruction: str,
+                           conversation_context: str, user_prompt: str, now: Optional[datetime] = None) -> str:
+    """Prompt système d'un tour : gabarit compilé + champs dynamiques"""
+    head, tail = template
+    now = now or datetime.now()
+
+    return "".join((
+        head,
+        f"🎯 SUJET DÉTECTÉ: {topic_detected.upper()} - Adapte ta réponse à ce domaine spécifique" if topic_detected else "",
+        "\n\n",
+        f"INSTRUCTION SALUTATION: {greeting_instruction}" if greeting_instruction else "",
+        "\n\n",
+        f"CONTEXTE CONVERSATION RÉCENTE:\\n{conversation_context}\\n" if conversation_context else "",
+        "\n\nHEURE: ",
+        now.strftime('%H:%M | DATE: %d/%m/%Y'),
+        "\n\nUTILISATEUR: ",
+        user_prompt,
+        tail
+    ))
+
+class SystemPromptTemplates:
+    """Gabarits compilés par (expertise, prénom, prompts spécialisés, question simple, demande détaillée),
+    gardés en LRU (le prénom rend le nombre de combinaisons non borné)"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._templates = OrderedDict()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+    def get(self, expertise: str, user_name: Optional[str], specialized: bool,
+            is_simple_question: bool, wants_detailed_explanation: bool) -> tuple[str, str]:
+        key = (expertise, user_name, specialized, is_simple_question, wants_detailed_explanation)
+        template = self._templates.get(key)
+        if template:
+            self._templates.move_to_end(key)
+            self.counters["hits"] += 1
+            return template
+
+        self.counters["misses"] += 1
+        template = compile_system_prompt_template(*key)
+        self._templates[key] = template
+        if len(self._templates) > self.max_entries:
+            self._templates.popitem(last=False)
+            self.counters["evictions"] += 1
+        return template
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self._templates),
+            "max_entries": self.max_entries,
+            **self.counters
+        }
+
+system_prompt_templates = SystemPromptTemplates(max_entries=int(os.getenv("SYSTEM_PROMPT_TEMPLATE_CACHE_SIZE", "1024")))
+
+# ================================
+# 📚 CONTEXTE CONVERSATIONNEL - BUDGET DE TOKENS ET RÉSUMÉ GLISSANT
+# ================================
+
+# Budget du contexte injecté dans le prompt (résumé + messages récents) et part réservée au résumé
+CONTEXT_TOKEN_BUDGET = int(os.getenv("AI_CONTEXT_TOKEN_BUDGET", "2000"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("AI_CONTEXT_SUMMARY_TOKENS", "300"))
+# Fenêtre pleine : les plus anciens messages sortent jusqu'à ce seuil (résumés par lots, pas à chaque tour)
+CONTEXT_LOW_WATERMARK = float(os.getenv("AI_CONTEXT_LOW_WATERMARK", "0.75"))
+CONTEXT_SUMMARY_ENABLED = os.getenv("AI_CONTEXT_SUMMARY_ENABLED", "true").lower() == "true"
+CONTEXT_SUMMARY_PROVIDERS = tuple(
+    ai_name.strip() for ai_name in os.getenv("AI_CONTEXT_SUMMARY_PROVIDERS", "groq,gemini").split(",") if ai_name.strip()
+)
+
+def build_context_summary_prompt(summary: str, lines: list, max_tokens: int) -> str:
+    """Prompt de résumé : résumé précédent + messages sortis de la fenêtre récente"""
+    previous = f"RÉSUMÉ PRÉCÉDENT:\n{summary}\n\n" if summary else ""
+    exchanges = "\n".join(lines)
+    return f"""Résume en français la conversation suivante entre un utilisateur et son coach, en {max_tokens // 2} mots maximum.
+Garde uniquement ce qui sera utile pour la suite: prénom, situation et objectifs de l'utilisateur, émotions exprimées, conseils déjà donnés.
+Réponds uniquement avec le résumé, sans introduction.
+
+{previous}NOUVEAUX ÉCHANGES:
+{exchanges}"""
+
+class ConversationContext:
+    """Contexte d'une session pour le prompt : chaque message est rendu ("role: contenu") et compté une
+    seule fois, la fenêtre récente reste sous le budget de tokens et les messages qui en sortent sont
+    résumés en arrière-plan (résumé extractif borné en attendant, ou si l'IA échoue)"""
+
+    def __init__(self, token_budget: int, summary_tokens: int, low_watermark: float):
+        self.window_budget = max(1, token_budget - summary_tokens)
+        self.summary_tokens = summary_tokens
+        self.low_watermark = low_watermark
+        self.recent = deque()  # (ligne rendue, tokens estimés)
+        self.recent_tokens = 0
+        self.pending = []  # lignes sorties de la fenêtre, pas encore résumées
+        self.summary = ""
+        self.summarized_messages = 0
+        self.summaries_generated = 0
+        self.summaries_failed = 0
+        self._summarizing = None
+
+    def _fit(self, text: str, max_tokens: int, keep_end: bool = False) -> str:
+        """Tronque un texte à un nombre de tokens estimé"""
+        limit = int(max_tokens * token_estimator.chars_per_token(None))
+        if len(text) <= limit:
+            return text
+        return "…" + text[-(limit - 1):] if keep_end else text[:limit - 1] + "…"
+
+    def add(self, role: str, content: str):
+        """Ajoute un message à la fenêtre récente (un message seul ne peut pas dépasser la fenêtre)"""
+        line = self._fit(f"{role}: {content}", self.window_budget)
+        tokens = token_estimator.estimate(None, line) + 1  # +1 : saut de ligne
+        self.recent.append((line, tokens))
+        self.recent_tokens += tokens
+
+        if self.recent_tokens > self.window_budget:
+            target = self.window_budget * self.low_watermark
+            while len(self.recent) > 1 and self.recent_tokens > target:
+                line, tokens = self.recent.popleft()
+                self.recent_tokens -= tokens
+                self.pending.append(line)
+
+    def summary_text(self) -> str:
+        """Résumé à injecter : résumé IA, complété des messages en attente (les plus récents gardés)"""
+        if not self.pending:
+            return self.summary
+        return self._fit(" | ".join([self.summary, *self.pending] if self.summary else self.pending),
+                         self.summary_tokens, keep_end=True)
+
+    def render(self) -> str:
+        """Contexte du prompt : identique à l'historique complet tant que la fenêtre n'a jamais débordé"""
+        summary = self.summary_text()
+        lines = [line for line, _ in self.recent]
+        if summary:
+            lines.insert(0, f"[Résumé des échanges précédents] {summary}")
+        return "\n".join(lines)
+
+    def needs_summary(self) -> bool:
+        return bool(self.pending) and self._summarizing is None
+
+    def fold_pending(self):
+        """Résumé extractif (sans IA) des messages en attente"""
+        count = len(self.pending)
+        self.summary = self.summary_text()
+        self.pending.clear()
+        self.summarized_messages += count
+
+    def _next_batch(self) -> list:
+        """Messages en attente à résumer en un appel (au plus une fenêtre de tokens)"""
+        batch, tokens = [], 0
+        for line in self.pending:
+            tokens += token_estimator.estimate(None, line)
+            if batch and tokens > self.window_budget:
+                break
+            batch.append(line)
+        return batch
+
+    async def summarize(self, session_id: str, expertise: Optional[str]):
+        """Résume les messages en attente par lots avec la première IA disponible (coût imputé à
+        l'expertise) ; les messages sortis de la fenêtre pendant un appel sont pris au lot suivant"""
+        while self.pending:
+            lines = self._next_batch()
+            prompt = build_context_summary_prompt(self.summary, lines, self.summary_tokens)
+
+            for ai_name in CONTEXT_SUMMARY_PROVIDERS:
+                usage = {}
+                try:
+                    summary = await call_ai(ai_name, prompt, self.summary_tokens, usage)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ Résumé du contexte via {ai_name} échoué: {str(e)}")
+                    continue
+
+                await record_ai_usage(expertise, session_id, ai_name, usage)
+                self.summary = self._fit(summary.strip(), self.summary_tokens)
+                del self.pending[:len(lines)]
+                self.summarized_messages += len(lines)
+                self.summaries_generated += 1
+                print(f"📝 Contexte résumé ({ai_name}) | Session: {session_id} | {self.summarized_messages} messages résumés")
+                break
+            else:
+                self.summaries_failed += 1
+                self.fold_pending()
+
+    def get_stats(self) -> dict:
+        return {
+            "recent_messages": len(self.recent),
+            "recent_tokens": self.recent_tokens,
+            "window_budget": self.window_budget,
+            "pending_messages": len(self.pending),
+            "summarized_messages": self.summarized_messages,
+            "summary_tokens": token_estimator.estimate(None, self.summary),
+            "summaries_generated": self.summaries_generated,
+            "summaries_failed": self.summaries_failed,
+            "summarizing": self._summarizing is not None
+        }
+
+def schedule_context_summary(session_id: str, context: ConversationContext, expertise: Optional[str]):
+    """Lance le résumé en tâche de fond (une seule à la fois par session), sans bloquer le tour"""
+    if not context.needs_summary():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if not CONTEXT_SUMMARY_ENABLED or loop is None or not CONTEXT_SUMMARY_PROVIDERS:
+        context.fold_pending()
+        return
+
+    def done(task: asyncio.Task):
+        context._summarizing = None
+        if not task.cancelled() and task.exception():
+            print(f"❌ Erreur résumé du contexte: {task.exception()}")
+
+    context._summarizing = loop.create_task(context.summarize(session_id, expertise))
+    context._summarizing.add_done_callback(done)
+
+# ================================
+# 🗄️ STOCKAGE DES CONVERSATIONS - MÉMOIRE BORNÉE + DÉBORDEMENT SQLITE
+# ================================
+
+class ConversationTurn:
+    """Message d'une conversation (rôle interné, horodatage en secondes epoch issu de l'horloge monotone) ;
+    lisible comme l'ancien dict et comme les messages de /micro-signals/analyze (sender, timestamp ISO)"""
+
+    __slots__ = ("role", "content", "at")
+
+    def __init__(self, role: str, content: str, at: float):
+        self.role = role
+        self.content = content
+        self.at = at
+
+    def get(self, key: str, default=None):
+        if key == "role" or key == "sender":
+            return self.role
+        if key == "content":
+            return self.content
+        if key == "timestamp":
+            return datetime.fromtimestamp(self.at).isoformat()
+        return default
+
+    def __getitem__(self, key: str):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+class ConversationLog(list):
+    """Journal des messages d'une session : compteurs par rôle et longueur totale tenus à jour à chaque
+    ajout (état de la conversation en O(1)), horodatages croissants même si l'horloge système recule"""
+
+    __slots__ = ("role_counts", "total_chars", "_clock_offset")
+
+    def __init__(self):
+        super().__init__()
+        self.role_counts = {}
+        self.total_chars = 0
+        self._clock_offset = time.time() - time.monotonic()
+
+    def add(self, role: str, content: str, at: Optional[float] = None) -> ConversationTurn:
+        now = time.monotonic() + self._clock_offset
+        if at is None:
+            at = max(now, self[-1].at) if self else now
+        turn = ConversationTurn(sys.intern(role), content, at)
+        self.append(turn)
+        self.role_counts[turn.role] = self.role_counts.get(turn.role, 0) + 1
+        self.total_chars += len(content)
+        return turn
+
+    def response_times(self) -> List[float]:
+        """Secondes entre deux messages consécutifs (sans passer par les horodatages ISO)"""
+        return [self[i].at - self[i - 1].at for i in range(1, len(self))]
+
+    def last_timestamp(self) -> Optional[str]:
+        return self[-1].get("timestamp") if self else None
+
+class ConversationSession:
+    """Historique complet d'une session + son contexte de prompt"""
+
+    def __init__(self, session_id: str, turns: list = None, summary: str = "", summarized_messages: int = 0):
+        self.session_id = session_id
+        self.messages = ConversationLog()
+        self.size_bytes = 0
+        self.last_access = time.monotonic()
+        self.context = ConversationContext(CONTEXT_TOKEN_BUDGET, CONTEXT_SUMMARY_TOKENS, CONTEXT_LOW_WATERMARK)
+
+        # Session rechargée : résumé sauvegardé, seuls les messages non résumés repassent dans la fenêtre
+        self.context.summary = summary
+        self.context.summarized_messages = summarized_messages
+        for index, (role, content, at) in enumerate(turns or []):
+            self.add(role, content, index >= summarized_messages, at)
+
+    def add(self, role: str, content: str, to_context: bool = True, at: Optional[float] = None) -> ConversationTurn:
+        turn = self.messages.add(role, content, at)
+        self.size_bytes += len(content.encode("utf-8")) + 64  # contenu + surcoût approximatif de l'enregistrement
+        if to_context:
+            self.context.add(role, content)
+        return turn
+
+    def close(self):
+        """Sortie de la mémoire : résumé en cours annulé"""
+        if self.context._summarizing:
+            self.context._summarizing.cancel()
+
+class MemoryConversationStore:
+    """Sessions en mémoire bornées : nombre maximal, taille totale, expiration après inactivité, éviction LRU.
+    Les sous-classes gardent les sessions évincées (_spill) et les rechargent à la demande (_load)"""
+
+    def __init__(self, max_sessions: int, max_bytes: int, idle_ttl: float):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()
+        self.total_bytes = 0
+        self.counters = {
+            "created": 0,
+            "evicted_lru": 0,
+            "evicted_bytes": 0,
+            "expired": 0,
+            "deleted": 0
+        }
+
+    def _load(self, session_id: str) -> Optional[ConversationSession]:
+        return None
+
+    def _spill(self, session: ConversationSession):
+        pass
+
+    def _persist(self, session: ConversationSession, turn: ConversationTurn):
+        pass
+
+    def _remove(self, session_id: str):
+        pass
+
+    def _evict(self, session_id: str, reason: str):
+        session = self._sessions.pop(session_id)
+        self.total_bytes -= session.size_bytes
+        self.counters[reason] += 1
+        session.close()
+        self._spill(session)
+
+    def _expire(self):
+        """Sessions inactives : les plus anciennes sont en tête (ordre LRU = ordre des derniers accès)"""
+        if self.idle_ttl <= 0:
+            return
+        deadline = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.last_access > deadline:
+                break
+            self._evict(session_id, "expired")
+
+    def _enforce_limits(self, keep: str):
+        while len(self._sessions) > self.max_sessions or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._sessions))
+            if oldest == keep:
+                break
+            self._evict(oldest, "evicted_lru" if len(self._sessions) > self.max_sessions else "evicted_bytes")
+
+    def get(self, session_id: str, create: bool = False, load: bool = True) -> Optional[ConversationSession]:
+        """Session chaude, sinon rechargée depuis le stockage (sauf load=False), sinon créée (si demandé)"""
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+        else:
+            session = self._load(session_id) if load else None
+            if session is None:
+                if not create:
+                    return None
+                session = ConversationSession(session_id)
+                self.counters["created"] += 1
+            self._install(session_id, session)
+        session.last_access = time.monotonic()
+        return session
+
+    def _install(self, session_id: str, session: ConversationSession):
+        self._sessions[session_id] = session
+        self.total_bytes += session.size_bytes
+        self._enforce_limits(keep=session_id)
+
+    async def preload(self, session_id: str, create: bool = False) -> Optional[ConversationSession]:
+        """Comme get, pour le code asynchrone : une session froide est rechargée hors de la boucle d'événements.
+        Les accès synchrones qui suivent (sans await entre les deux) trouvent la session en mémoire"""
+        return self.get(session_id, create)
+
+    def exists(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def get_messages(self, session_id: str) -> list:
+        session = self.get(session_id)
+        return session.messages if session else []
+
+    def get_context(self, session_id: str) -> ConversationContext:
+        return self.get(session_id, create=True).context
+
+    def append(self, session_id: str, role: str, content: str) -> ConversationSession:
+        session = self.get(session_id, create=True)
+        previous_size = session.size_bytes
+        self._persist(session, session.add(role, content))
+        self.total_bytes += session.size_bytes - previous_size
+        self._enforce_limits(keep=session_id)
+        return session
+
+    def delete(self, session_id: str) -> int:
+        """Supprime une session (mémoire et stockage) ; retourne le nombre de messages supprimés"""
+        session = self.get(session_id)
+        if session is None:
+            return 0
+        self._sessions.pop(session_id)
+        self.total_bytes -= session.size_bytes
+        session.close()
+        self._remove(session_id)
+        self.counters["deleted"] += 1
+        return len(session.messages)
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def get_stats(self) -> dict:
+        self._expire()
+        return {
+            "backend": "memory",
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "idle_ttl_seconds": self.idle_ttl,
+            **self.counters
+        }
+
+class SQLiteConversationStore(MemoryConversationStore):
+    """Sessions chaudes en mémoire, sessions froides dans SQLite (rechargées à la demande) ;
+    les messages sont écrits en différé, par lots, dans un thread"""
+
+    def __init__(self, path: str, flush_interval: float, flush_batch: int, **limits):
+        super().__init__(**limits)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._pending_messages = []  # (session_id, seq, role, content, at)
+        self._pending_sessions = {}  # session_id -> (résumé, messages résumés)
+        self._flush_task = None
+        self._removals = 0
+        self.counters.update({"loaded": 0, "spilled": 0, "flushes": 0, "rows_written": 0})
+
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS conversation_messages (
+                session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, at REAL NOT NULL,
+                PRIMARY KEY (session_id, seq))""")
+            # Base créée avant l'horodatage des messages : colonne ajoutée, les anciens messages
+            # (at NULL) sont datés au moment de leur rechargement
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(conversation_messages)")}
+            if "at" not in columns:
+                self._db.execute("ALTER TABLE conversation_messages ADD COLUMN at REAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS conversation_sessions (
+                session_id TEXT PRIMARY KEY, summary TEXT NOT NULL, summarized_messages INTEGER NOT NULL, updated_at REAL NOT NULL)""")
+
+    def _persist(self, session: ConversationSession, turn: ConversationTurn):
+        self._pending_messages.append((session.session_id, len(session.messages) - 1, turn.role, turn.content, turn.at))
+        if len(self._pending_messages) >= self.flush_batch and not self._flush_task:
+            # Pas de boucle de vidage (hors serveur) : écriture immédiate du lot
+            self.flush()
+
+    def _spill(self, session: ConversationSession):
+        self._pending_sessions[session.session_id] = (session.context.summary, session.context.summarized_messages)
+        self.counters["spilled"] += 1
+
+    def _load(self, session_id: str) -> Optional[ConversationSession]:
+        # Les écritures différées de cette session doivent être sur disque avant la relecture
+        if session_id in self._pending_sessions or any(row[0] == session_id for row in self._pending_messages):
+            self.flush()
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT role, content, at FROM conversation_messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+            meta = self._db.execute(
+                "SELECT summary, summarized_messages FROM conversation_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        if not rows:
+            return None
+
+        summary, summarized_messages = meta if meta else ("", 0)
+        self.counters["loaded"] += 1
+        print(f"📂 Conversation rechargée depuis SQLite: {session_id} ({len(rows)} messages)")
+        return ConversationSession(session_id, rows, summary, summarized_messages)
+
+    def _remove(self, session_id: str):
+        # Même verrou que flush : un lot déjà retiré de la file est écrit avant la suppression, jamais après
+        with self._db_lock, self._db:
+            self._removals += 1
+            self._pending_messages = [row for row in self._pending_messages if row[0] != session_id]
+            self._pending_sessions.pop(session_id, None)
+            self._db.execute("DELETE FROM conversation_messages WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM conversation_sessions WHERE session_id = ?", (session_id,))
+
+    async def preload(self, session_id: str, create: bool = False) -> Optional[ConversationSession]:
+        if session_id not in self._sessions:
+            removals = self._removals
+            session = await asyncio.to_thread(self._load, session_id)
+            # Session rechargée entre-temps par un accès synchrone, ou supprimée pendant la lecture : résultat ignoré
+            if session is not None and session_id not in self._sessions and removals == self._removals:
+                self._install(session_id, session)
+        # Stockage déjà consulté : plus aucun accès disque sur la boucle
+        return self.get(session_id, create, load=False)
+
+    def flush(self):
+        """Écrit les messages et résumés en attente en une transaction"""
+        if not self._pending_messages and not self._pending_sessions:
+            return
+        now = time.time()
+        with self._db_lock:
+            messages, self._pending_messages = self._pending_messages, []
+            sessions, self._pending_sessions = self._pending_sessions, {}
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO conversation_messages VALUES (?, ?, ?, ?, ?)", messages)
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO conversation_sessions VALUES (?, ?, ?, ?)",
+                        [(session_id, summary, summarized, now) for session_id, (summary, summarized) in sessions.items()]
+                    )
+            except Exception:
+                # Transaction annulée (base verrouillée, disque plein...) : le lot repasse en tête de file
+                # pour le prochain vidage ; un résumé plus récent de la même session reste prioritaire
+                self._pending_messages[:0] = messages
+                for session_id, pending in sessions.items():
+                    self._pending_sessions.setdefault(session_id, pending)
+                raise
+        self.counters["flushes"] += 1
+        self.counters["rows_written"] += len(messages) + len(sessions)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                print(f"⚠️ Écriture des conversations dans SQLite impossible: {e}")
+
+    def start(self):
+        """Lance l'écriture différée périodique"""
+        if not self._flush_task:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Arrêt : résumés des sessions chaudes et messages en attente écrits sur disque"""
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        for session in self._sessions.values():
+            self._spill(session)
+        self.flush()
+        self._db.close()
+
+    def get_stats(self) -> dict:
+        return {
+            **super().get_stats(),
+            "backend": "sqlite",
+            "path": self.path,
+            "pending_writes": len(self._pending_messages) + len(self._pending_sessions)
+        }
+
+def create_conversation_store() -> MemoryConversationStore:
+    """Stockage des conversations selon CONVERSATION_STORE_BACKEND (memory ou sqlite)"""
+    limits = {
+        "max_sessions": int(os.getenv("CONVERSATION_MAX_SESSIONS", "5000")),
+        "max_bytes": int(os.getenv("CONVERSATION_MAX_BYTES", str(64 * 1024 * 1024))),
+        "idle_ttl": float(os.getenv("CONVERSATION_IDLE_TTL_SECONDS", "3600"))
+    }
+    if os.getenv("CONVERSATION_STORE_BACKEND", "memory").lower() == "sqlite":
+        return SQLiteConversationStore(
+            path=os.getenv("CONVERSATION_DB_PATH", "conversations.db"),
+            flush_interval=float(os.getenv("CONVERSATION_FLUSH_INTERVAL", "1.0")),
+            flush_batch=int(os.getenv("CONVERSATION_FLUSH_BATCH", "200")),
+            **limits
+        )
+    return MemoryConversationStore(**limits)
+
+conversation_store = create_conversation_store()
+
+def remember_message(session_id: str, role: str, content: str, expertise: Optional[str] = None) -> ConversationSession:
+    """Ajoute un message à l'historique complet et au contexte de prompt de la session"""
+    session = conversation_store.append(session_id, role, content)
+    schedule_context_summary(session_id, session.context, expertise)
+    return session
+
+# ================================
+# 💾 CACHE DES RÉPONSES IA - PROMPT NORMALISÉ + MINHASH/LSH
+# ================================
+
+# Remplace le prénom de l'utilisateur dans les réponses en cache (réinjecté à la lecture)
+RESPONSE_CACHE_NAME_PLACEHOLDER = "⟨prénom⟩"
+
+# Prompts déclenchant une action (image, recherche...) : jamais servis depuis le cache
+RESPONSE_CACHE_EXCLUDED_CATEGORIES = (
+    "action:image_generation", "search", "profile", "action:event_creation", "action:social_post"
+)
+
+def normalize_prompt(text: str) -> str:
+    """Forme canonique d'un prompt : minuscules, sans accents, ponctuation ni emojis"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char if char.isalnum() and char.isascii() else " " for char in text if not unicodedata.combining(char))
+    return " ".join(text.split())
+
+class ResponseCache:
+    """Cache des réponses du coach : correspondance exacte sur le prompt normalisé,
+    puis quasi-doublons via signatures MinHash indexées par LSH (bandes de `rows` valeurs).
+    Le périmètre (expertise, type de réponse, sujet, premier message) fait partie de la clé ;
+    expiration TTL et éviction LRU"""
+
+    MERSENNE_PRIME = (1 << 61) - 1
+
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity: float,
+                 num_perm: int, rows: int, shingle_size: int, max_prompt_chars: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.num_perm = num_perm
+        self.rows = rows
+        self.bands = num_perm // rows
+        self.shingle_size = shingle_size
+        self.max_prompt_chars = max_prompt_chars
+
+        # Permutations (a*x + b) mod p déterministes : signatures stables d'un démarrage à l'autre
+        rng = random.Random(1)
+        self._permutations = [
+            (rng.randrange(1, self.MERSENNE_PRIME), rng.randrange(0, self.MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
 
-    return suggestions.get(expertise, [
-        "Image personnalisée selon vos goûts",
-        "Illustration de votre conversation",
-        "Création artistique unique",
-        "Design adapté à vos besoins"
-    ])
+        # clé -> entrée ; bucket LSH -> clés
+        self._entries = OrderedDict()
+        self._buckets = {}
+
+        self.counters = {
+            "lookups": 0,
+            "exact_hits": 0,
+            "near_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expired": 0
+        }
+        self.saved_cost = 0.0
+        self.saved_seconds = 0.0
+        self.lookup_seconds = 0.0
+
+    def _shingles(self, normalized: str) -> set:
+        size = self.shingle_size
+        if len(normalized) <= size:
+            return {normalized}
+        return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+    def signature(self, normalized: str) -> tuple:
+        """Signature MinHash des n-grammes de caractères du prompt normalisé"""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for shingle in self._shingles(normalized)
+        ]
+        prime = self.MERSENNE_PRIME
+        return tuple(min((a * h + b) % prime for h in hashes) for a, b in self._permutations)
 
-async def ia_coach_response(user_prompt: str, session_id: str = "default", expertise: str = None, user_name: str = None) -> tuple[str, dict]:
-    """IA Coach spécialisée avec mémoire conversationnelle complète jusqu'au reset"""
+    def _band_keys(self, scope: tuple, signature: tuple) -> list:
+        return [
+            (scope, band, signature[band * self.rows:(band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
 
-    # Gestion de la mémoire conversationnelle complète
-    if session_id not in conversation_memory:
-        conversation_memory[session_id] = []
-        print(f"🆕 Nouvelle session créée: {session_id}")
+    @staticmethod
+    def get_scope(turn: dict) -> tuple:
+        return (turn["expertise"] or "default", turn["response_type"], turn["topic_detected"], turn["is_first_turn"])
+
+    def is_cacheable(self, turn: dict) -> bool:
+        """Cache activé pour cette expertise et prompt court sans action associée"""
+        if not RESPONSE_CACHE_EXPERTISES.get(turn["expertise"] or "default", False):
+            return False
+        if len(turn["user_prompt"]) > self.max_prompt_chars:
+            return False
+        matches = keyword_matcher.scan(turn["user_prompt"])
+        return not any(matches.has(category) for category in RESPONSE_CACHE_EXCLUDED_CATEGORIES)
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key)
+        for band_key in self._band_keys(key[0], entry["signature"]):
+            bucket = self._buckets.get(band_key)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _is_expired(self, entry: dict, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry["created_at"] > self.ttl_seconds
+
+    def _find(self, scope: tuple, normalized: str, now: float) -> tuple[Optional[tuple], float]:
+        key = (scope, normalized)
+        entry = self._entries.get(key)
+        if entry:
+            if not self._is_expired(entry, now):
+                return key, 1.0
+            self._remove(key)
+            self.counters["expired"] += 1
+
+        # Quasi-doublons : candidats partageant au moins une bande LSH
+        signature = self.signature(normalized)
+        candidates = set()
+        for band_key in self._band_keys(scope, signature):
+            candidates.update(self._buckets.get(band_key, ()))
+
+        best_key, best_similarity = None, 0.0
+        for candidate in candidates:
+            entry = self._entries[candidate]
+            if self._is_expired(entry, now):
+                self._remove(candidate)
+                self.counters["expired"] += 1
+                continue
+            similarity = sum(x == y for x, y in zip(signature, entry["signature"])) / self.num_perm
+            if similarity > best_similarity:
+                best_key, best_similarity = candidate, similarity
+
+        if best_similarity >= self.similarity:
+            return best_key, best_similarity
+        return None, best_similarity
+
+    def get(self, turn: dict) -> Optional[dict]:
+        """Réponse en cache pour ce tour (prénom réinjecté), ou None"""
+        started = time.perf_counter()
+        self.counters["lookups"] += 1
+        key, similarity = self._find(self.get_scope(turn), normalize_prompt(turn["user_prompt"]), time.time())
+
+        if key is None:
+            self.counters["misses"] += 1
+            self.lookup_seconds += time.perf_counter() - started
+            return None
+
+        self._entries.move_to_end(key)
+        entry = self._entries[key]
+        entry["hits"] += 1
+        self.counters["exact_hits" if similarity == 1.0 else "near_hits"] += 1
+        self.saved_cost += entry["cost"]
+        self.saved_seconds += entry["generation_seconds"]
+
+        user_name = turn["user_name"]
+        response = entry["response"]
+        if user_name:
+            response = response.replace(RESPONSE_CACHE_NAME_PLACEHOLDER, user_name)
+        else:
+            response = response.replace(f" {RESPONSE_CACHE_NAME_PLACEHOLDER}", "").replace(RESPONSE_CACHE_NAME_PLACEHOLDER, "")
 
-    # Ajouter le message utilisateur à l'historique
-    conversation_memory[session_id].append({"role": "user", "content": user_prompt})
+        self.lookup_seconds += time.perf_counter() - started
+        return {
+            "response": response,
+            "service_used": entry["service_used"],
+            "similarity": round(similarity, 3),
+            "cached_prompt": key[1]
+        }
 
-    # Pas de limite sur l'historique - on garde tout jusqu'au reset
-    conversation_length = len(conversation_memory[session_id])
-    print(f"💬 Conversation: {conversation_length} messages | Session: {session_id}")
+    def put(self, turn: dict, response: str, service_used: str, cost: float, generation_seconds: float):
+        """Enregistre la réponse finale d'un tour (prénom remplacé par un marqueur)"""
+        if not response or service_used == "error":
+            return
 
-    # Détection de questions simples pour réponses courtes
-    simple_questions = [
-        "bonjour", "salut", "hello", "coucou", "bonsoir",
-        "comment ça va", "comment vas-tu", "ça va", "comment allez-vous",
-        "quelle heure", "quel jour", "quelle date",
-        "merci", "au revoir", "à bientôt", "bye"
-    ]
+        scope = self.get_scope(turn)
+        normalized = normalize_prompt(turn["user_prompt"])
+        key = (scope, normalized)
+        if key in self._entries:
+            self._remove(key)
 
-    # Détection de demandes d'explications détaillées
-    detailed_requests = [
-        "explique", "détaille", "développe", "peux-tu expliquer", "comment faire",
-        "dis-moi plus", "raconte-moi", "j'aimerais savoir", "peux-tu me dire",
-        "comment ça marche", "pourquoi", "donne-moi des conseils", "aide-moi",
-        "j'ai besoin", "peux-tu m'aider", "comment puis-je", "que faire"
-    ]
+        if turn["user_name"]:
+            response = re.sub(rf"\b{re.escape(turn['user_name'])}\b", RESPONSE_CACHE_NAME_PLACEHOLDER, response)
 
-    # Détection des sujets de spécialité
-    confidence_keywords = ["confiance", "estime de soi", "complexe", "timide", "sûr de moi"]
-    dating_keywords = ["rendez-vous", "premier rendez", "date", "sortir avec", "rencontrer"]
-    social_keywords = ["stress social", "anxiété sociale", "timidité", "parler en public", "groupe"]
-    communication_keywords = ["communication", "parler", "écouter", "conversation", "charisme"]
-    personal_dev_keywords = ["développement personnel", "motivation", "objectifs", "habitudes", "croissance", "bien-être", "bien-etre", "épanouissement", "epanouissement", "réussir", "améliorer ma vie", "changer ma vie", "personnel", "développement", "développer"]
-
-    # Sujets prioritaires sans limite de caractères
-    priority_topics = ["confiance", "rendez-vous", "stress_social", "communication"]
-
-    # Détection du sujet principal
-    topic_detected = None
-    if any(keyword in user_prompt.lower() for keyword in confidence_keywords):
-        topic_detected = "confiance"
-    elif any(keyword in user_prompt.lower() for keyword in dating_keywords):
-        topic_detected = "rendez-vous"
-    elif any(keyword in user_prompt.lower() for keyword in social_keywords):
-        topic_detected = "stress_social"
-    elif any(keyword in user_prompt.lower() for keyword in communication_keywords):
-        topic_detected = "communication"
-    elif any(keyword in user_prompt.lower() for keyword in personal_dev_keywords):
-        topic_detected = "developpement_personnel"
-
-    is_simple_question = any(simple in user_prompt.lower() for simple in simple_questions)
-    wants_detailed_explanation = any(detail in user_prompt.lower() for detail in detailed_requests)
-
-    # Historique de conversation complet pour le contexte
-    conversation_context = ""
-    if len(conversation_memory[session_id]) > 1:
-        # Prendre TOUS les messages précédents (pas de limite)
-        all_messages = conversation_memory[session_id][:-1]  # Tous sauf le message actuel
-        conversation_context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in all_messages])
-        print(f"📚 Contexte historique: {len(all_messages)} messages précédents")
+        entry = {
+            "response": response,
+            "service_used": service_used,
+            "cost": cost,
+            "generation_seconds": generation_seconds,
+            "signature": self.signature(normalized),
+            "created_at": time.time(),
+            "hits": 0
+        }
+        self._entries[key] = entry
+        for band_key in self._band_keys(scope, entry["signature"]):
+            self._buckets.setdefault(band_key, set()).add(key)
+        self.counters["stores"] += 1
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.counters["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        hits = self.counters["exact_hits"] + self.counters["near_hits"]
+        lookups = self.counters["lookups"]
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "expertises": [expertise for expertise, enabled in RESPONSE_CACHE_EXPERTISES.items() if enabled],
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            **self.counters,
+            "saved_cost": round(self.saved_cost, 6),
+            "saved_generation_seconds": round(self.saved_seconds, 1),
+            "avg_lookup_ms": round(self.lookup_seconds / lookups * 1000, 3) if lookups else 0.0
+        }
+
+# Cache des réponses (désactivé par défaut) et activation par expertise
+RESPONSE_CACHE_ENABLED = os.getenv("AI_RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_EXPERTISES = {
+    expertise: os.getenv(f"AI_RESPONSE_CACHE_{expertise.upper()}", "true").lower() == "true"
+    for expertise in EXPERTISE_AI_MAPPING
+}
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("AI_RESPONSE_CACHE_MAX_ENTRIES", "2000")),
+    ttl_seconds=float(os.getenv("AI_RESPONSE_CACHE_TTL_SECONDS", "86400")),
+    similarity=float(os.getenv("AI_RESPONSE_CACHE_SIMILARITY", "0.8")),
+    num_perm=int(os.getenv("AI_RESPONSE_CACHE_NUM_PERM", "64")),
+    rows=int(os.getenv("AI_RESPONSE_CACHE_LSH_ROWS", "4")),
+    shingle_size=int(os.getenv("AI_RESPONSE_CACHE_SHINGLE_SIZE", "3")),
+    max_prompt_chars=int(os.getenv("AI_RESPONSE_CACHE_MAX_PROMPT_CHARS", "200"))
+)
+
+def get_cached_ia_response(turn: dict) -> Optional[dict]:
+    """Réponse du cache pour ce tour si le cache est actif pour son expertise"""
+    if not RESPONSE_CACHE_ENABLED or not response_cache.is_cacheable(turn):
+        return None
+
+    cached = response_cache.get(turn)
+    if cached:
+        print(f"💾 Réponse servie depuis le cache (similarité {cached['similarity']:.2f}): {cached['cached_prompt'][:50]}")
+    return cached
+
+def store_ia_response(turn: dict, response: str, service_used: str, generation_seconds: float, usage: Optional[dict]):
+    """Met en cache la réponse finale d'un tour généré par une IA (avec son coût réel)"""
+    if not RESPONSE_CACHE_ENABLED or not response_cache.is_cacheable(turn):
+        return
+
+    cost = usage["cost"] if usage else 0.0
+    response_cache.put(turn, response, service_used, cost, generation_seconds)
+
+async def prepare_ia_coach_turn(user_prompt: str, session_id: str = "default", expertise: str = None, user_name: str = None) -> dict:
+    """Prépare un tour de l'IA Coach : mémoire, détection du sujet, prompt système et IA à utiliser"""
+
+    # Gestion de la mémoire conversationnelle complète (rechargée depuis le stockage si besoin)
+    session = await conversation_store.preload(session_id, create=True)
+    if not session.messages:
+        print(f"🆕 Nouvelle session créée: {session_id}")
+
+    # Contexte des messages précédents : résumé + fenêtre récente sous le budget de tokens
+    context = session.context
+    conversation_context = context.render()
+    if conversation_context:
+        print(f"📚 Contexte historique: {len(context.recent)} messages récents ({context.recent_tokens} tokens)"
+              f"{f' + résumé de {context.summarized_messages + len(context.pending)} messages' if context.summary or context.pending else ''}")
+
+    # Ajouter le message utilisateur à l'historique (complet jusqu'au reset)
+    session = remember_message(session_id, "user", user_prompt, expertise)
+    conversation_length = len(session.messages)
+    print(f"💬 Conversation: {conversation_length} messages | Session: {session_id}")
+
+    # Sujet, question simple, demande détaillée et salutation (mots-clés)
+    prompt_analysis = analyze_coach_prompt(user_prompt)
+    topic_detected = prompt_analysis["topic_detected"]
+    is_simple_question = prompt_analysis["is_simple_question"]
+    wants_detailed_explanation = prompt_analysis["wants_detailed_explanation"]
 
     # Analyse multi-phrases intelligente (jusqu'à 5 phrases)
     multi_analysis = analyze_multi_sentence_context(user_prompt)
@@ -1233,9 +4824,8 @@ async def ia_coach_response(user_prompt: str, session_id: str = "default", exper
         print(f"🔍 Contexte: {', '.join(multi_analysis['context_clues'])}")
 
     # Détection du contexte de salutation
-    greeting_words = ["salut", "bonjour", "hello", "coucou", "bonsoir", "hey", "hi"]
-    user_greeted = any(greeting in user_prompt.lower() for greeting in greeting_words)
-    is_first_message = len(conversation_memory[session_id]) <= 1  # Seulement le message actuel
+    user_greeted = prompt_analysis["user_greeted"]
+    is_first_message = conversation_length <= 1  # Seulement le message actuel
 
     # Instructions spéciales pour les salutations
     greeting_instruction = ""
@@ -1245,178 +4835,207 @@ async def ia_coach_response(user_prompt: str, session_id: str = "default", exper
         greeting_instruction = "INTERDICTION ABSOLUE: L'utilisateur te salue à nouveau mais vous êtes déjà en conversation. Ne commence PAS ta réponse par 'Bonjour !', 'Salut !' ou toute salutation. Réponds directement à sa demande sans répéter sa salutation."
     elif not user_greeted:
         greeting_instruction = "RÈGLE: L'utilisateur pose directement une question. Réponds directement à sa question sans aucune salutation."
-    expertise_focus = ""
-    if expertise == "psychology":
-        expertise_focus = "EXPERTISE RENFORCÉE: Psychologie, thérapie comportementale, développement personnel"
-    elif expertise == "sexology":
-        expertise_focus = "EXPERTISE RENFORCÉE: Sexologie, éducation sexuelle, intimité et bien-être sexuel"
-    elif expertise == "seduction":
-        expertise_focus = "EXPERTISE RENFORCÉE: Séduction, charisme, techniques de drague et attraction"
-    elif expertise == "development":
-        expertise_focus = "EXPERTISE RENFORCÉE: Développement personnel, motivation, objectifs et croissance"
-    elif expertise == "amical":
-        expertise_focus = """MODE AMICAL:
-- Réponses COURTES et naturelles (maximum 2-3 phrases)
-- Ton décontracté comme un ami proche
-- Évite les répétitions du prénom
-- Sois chaleureux mais concis"""
 
     # Utilisation des prompts spécialisés si activés
-    if os.getenv("ENABLE_SPECIALIZED_PROMPTS", "true").lower() == "true":
-        specialized_system = get_specialized_prompt_system(expertise, user_name)
+    specialized = os.getenv("ENABLE_SPECIALIZED_PROMPTS", "true").lower() == "true"
+    if specialized:
         print(f"🎯 Prompt spécialisé activé pour {expertise}")
-    else:
-        specialized_system = f"""Tu es un IA Coach expert en séduction, sexologie et psychologie. Tu es un ami bienveillant.
-PERSONNALITÉ: Chaleureux, empathique, sans jugement, expert relations/sexualité.
-{expertise_focus}"""
 
-    # Système prompt avec spécialisation
-    system_prompt = f"""{specialized_system}
+    # Système prompt : partie statique compilée une fois, seuls les champs du tour sont insérés
+    template = system_prompt_templates.get(expertise, user_name, specialized, is_simple_question, wants_detailed_explanation)
+    system_prompt = assemble_system_prompt(template, topic_detected, greeting_instruction, conversation_context, user_prompt)
 
-SUJETS DE SPÉCIALITÉ (reconnais ces thèmes et adapte tes réponses):
-💙 CONFIANCE EN SOI: Techniques d'estime de soi, affirmation personnelle, surmonter les complexes
-🗓️ PREMIER RENDEZ-VOUS: Comportement, conversation, gestion du stress, faire bonne impression
-👥 STRESS SOCIAL: Anxiété sociale, timidité, prise de parole, interactions sociales
-💬 COMMUNICATION: Écoute active, expression des émotions, langage corporel, charisme
-🌟 DÉVELOPPEMENT PERSONNEL: Motivation, objectifs, habitudes, croissance personnelle, bien-être
-😊 MODE AMICAL: Conversations décontractées, conseils bienveillants, écoute amicale
+    # Classe de réponse décidée avant l'appel : longueur, max_tokens et séquences d'arrêt
+    response_class = get_response_class(expertise, topic_detected, is_simple_question, wants_detailed_explanation)
+    generation_budget = get_generation_budget(response_class)
+    max_response_length = generation_budget["max_chars"]
+    if response_class == "amical":
+        print(f"😊 Mode amical détecté - Réponses courtes (max {max_response_length} chars)")
+    elif response_class == "priority":
+        print(f"🎯 Sujet prioritaire détecté ({topic_detected}) - AUCUNE LIMITE de caractères")
 
-STYLE DE RÉPONSE:
-{
-    "- RÉPONSE COURTE (1-2 phrases max) pour cette question simple" if is_simple_question
-    else "- RÉPONSE DÉTAILLÉE avec explications complètes, exemples et conseils pratiques" if wants_detailed_explanation
-    else "- Réponse COMPLÈTE mais concise (300-500 caractères) avec conseils utiles"
-}
-- Conversationnel et naturel
-- RÈGLE ABSOLUE: Ne salue (Salut/Bonjour) que si l'utilisateur salue ET que c'est le début de conversation
-- Si l'utilisateur pose directement une question, réponds directement sans aucune salutation
-- En cours de conversation, ne répète JAMAIS de salutation même si l'utilisateur re-salue
-- Ne commence JAMAIS ta réponse par "Bonjour !" ou "Salut !" si vous êtes déjà en conversation
-- Utilise le contexte de la conversation précédente pour maintenir la fluidité
-- Aucun tabou sur la sexualité (éducatif et respectueux)
-- DONNE des conseils CONCRETS et UTILES
-{"- DÉVELOPPE en détail avec exemples et conseils pratiques" if wants_detailed_explanation else "- EXPLIQUE suffisamment pour être utile, propose d'expliquer plus si besoin"}
+    # Sélection de la meilleure IA selon l'expertise (coût maximal de l'appel réservé sur le budget)
+    budget_reservation = {"prompt": system_prompt, "generation_budget": generation_budget}
+    best_ai = await get_best_ai_for_expertise(expertise, topic_detected, budget_reservation)
 
-{f"🎯 SUJET DÉTECTÉ: {topic_detected.upper()} - Adapte ta réponse à ce domaine spécifique" if topic_detected else ""}
+    return {
+        "user_prompt": user_prompt,
+        "session_id": session_id,
+        "expertise": expertise,
+        "user_name": user_name,
+        "system_prompt": system_prompt,
+        "best_ai": best_ai,
+        "topic_detected": topic_detected,
+        "is_simple_question": is_simple_question,
+        "wants_detailed_explanation": wants_detailed_explanation,
+        "response_type": "simple" if is_simple_question else "detailed" if wants_detailed_explanation else "short",
+        "is_first_turn": is_first_message,
+        "response_class": response_class,
+        "generation_budget": generation_budget,
+        "budget_reservation": budget_reservation,
+        "max_response_length": max_response_length
+    }
 
-{f"INSTRUCTION SALUTATION: {greeting_instruction}" if greeting_instruction else ""}
+def truncate_ia_response(response: str, max_response_length: Optional[int]) -> str:
+    """Troncature intelligente : s'arrêter à la fin d'une phrase (sauf sujets prioritaires)"""
+    if not max_response_length or len(response) <= max_response_length:
+        return response
 
-{f"CONTEXTE CONVERSATION RÉCENTE:\\n{conversation_context}\\n" if conversation_context else ""}
+    # Chercher la dernière phrase complète dans la limite
+    truncated = response[:max_response_length]
 
-HEURE: {datetime.now().strftime('%H:%M')} | DATE: {datetime.now().strftime('%d/%m/%Y')}
+    # Chercher le dernier point, point d'exclamation ou point d'interrogation
+    last_sentence_end = max(
+        truncated.rfind('.'),
+        truncated.rfind('!'),
+        truncated.rfind('?')
+    )
 
-UTILISATEUR: {user_prompt}
+    if last_sentence_end > max_response_length // 2:  # Si on trouve une phrase pas trop courte
+        response = truncated[:last_sentence_end + 1]
+        print(f"✂️ Réponse coupée à la fin d'une phrase ({len(response)} chars)")
+    else:
+        # Fallback : couper au dernier mot + "..."
+        response = truncated.rsplit(' ', 1)[0] + "..."
+        print(f"⚠️ Réponse tronquée au dernier mot ({len(response)} chars)")
+
+    return response
+
+async def finalize_ia_coach_turn(turn: dict, response: str, service_used: str,
+                                 cached: Optional[dict] = None, usage: Optional[dict] = None) -> tuple[str, dict]:
+    """Termine un tour de l'IA Coach une fois la réponse complète : coût (usage réel de l'IA), longueur,
+    mémoire, actions (réponse issue du cache : aucun coût)"""
+    user_prompt = turn["user_prompt"]
+    session_id = turn["session_id"]
+    expertise = turn["expertise"]
+    user_name = turn["user_name"]
+    topic_detected = turn["topic_detected"]
+    is_simple_question = turn["is_simple_question"]
+    wants_detailed_explanation = turn["wants_detailed_explanation"]
+
+    # Tracking du coût de la génération (prompt complet + réponse, avant troncature)
+    usage_entry = None
+    if not cached and usage:
+        usage_entry = await record_ai_usage(expertise, session_id, service_used, usage, turn["budget_reservation"])
+
+    # Troncature : filet de sécurité (la longueur est déjà bornée par max_tokens et les séquences d'arrêt)
+    generated_chars = len(response)
+    response = truncate_ia_response(response, turn["max_response_length"])
+    generation = None
+    if not cached and usage:
+        generation = {
+            "response_class": turn["response_class"],
+            "max_tokens": usage.get("max_tokens"),
+            "truncated": len(response) < generated_chars,
+            "wasted_tokens": generation_budgets.record(
+                turn["response_class"], usage.get("max_tokens"), usage_entry["completion_tokens"], generated_chars, len(response)
+            )
+        }
 
-{"Réponds de manière courte et naturelle." if is_simple_question else "Réponds de manière empathique et détaillée."}"""
+    print(f"📏 Type: {'Simple' if is_simple_question else 'Détaillée' if wants_detailed_explanation else 'Courte'} | Longueur: {len(response)} chars")
 
-    try:
-        # Sélection de la meilleure IA selon l'expertise
-        best_ai = get_best_ai_for_expertise(expertise, topic_detected)
-
-        # Génération avec l'IA optimale pour cette expertise
-        response, service_used = await generate_with_best_ai(system_prompt, best_ai)
-
-        # Tracking du coût de la génération
-        estimated_tokens = len(response) * 1.3  # Approximation tokens
-        add_cost(expertise, service_used, int(estimated_tokens))
-
-        # Limitation de la longueur selon le type de demande et l'expertise
-        if expertise == "amical":
-            MAX_RESPONSE_LENGTH = 200  # Mode amical = réponses TRÈS courtes
-            print(f"😊 Mode amical détecté - Réponses courtes (max {MAX_RESPONSE_LENGTH} chars)")
-        elif topic_detected in priority_topics:
-            MAX_RESPONSE_LENGTH = None  # Aucune limite pour les sujets prioritaires
-            print(f"🎯 Sujet prioritaire détecté ({topic_detected}) - AUCUNE LIMITE de caractères")
-        elif is_simple_question:
-            MAX_RESPONSE_LENGTH = 300  # Court pour questions simples
-        elif wants_detailed_explanation:
-            MAX_RESPONSE_LENGTH = 2000  # Très long pour explications détaillées
-        else:
-            MAX_RESPONSE_LENGTH = 800  # Moyen par défaut (doublé)
-
-        # Troncature intelligente : s'arrêter à la fin d'une phrase (sauf sujets prioritaires)
-        if MAX_RESPONSE_LENGTH and len(response) > MAX_RESPONSE_LENGTH:
-            # Chercher la dernière phrase complète dans la limite
-            truncated = response[:MAX_RESPONSE_LENGTH]
-
-            # Chercher le dernier point, point d'exclamation ou point d'interrogation
-            last_sentence_end = max(
-                truncated.rfind('.'),
-                truncated.rfind('!'),
-                truncated.rfind('?')
-            )
+    # Déterminer la voix recommandée selon l'expertise/sujet
+    recommended_voice = get_voice_for_expertise(expertise, topic_detected)
 
-            if last_sentence_end > MAX_RESPONSE_LENGTH // 2:  # Si on trouve une phrase pas trop courte
-                response = truncated[:last_sentence_end + 1]
-                print(f"✂️ Réponse coupée à la fin d'une phrase ({len(response)} chars)")
-            else:
-                # Fallback : couper au dernier mot + "..."
-                response = truncated.rsplit(' ', 1)[0] + "..."
-                print(f"⚠️ Réponse tronquée au dernier mot ({len(response)} chars)")
+    # Sauvegarder la réponse de l'IA dans la mémoire conversationnelle
+    # (session éventuellement évincée pendant la génération : rechargée hors de la boucle)
+    await conversation_store.preload(session_id, create=True)
+    conversation_length = len(remember_message(session_id, "assistant", response, expertise).messages)
+    print(f"💾 Réponse sauvegardée | Total conversation: {conversation_length} messages")
 
-        print(f"📏 Type: {'Simple' if is_simple_question else 'Détaillée' if wants_detailed_explanation else 'Courte'} | Longueur: {len(response)} chars")
+    # Dépense du mois de l'expertise (tous workers confondus)
+    current_cost = await asyncio.to_thread(cost_ledger.get_spent, expertise or "default")
 
-        # Déterminer la voix recommandée selon l'expertise/sujet
-        recommended_voice = get_voice_for_expertise(expertise, topic_detected)
+    # Analyse des actions à effectuer
+    actions_performed = {}
 
-        # Sauvegarder la réponse de l'IA dans la mémoire conversationnelle
-        conversation_memory[session_id].append({"role": "assistant", "content": response})
-        print(f"💾 Réponse sauvegardée | Total conversation: {len(conversation_memory[session_id])} messages")
+    # Détection d'actions dans la réponse (simulation)
+    matches = keyword_matcher.scan(user_prompt)
+    if matches.has("action:profile_update"):
+        actions_performed["profile_update"] = "Action détectée mais non implémentée dans cette démo"
 
-        # Analyse des actions à effectuer
-        actions_performed = {}
+    if matches.has("action:event_creation"):
+        actions_performed["event_creation"] = "Action détectée mais non implémentée dans cette démo"
 
-        # Détection d'actions dans la réponse (simulation)
-        if "modifier profil" in user_prompt.lower() or "changer profil" in user_prompt.lower():
-            actions_performed["profile_update"] = "Action détectée mais non implémentée dans cette démo"
+    if matches.has("action:social_post"):
+        actions_performed["social_post"] = "Action détectée mais non implémentée dans cette démo"
 
-        if "créer événement" in user_prompt.lower() or "organiser" in user_prompt.lower():
-            actions_performed["event_creation"] = "Action détectée mais non implémentée dans cette démo"
+    if matches.has("search") and matches.has("profile"):
+        actions_performed["profile_search"] = "Action détectée mais non implémentée dans cette démo"
 
-        if "poster" in user_prompt.lower() or "publier" in user_prompt.lower():
-            actions_performed["social_post"] = "Action détectée mais non implémentée dans cette démo"
+    if matches.has("action:image_generation"):
+        image_result = await generate_image_deepinfra(user_prompt)
+        actions_performed["image_generation"] = image_result
 
-        if "chercher" in user_prompt.lower() and "profil" in user_prompt.lower():
-            actions_performed["profile_search"] = "Action détectée mais non implémentée dans cette démo"
+    if matches.has("action:internet_search"):
+        search_result = await search_internet(user_prompt)
+        actions_performed["internet_search"] = search_result
 
-        if "image" in user_prompt.lower() or "photo" in user_prompt.lower() or "dessiner" in user_prompt.lower():
-            image_result = await generate_image_deepinfra(user_prompt)
-            actions_performed["image_generation"] = image_result
+    return response, {
+        "service_used": service_used,
+        "actions_performed": actions_performed,
+        "conversation_length": conversation_length,
+        "is_simple_question": is_simple_question,
+        "wants_detailed_explanation": wants_detailed_explanation,
+        "budget_info": {
+            "current_cost": current_cost,
+            "budget_limit": BUDGET_LIMITS.get(expertise, 10.0),
+            "remaining": BUDGET_LIMITS.get(expertise, 10.0) - current_cost,
+            "expertise": expertise
+        },
+        "response_type": turn["response_type"],
+        "from_cache": cached is not None,
+        "cache_similarity": cached["similarity"] if cached else None,
+        "usage": {
+            "prompt_tokens": usage_entry["prompt_tokens"],
+            "completion_tokens": usage_entry["completion_tokens"],
+            "estimated": usage_entry["estimated"],
+            "cost": round(usage_entry["cost"], 6)
+        } if usage_entry else None,
+        "generation": generation,
+        "response_length": len(response),
+        "topic_detected": topic_detected,
+        "expertise": expertise,
+        "user_name": user_name,
+        "personalized": user_name is not None,
+        "recommended_voice": recommended_voice,
+        "best_ai_used": service_used,
+        "max_words_limit": int(os.getenv("RESPONSE_MAX_WORDS", "500")),
+        "timestamp": datetime.now().isoformat()
+    }
 
-        if "rechercher" in user_prompt.lower() or "chercher sur internet" in user_prompt.lower():
-            search_result = await search_internet(user_prompt)
-            actions_performed["internet_search"] = search_result
+async def record_ia_coach_error(session_id: str, error: Exception) -> tuple[str, dict]:
+    """Réponse d'erreur de l'IA Coach (également sauvegardée dans la conversation)"""
+    error_msg = f"❌ Désolé, je rencontre un problème technique: {str(error)}"
+    if await conversation_store.preload(session_id):
+        remember_message(session_id, "assistant", error_msg)
+    return error_msg, {"error": str(error)}
 
-        return response, {
-            "service_used": service_used,
-            "actions_performed": actions_performed,
-            "conversation_length": len(conversation_memory[session_id]),
-            "is_simple_question": is_simple_question,
-            "wants_detailed_explanation": wants_detailed_explanation,
-            "budget_info": {
-                "current_cost": cost_tracker.get(expertise, 0.0),
-                "budget_limit": BUDGET_LIMITS.get(expertise, 10.0),
-                "remaining": BUDGET_LIMITS.get(expertise, 10.0) - cost_tracker.get(expertise, 0.0),
-                "expertise": expertise
-            },
-            "response_type": "simple" if is_simple_question else "detailed" if wants_detailed_explanation else "short",
-            "response_length": len(response),
-            "topic_detected": topic_detected,
-            "expertise": expertise,
-            "user_name": user_name,
-            "personalized": user_name is not None,
-            "recommended_voice": recommended_voice,
-            "best_ai_used": service_used,
-            "max_words_limit": int(os.getenv("RESPONSE_MAX_WORDS", "500")),
-            "timestamp": datetime.now().isoformat()
-        }
+async def ia_coach_response(user_prompt: str, session_id: str = "default", expertise: str = None, user_name: str = None) -> tuple[str, dict]:
+    """IA Coach spécialisée avec mémoire conversationnelle complète jusqu'au reset
+    (un tour à la fois par session : SessionBusy si trop de messages sont déjà en attente)"""
+    async with conversation_locks.hold(session_id):
+        turn = await prepare_ia_coach_turn(user_prompt, session_id, expertise, user_name)
 
-    except Exception as e:
-        error_msg = f"❌ Désolé, je rencontre un problème technique: {str(e)}"
-        # Sauvegarder l'erreur dans la conversation aussi
-        if session_id in conversation_memory:
-            conversation_memory[session_id].append({"role": "assistant", "content": error_msg})
-        return error_msg, {"error": str(e)}
+        try:
+            cached = get_cached_ia_response(turn)
+            if cached:
+                return await finalize_ia_coach_turn(turn, cached["response"], cached["service_used"], cached)
+
+            # Génération avec l'IA optimale pour cette expertise
+            started = time.monotonic()
+            usage = {}
+            response, service_used = await generate_with_best_ai(turn["system_prompt"], turn["best_ai"], usage, turn["generation_budget"])
+            response, metadata = await finalize_ia_coach_turn(turn, response, service_used, usage=usage)
+            store_ia_response(turn, response, service_used, time.monotonic() - started, metadata["usage"])
+            return response, metadata
+
+        except Exception as e:
+            return await record_ia_coach_error(session_id, e)
+
+        finally:
+            # Réponse en cache, erreur ou appel interrompu : réservation non soldée rendue au budget
+            await release_budget(turn["budget_reservation"])
 
 @app.get("/")
 async def root():
@@ -1435,6 +5054,10 @@ async def root():
             "image_suggestions": "POST /image-suggestions (suggestions d'images)",
             "webcam_analyze": "POST /webcam/analyze (analyse webcam)",
             "webcam_scores": "GET /webcam/profile-score/{user_id}",
+            "tts_stats": "GET /tts/stats (cache audio TTS)",
+            "ai_latency": "GET /ai/latency (latences IA et hedging)",
+            "ai_health": "GET /ai/health (santé et disjoncteurs des IA)",
+            "voices": "GET /voices (voix par expertise et personnage)",
             "reset": "POST /reset (reset conversation)"
         },
         "refactored": "✅ Code optimisé pour WebSocket uniquement"
@@ -1512,31 +5135,46 @@ async def get_image_suggestions_endpoint(request: ImageSuggestionsRequest):
 
 @app.get("/budget-status")
 async def get_budget_status():
-    """Consulte l'état des budgets par expertise"""
+    """Consulte l'état des budgets par expertise (vue globale de tous les workers, lue en une transaction)"""
     try:
-        reset_monthly_costs()
+        month = cost_ledger.current_month()
+        ledger_month = await asyncio.to_thread(cost_ledger.get_month, month)
 
         budget_status = {}
-        for expertise in ["psychology", "development", "sexology", "seduction", "amical", "images"]:
-            current_cost = cost_tracker.get(expertise, 0.0)
+        for expertise in dict.fromkeys([*BUDGET_LIMITS, *ledger_month]):
+            totals = ledger_month.get(expertise, {})
+            current_cost = totals.get("spent", 0.0)
+            reserved = totals.get("reserved", 0.0)
             limit = BUDGET_LIMITS.get(expertise, 10.0)
             remaining = limit - current_cost
             percentage = (current_cost / limit) * 100 if limit > 0 else 0
 
             budget_status[expertise] = {
                 "current_cost": round(current_cost, 4),
+                "reserved": round(reserved, 4),
+                "calls": totals.get("calls", 0),
                 "budget_limit": limit,
                 "remaining": round(remaining, 4),
                 "percentage_used": round(percentage, 1),
                 "status": "OK" if remaining > 0 else "EXCEEDED",
-                "fallback_active": remaining <= 0
+                "fallback_active": remaining - reserved <= 0
             }
 
         return {
             "success": True,
-            "month": cost_tracker["last_reset"],
+            "month": month,
             "budgets": budget_status,
-            "total_spent": round(sum(cost_tracker[k] for k in cost_tracker if k != "last_reset"), 4)
+            "total_spent": round(sum(totals["spent"] for totals in ledger_month.values()), 4),
+            "history": await asyncio.to_thread(cost_ledger.get_history),
+            "cost_ledger": cost_ledger.get_stats(),
+            "usage": usage_ledger.get_stats(),
+            "response_cache": response_cache.get_stats(),
+            "system_prompt_templates": system_prompt_templates.get_stats(),
+            "generation_budgets": generation_budgets.get_stats(),
+            "single_flight": {
+                "description": description_flights.get_stats(),
+                "image": image_flights.get_stats()
+            }
         }
 
     except Exception as e:
@@ -1545,20 +5183,129 @@ async def get_budget_status():
             "error": str(e)
         }
 
+@app.get("/budget-status/session/{session_id}")
+async def get_session_usage(session_id: str):
+    """Tokens et coût cumulés d'une session (journal d'usage)"""
+    totals = usage_ledger.get_session(session_id)
+    if totals is None:
+        raise HTTPException(status_code=404, detail=f"Aucun usage enregistré pour la session {session_id}")
+
+    return {
+        "success": True,
+        "session_id": session_id,
+        **totals,
+        "cost": round(totals["cost"], 6)
+    }
+
+@app.get("/ai/health")
+async def get_ai_health():
+    """Tableau de santé des IA : état du disjoncteur, taux d'erreur, 429, latences et quotas"""
+    return {
+        "success": True,
+        "providers": provider_health.get_stats(),
+        "rate_limits": ai_providers.get_stats()
+    }
+
+@app.get("/ai/latency")
+async def get_ai_latency():
+    """Latences récentes par IA (p50/p95), délai de hedging et nombre de requêtes parallèles lancées"""
+    return {
+        "success": True,
+        **provider_latency.get_stats()
+    }
+
+@app.get("/tts/stats")
+async def get_tts_stats():
+    """Statistiques TTS : cache audio (hits/misses, occupation) et ordonnanceur (file, attentes)"""
+    stats = {
+        "success": True,
+        "cache_enabled": tts_cache is not None,
+        "scheduler": tts_scheduler.get_stats(),
+        "single_flight": tts_flights.get_stats()
+    }
+    if tts_cache:
+        stats["cache"] = tts_cache.get_stats()
+
+    return stats
+
+@app.get("/voices")
+async def get_voices():
+    """Catalogue des voix et correspondances expertise / sujet / personnage résolues"""
+    return {
+        "success": True,
+        **voice_registry.get_mappings()
+    }
+
 @app.get("/inscription/question/{numero}")
-async def get_inscription_question_audio(numero: int):
-    """Récupère l'audio d'une question d'inscription"""
+async def get_inscription_question_audio(numero: int, request: Request, voice: Optional[str] = None):
+    """Récupère l'audio d'une question d'inscription (pack pré-généré, ETag et Range)"""
     if not (1 <= numero <= len(QUESTIONS)):
         raise HTTPException(status_code=404, detail=f"Question {numero} non trouvée. Disponibles: 1-{len(QUESTIONS)}")
 
+    selected_voice = voice if voice in FRENCH_VOICES else DEFAULT_VOICE
+    pack_entry = inscription_audio_pack.get(selected_voice, numero) if inscription_audio_pack else None
+
+    if pack_entry:
+        start, end, etag = pack_entry
+        size = end - start
+        headers = {
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "Cache-Control": "public, max-age=86400",
+            "Content-Disposition": f"inline; filename=question_{numero}.mp3"
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+        byte_range = None
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (not if_range or if_range.strip() == etag):
+            byte_range = parse_byte_range(range_header, size)
+
+        if byte_range:
+            range_start, range_end = byte_range
+            headers["Content-Range"] = f"bytes {range_start}-{range_end - 1}/{size}"
+            return Response(
+                content=inscription_audio_pack.read(start + range_start, start + range_end),
+                status_code=206,
+                media_type="audio/mpeg",
+                headers=headers
+            )
+
+        return Response(
+            content=inscription_audio_pack.read(start, end),
+            media_type="audio/mpeg",
+            headers=headers
+        )
+
+    print(f"⚠️ Question {numero} ({selected_voice}) absente du pack audio - génération TTS")
     question_text = QUESTIONS[numero - 1]
-    audio_data = await generate_audio(question_text)
+    audio_chunks = generate_audio_stream(question_text, selected_voice, TTS_PRIORITY_PREFETCH)
 
-    if not audio_data:
+    # Attendre le premier morceau avant d'envoyer les en-têtes (erreur TTS → 500 propre)
+    try:
+        first_chunk = await anext(audio_chunks)
+    except StopAsyncIteration:
+        raise HTTPException(status_code=500, detail="Erreur génération audio")
+    except TTSQueueFull:
+        raise HTTPException(status_code=503, detail="Synthèse vocale saturée, réessayez", headers={"Retry-After": "2"})
+    except Exception as e:
+        print(f"❌ Erreur TTS: {e}")
         raise HTTPException(status_code=500, detail="Erreur génération audio")
 
     async def audio_stream():
-        yield audio_data
+        yield first_chunk
+        try:
+            async for chunk in audio_chunks:
+                yield chunk
+        except Exception as e:
+            print(f"❌ Erreur TTS en cours de streaming: {e}")
+        finally:
+            # Libère la place TTS même si le client coupe la connexion
+            await audio_chunks.aclose()
 
     return StreamingResponse(
         audio_stream(),
@@ -1620,10 +5367,11 @@ Retourne uniquement la description, sans commentaires.
 # 🧠 LOGIQUE IA CENTRALISÉE
 # ================================
 
-async def process_ia_request_centralized(prompt: str, expertise: str, session_id: str = "default", user_name: str = None):
+async def process_ia_request_centralized(prompt: str, expertise: str, session_id: str = "default", user_name: str = None, with_audio: bool = True):
     """
     Logique IA centralisée - utilisée uniquement par WebSocket
     Remplace la duplication de code entre endpoints
+    (with_audio=False : l'appelant se charge de l'audio, par ex. en streaming)
     """
     try:
         print(f"🧠 Traitement IA centralisé: {prompt[:50]}... | Expertise: {expertise}")
@@ -1635,13 +5383,20 @@ async def process_ia_request_centralized(prompt: str, expertise: str, session_id
 
         # Génération audio avec voix recommandée
         recommended_voice = get_voice_for_expertise(expertise, metadata.get("topic_detected"))
-        audio_data = await generate_audio(ia_response, recommended_voice)
+        audio_data = None
+        audio_unavailable = False
+        if with_audio:
+            try:
+                audio_data = await generate_audio(ia_response, recommended_voice)
+            except TTSQueueFull:
+                audio_unavailable = True
 
         return {
             "success": True,
             "response": ia_response,
             "metadata": metadata,
             "audio_data": audio_data,
+            "audio_unavailable": audio_unavailable,
             "recommended_voice": recommended_voice,
             "session_id": session_id,
             "expertise": expertise
@@ -1660,16 +5415,266 @@ async def process_ia_request_centralized(prompt: str, expertise: str, session_id
 # 🚀 WEBSOCKET PREMIUM - STREAMING TEMPS RÉEL
 # ================================
 
+# Modes audio WebSocket :
+# - "complete"  : un seul message avec tout le MP3 en base64 (défaut, anciens clients)
+# - "stream"    : un message par morceau Edge TTS, envoyé dès sa réception
+# - "sentences" : un segment audio par phrase, synthétisé pendant que le texte est encore généré
+WEBSOCKET_AUDIO_MODES = ("complete", "stream", "sentences")
+
+def get_audio_mode(data: dict, default: str = "complete") -> str:
+    """Mode audio demandé par le client (valeur inconnue → défaut)"""
+    audio_mode = data.get("audio_mode", default)
+    return audio_mode if audio_mode in WEBSOCKET_AUDIO_MODES else default
+
+# Transports audio WebSocket (négociés par connexion) :
+# - "base64" : l'audio est encodé dans le champ audio_data du message JSON (défaut, anciens clients)
+# - "binary" : le message JSON sert d'en-tête (sequence_id, byte_length) et l'audio suit en trame binaire brute
+WEBSOCKET_AUDIO_TRANSPORTS = ("base64", "binary")
+
+class WebSocketAudioSender:
+    """Envoi de l'audio selon le transport négocié avec le client. Tous les envois de la connexion passent
+    par son verrou : aucun message (text_chunk d'une autre tâche) ne s'intercale entre un en-tête audio
+    et sa trame binaire"""
+
+    def __init__(self, websocket: WebSocket, transport: str = "base64"):
+        self.websocket = websocket
+        self.transport = transport if transport in WEBSOCKET_AUDIO_TRANSPORTS else "base64"
+        self._next_sequence_id = 0
+        self._send_lock = asyncio.Lock()
+
+    async def send_json(self, message: dict):
+        async with self._send_lock:
+            await self.websocket.send_json(message)
+
+    async def negotiate(self, data: dict):
+        """Change de transport si le client le demande (valable pour la suite de la connexion)"""
+        requested = data.get("audio_transport")
+        if requested in WEBSOCKET_AUDIO_TRANSPORTS and requested != self.transport:
+            self.transport = requested
+            await self.send_json({"type": "protocol", "audio_transport": self.transport})
+
+    async def send_audio(self, message: dict, audio_data: bytes):
+        """Envoie un message audio : base64 dans le JSON, ou en-tête JSON suivi d'une trame binaire"""
+        if self.transport == "binary":
+            # L'en-tête et la trame binaire partent ensemble (verrou tenu entre les deux)
+            async with self._send_lock:
+                await self.websocket.send_json({
+                    **message,
+                    "sequence_id": self._next_sequence_id,
+                    "byte_length": len(audio_data)
+                })
+                await self.websocket.send_bytes(audio_data)
+                self._next_sequence_id += 1
+        else:
+            await self.send_json({
+                **message,
+                "audio_data": base64.b64encode(audio_data).decode("utf-8")
+            })
+
+def get_audio_sender(websocket: WebSocket) -> WebSocketAudioSender:
+    """Émetteur audio de la connexion (transport initial via ?audio_transport=binary)"""
+    audio_sender = getattr(websocket.state, "audio_sender", None)
+    if audio_sender is None:
+        audio_sender = WebSocketAudioSender(websocket, websocket.query_params.get("audio_transport", "base64"))
+        websocket.state.audio_sender = audio_sender
+    return audio_sender
+
+async def send_ws_json(websocket: WebSocket, message: dict):
+    """Envoie un message JSON via le verrou d'envoi de la connexion"""
+    await get_audio_sender(websocket).send_json(message)
+
+async def send_audio_unavailable(websocket: WebSocket, type_suffix: str = "", extra: dict = None):
+    """Prévient le client que la réponse reste en texte seul (ordonnanceur TTS saturé)"""
+    await send_ws_json(websocket, {
+        "type": f"audio_unavailable{type_suffix}",
+        **(extra or {}),
+        "reason": "tts_busy",
+        "message": "Synthèse vocale saturée - réponse en texte seul"
+    })
+
+async def stream_audio_chunks_ws(websocket: WebSocket, text: str, voice: str, type_suffix: str = "", extra: dict = None) -> int:
+    """Transmet l'audio au fil de la synthèse (audio_chunk* puis audio_end*) ; retourne le nombre d'octets envoyés"""
+    extra = extra or {}
+    audio_sender = get_audio_sender(websocket)
+    sequence = 0
+    total_bytes = 0
+
+    try:
+        async with aclosing(generate_audio_stream(text, voice)) as audio_chunks:
+            async for chunk in audio_chunks:
+                await audio_sender.send_audio({
+                    "type": f"audio_chunk{type_suffix}",
+                    **extra,
+                    "sequence": sequence
+                }, chunk)
+                sequence += 1
+                total_bytes += len(chunk)
+    except TTSQueueFull:
+        await send_audio_unavailable(websocket, type_suffix, extra)
+        return 0
+    except Exception as e:
+        print(f"❌ Erreur TTS streaming: {e}")
+
+    if not total_bytes:
+        await send_ws_json(websocket, {
+            "type": f"audio_error{type_suffix}",
+            **extra,
+            "message": "Erreur génération audio"
+        })
+        return 0
+
+    await send_ws_json(websocket, {
+        "type": f"audio_end{type_suffix}",
+        **extra,
+        "voice_used": voice,
+        "chunks": sequence,
+        "total_bytes": total_bytes
+    })
+    return total_bytes
+
+# Fin de phrase : ponctuation suivie d'un espace (pas "1. " des listes numérotées) ou saut de ligne
+SENTENCE_END_PATTERN = re.compile(r'(?<!\d)[.!?…]+["»)\]]*\s+|\n+')
+
+class SentenceSegmenter:
+    """Découpe incrémentale du texte en phrases au fil des fragments reçus"""
+
+    def __init__(self, min_chars: int = None):
+        # Les phrases trop courtes ("Ah !") sont regroupées avec la suivante
+        self.min_chars = min_chars if min_chars is not None else int(os.getenv("TTS_SENTENCE_MIN_CHARS", "20"))
+        self._buffer = ""
+
+    def feed(self, fragment: str) -> list:
+        """Ajoute un fragment et retourne les phrases complètes"""
+        self._buffer += fragment
+        sentences = []
+        start = 0
+
+        for match in SENTENCE_END_PATTERN.finditer(self._buffer):
+            candidate = self._buffer[start:match.end()].strip()
+            if len(candidate) < self.min_chars:
+                continue
+            sentences.append(candidate)
+            start = match.end()
+
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self) -> list:
+        """Retourne le texte restant (dernière phrase sans ponctuation finale)"""
+        remaining = self._buffer.strip()
+        self._buffer = ""
+        return [remaining] if remaining else []
+
+class SentenceTTSPipeline:
+    """Synthèse phrase par phrase : la phrase N est synthétisée pendant que la N+1 est encore produite,
+    les segments audio sont envoyés dans l'ordre"""
+
+    def __init__(self, websocket: WebSocket, voice: str, type_suffix: str = "", extra: dict = None, max_parallel: int = None):
+        self.websocket = websocket
+        self.audio_sender = get_audio_sender(websocket)
+        self.voice = voice
+        self.type_suffix = type_suffix
+        self.extra = extra or {}
+        self.segments = 0
+        self.total_bytes = 0
+
+        self._normalizer = SpeechTextNormalizer()
+        self._segmenter = SentenceSegmenter()
+        self._semaphore = asyncio.Semaphore(max_parallel or int(os.getenv("TTS_PIPELINE_PARALLEL", "2")))
+        self._pending = asyncio.Queue()
+        self._sender = asyncio.create_task(self._send_in_order())
+
+    def feed(self, fragment: str):
+        """Ajoute du texte ; chaque phrase complète (nettoyée du Markdown) part immédiatement en synthèse"""
+        for sentence in self._segmenter.feed(self._normalizer.feed(fragment)):
+            self._submit(sentence)
+
+    def _submit(self, sentence: str):
+        task = asyncio.create_task(self._synthesize(sentence))
+        self._pending.put_nowait((self.segments, sentence, task))
+        self.segments += 1
+
+    async def _synthesize(self, sentence: str) -> Optional[bytes]:
+        async with self._semaphore:
+            try:
+                return await generate_audio(sentence, self.voice, is_clean=True)
+            except TTSQueueFull:
+                return None  # segment envoyé en texte seul
+
+    async def _send_in_order(self):
+        while True:
+            item = await self._pending.get()
+            if item is None:
+                return
+
+            index, sentence, task = item
+            audio_data = await task
+
+            if audio_data is None:
+                await send_audio_unavailable(self.websocket, self.type_suffix, {**self.extra, "index": index})
+                continue
+
+            if not audio_data:
+                await self.audio_sender.send_json({
+                    "type": f"audio_error{self.type_suffix}",
+                    **self.extra,
+                    "index": index,
+                    "message": "Erreur génération audio"
+                })
+                continue
+
+            self.total_bytes += len(audio_data)
+            await self.audio_sender.send_audio({
+                "type": f"audio_segment{self.type_suffix}",
+                **self.extra,
+                "index": index,
+                "text": sentence,
+                "voice_used": self.voice
+            }, audio_data)
+
+    async def finish(self, flush: bool = True) -> int:
+        """Synthétise le reste du texte, attend l'envoi de tous les segments puis envoie audio_end
+        (flush=False : le texte qui suit la dernière phrase complète est abandonné)"""
+        if flush:
+            for sentence in self._segmenter.feed(self._normalizer.flush()) + self._segmenter.flush():
+                self._submit(sentence)
+        self._pending.put_nowait(None)
+
+        try:
+            await self._sender
+        except Exception:
+            await self.cancel()
+            raise
+
+        await self.audio_sender.send_json({
+            "type": f"audio_end{self.type_suffix}",
+            **self.extra,
+            "voice_used": self.voice,
+            "segments": self.segments,
+            "total_bytes": self.total_bytes
+        })
+        return self.total_bytes
+
+    async def cancel(self):
+        """Abandonne les synthèses en cours (client déconnecté, erreur)"""
+        self._sender.cancel()
+        while not self._pending.empty():
+            item = self._pending.get_nowait()
+            if item:
+                item[2].cancel()
+
 @app.websocket("/ws/ia")
 async def websocket_ia_coach(websocket: WebSocket):
     """WebSocket optimisé pour IA Coach - Logique centralisée"""
     await websocket.accept()
     print("🔌 WebSocket connecté - Mode Premium activé")
+    audio_sender = get_audio_sender(websocket)
 
     try:
         while True:
             # Recevoir message du client
             data = await websocket.receive_json()
+            await audio_sender.negotiate(data)
 
             prompt = data.get("prompt", "")
             session_id = data.get("session_id", "default")
@@ -1680,68 +5685,111 @@ async def websocket_ia_coach(websocket: WebSocket):
 
             # Mode streaming ou mode simple selon la préférence
             streaming_mode = data.get("streaming", True)
+            audio_mode = get_audio_mode(data)
 
             if streaming_mode:
                 # Mode streaming avancé (existant)
-                await websocket.send_json({
+                await send_ws_json(websocket, {
                     "type": "typing_start",
                     "expertise": expertise,
                     "message": "🤖 IA en train d'écrire..."
                 })
 
-                # Streaming de la réponse par chunks
-                full_response = ""
-                async for chunk_data in stream_ia_response_chunks(prompt, session_id, expertise, user_name):
-                    await websocket.send_json(chunk_data)
-                    if chunk_data["type"] == "text_chunk":
-                        full_response += chunk_data["content"] + " "
+                audio_enabled = os.getenv("WEBSOCKET_AUDIO_STREAMING", "true").lower() == "true"
 
-                await websocket.send_json({
+                # Mode "sentences" : la synthèse démarre dès la première phrase complète
+                sentence_pipeline = None
+                if audio_enabled and audio_mode == "sentences":
+                    await send_ws_json(websocket, {
+                        "type": "audio_start",
+                        "expertise": expertise,
+                        "message": "🎵 Génération audio..."
+                    })
+                    sentence_pipeline = SentenceTTSPipeline(
+                        websocket, get_voice_for_expertise(expertise), extra={"expertise": expertise}
+                    )
+
+                # Streaming de la réponse token par token
+                streamed_text = ""
+                final_text = None
+                try:
+                    # aclosing : connexion coupée → le verrou de la session est rendu immédiatement
+                    async with aclosing(stream_ia_response_chunks(prompt, session_id, expertise, user_name)) as chunks:
+                        async for chunk_data in chunks:
+                            await send_ws_json(websocket, chunk_data)
+                            if chunk_data["type"] != "text_chunk":
+                                continue
+                            if chunk_data["is_complete"]:
+                                final_text = chunk_data["full_text"]
+                            else:
+                                streamed_text += chunk_data["content"]
+                                if sentence_pipeline:
+                                    sentence_pipeline.feed(chunk_data["content"])
+                except BaseException:
+                    if sentence_pipeline:
+                        await sentence_pipeline.cancel()
+                    raise
+
+                # Texte final (après limitation de longueur) : fait foi pour l'affichage et l'audio
+                full_response = final_text if final_text is not None else streamed_text.strip()
+                await send_ws_json(websocket, {
                     "type": "text_complete",
                     "expertise": expertise,
-                    "full_text": full_response.strip()
+                    "full_text": full_response
                 })
 
+                if sentence_pipeline:
+                    # Réponse tronquée : la fin de phrase coupée n'est pas synthétisée
+                    await sentence_pipeline.finish(flush=full_response == streamed_text.strip())
+
                 # Audio streaming
-                if os.getenv("WEBSOCKET_AUDIO_STREAMING", "true").lower() == "true":
-                    await websocket.send_json({
+                elif audio_enabled:
+                    await send_ws_json(websocket, {
                         "type": "audio_start",
                         "expertise": expertise,
                         "message": "🎵 Génération audio..."
                     })
 
                     recommended_voice = get_voice_for_expertise(expertise)
-                    audio_data = await generate_audio(full_response.strip(), recommended_voice)
 
-                    if audio_data:
-                        import base64
-                        audio_b64 = base64.b64encode(audio_data).decode('utf-8')
-                        await websocket.send_json({
-                            "type": "audio_complete",
-                            "expertise": expertise,
-                            "audio_data": audio_b64,
-                            "voice_used": recommended_voice
-                        })
+                    if audio_mode == "stream":
+                        await stream_audio_chunks_ws(websocket, full_response, recommended_voice, extra={"expertise": expertise})
                     else:
-                        await websocket.send_json({
-                            "type": "audio_error",
-                            "expertise": expertise,
-                            "message": "Erreur génération audio"
-                        })
+                        try:
+                            audio_data = await generate_audio(full_response, recommended_voice)
+                        except TTSQueueFull:
+                            audio_data = None
+                            await send_audio_unavailable(websocket, extra={"expertise": expertise})
+
+                        if audio_data:
+                            await audio_sender.send_audio({
+                                "type": "audio_complete",
+                                "expertise": expertise,
+                                "voice_used": recommended_voice
+                            }, audio_data)
+                        elif audio_data is not None:
+                            await send_ws_json(websocket, {
+                                "type": "audio_error",
+                                "expertise": expertise,
+                                "message": "Erreur génération audio"
+                            })
             else:
                 # Mode simple avec logique centralisée
-                await websocket.send_json({
+                await send_ws_json(websocket, {
                     "type": "processing",
                     "expertise": expertise,
                     "message": "🤖 Traitement en cours..."
                 })
 
                 # Utiliser la logique centralisée
-                result = await process_ia_request_centralized(prompt, expertise, session_id, user_name)
+                result = await process_ia_request_centralized(
+                    prompt, expertise, session_id, user_name,
+                    with_audio=audio_mode == "complete"
+                )
 
                 if result["success"]:
                     # Envoyer réponse complète
-                    await websocket.send_json({
+                    await send_ws_json(websocket, {
                         "type": "response_complete",
                         "expertise": expertise,
                         "response": result["response"],
@@ -1749,17 +5797,22 @@ async def websocket_ia_coach(websocket: WebSocket):
                     })
 
                     # Envoyer audio si disponible
-                    if result["audio_data"]:
-                        import base64
-                        audio_b64 = base64.b64encode(result["audio_data"]).decode('utf-8')
-                        await websocket.send_json({
+                    if audio_mode == "stream":
+                        await stream_audio_chunks_ws(websocket, result["response"], result["recommended_voice"], extra={"expertise": expertise})
+                    elif audio_mode == "sentences":
+                        sentence_pipeline = SentenceTTSPipeline(websocket, result["recommended_voice"], extra={"expertise": expertise})
+                        sentence_pipeline.feed(result["response"])
+                        await sentence_pipeline.finish()
+                    elif result["audio_data"]:
+                        await audio_sender.send_audio({
                             "type": "audio_complete",
                             "expertise": expertise,
-                            "audio_data": audio_b64,
                             "voice_used": result["recommended_voice"]
-                        })
+                        }, result["audio_data"])
+                    elif result["audio_unavailable"]:
+                        await send_audio_unavailable(websocket, extra={"expertise": expertise})
                 else:
-                    await websocket.send_json({
+                    await send_ws_json(websocket, {
                         "type": "error",
                         "expertise": expertise,
                         "message": result["error"]
@@ -1772,7 +5825,7 @@ async def websocket_ia_coach(websocket: WebSocket):
     except Exception as e:
         print(f"❌ Erreur WebSocket: {str(e)}")
         try:
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": "error",
                 "message": f"Erreur: {str(e)}"
             })
@@ -1789,9 +5842,12 @@ async def websocket_roleplay(websocket: WebSocket):
     await websocket.accept()
     print("🎭 WebSocket Roleplay connecté - Mode immersif activé")
 
+    audio_sender = get_audio_sender(websocket)
+
     try:
         while True:
             data = await websocket.receive_json()
+            await audio_sender.negotiate(data)
 
             if data["type"] == "start_simulation":
                 # Démarrer une nouvelle simulation
@@ -1810,7 +5866,7 @@ async def websocket_roleplay(websocket: WebSocket):
     except Exception as e:
         print(f"❌ Erreur WebSocket Roleplay: {str(e)}")
         try:
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": "error",
                 "message": f"Erreur: {str(e)}"
             })
@@ -1834,8 +5890,12 @@ async def handle_start_simulation_ws(websocket: WebSocket, data: dict):
         simulation_data = await start_date_simulation(simulation_request)
 
         if simulation_data["success"]:
+            # Mode audio choisi pour toute la simulation (modifiable à chaque message)
+            audio_mode = get_audio_mode(data)
+            active_simulations[simulation_data["simulation_id"]]["audio_mode"] = audio_mode
+
             # Envoyer les données de simulation
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": "simulation_started",
                 "simulation_id": simulation_data["simulation_id"],
                 "date_profile": simulation_data["date_profile"],
@@ -1845,17 +5905,17 @@ async def handle_start_simulation_ws(websocket: WebSocket, data: dict):
             })
 
             # Streaming du premier message
-            await stream_first_message(websocket, simulation_data)
+            await stream_first_message(websocket, simulation_data, audio_mode)
 
         else:
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": "error",
                 "message": simulation_data.get("error", "Erreur lors du démarrage")
             })
 
     except Exception as e:
         print(f"❌ Erreur start simulation WS: {str(e)}")
-        await websocket.send_json({
+        await send_ws_json(websocket, {
             "type": "error",
             "message": str(e)
         })
@@ -1867,7 +5927,7 @@ async def handle_send_message_ws(websocket: WebSocket, data: dict):
         user_message = data["user_message"]
 
         if simulation_id not in active_simulations:
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": "error",
                 "message": "Simulation non trouvée"
             })
@@ -1875,9 +5935,10 @@ async def handle_send_message_ws(websocket: WebSocket, data: dict):
 
         simulation = active_simulations[simulation_id]
         date_name = simulation["date_profile"]["name"]
+        simulation["audio_mode"] = get_audio_mode(data, simulation.get("audio_mode", "complete"))
 
         # 1. Indicateur "en train de réfléchir"
-        await websocket.send_json({
+        await send_ws_json(websocket, {
             "type": "date_thinking",
             "message": f"{date_name} réfléchit...",
             "avatar": "thinking",
@@ -1892,18 +5953,18 @@ async def handle_send_message_ws(websocket: WebSocket, data: dict):
 
     except Exception as e:
         print(f"❌ Erreur send message WS: {str(e)}")
-        await websocket.send_json({
+        await send_ws_json(websocket, {
             "type": "error",
             "message": str(e)
         })
 
-async def stream_first_message(websocket: WebSocket, simulation_data: dict):
+async def stream_first_message(websocket: WebSocket, simulation_data: dict, audio_mode: str = "complete"):
     """Stream le premier message de la simulation"""
     first_message = simulation_data["first_message"]
     date_profile = simulation_data["date_profile"]
 
     # Indicateur de début
-    await websocket.send_json({
+    await send_ws_json(websocket, {
         "type": "first_message_start",
         "message": f"{date_profile['name']} vous accueille..."
     })
@@ -1914,69 +5975,71 @@ async def stream_first_message(websocket: WebSocket, simulation_data: dict):
     await stream_text_response(websocket, first_message, "first_message")
 
     # Génération audio du premier message
-    await stream_audio_response(websocket, first_message, date_profile, "first_message")
+    await stream_audio_response(websocket, first_message, date_profile, "first_message", audio_mode)
 
     # Coaching initial
-    await websocket.send_json({
+    await send_ws_json(websocket, {
         "type": "coaching_initial",
         "coaching_tip": simulation_data["coaching_tip"],
         "tips": simulation_data["tips"]
     })
 
 async def stream_roleplay_response_ws(websocket: WebSocket, user_message: str, simulation_id: str):
-    """Stream la réponse complète du roleplay"""
+    """Stream la réponse complète du roleplay (état de la simulation mis à jour un message à la fois,
+    le streaming texte/audio se fait hors verrou)"""
     simulation = active_simulations[simulation_id]
 
-    # Ajouter le message utilisateur à l'historique
-    simulation["messages"].append({
-        "sender": "user",
-        "message": user_message,
-        "timestamp": datetime.now().isoformat()
-    })
+    async with simulation_locks.hold(simulation_id):
+        # Ajouter le message utilisateur à l'historique
+        simulation["messages"].append({
+            "sender": "user",
+            "message": user_message,
+            "timestamp": datetime.now().isoformat()
+        })
 
-    # 1. Générer la réponse IA
-    ia_response = await generate_roleplay_response(user_message, simulation)
+        # 1. Générer la réponse IA
+        ia_response = await generate_roleplay_response(user_message, simulation, simulation_id)
 
-    # 2. Streaming du texte
-    await stream_text_response(websocket, ia_response, "response")
+        # 2. Ajouter la réponse IA à l'historique
+        simulation["messages"].append({
+            "sender": "date",
+            "message": ia_response,
+            "timestamp": datetime.now().isoformat()
+        })
 
-    # 3. Ajouter la réponse IA à l'historique
-    simulation["messages"].append({
-        "sender": "date",
-        "message": ia_response,
-        "timestamp": datetime.now().isoformat()
-    })
+        # 3. Analyse de performance
+        performance_analysis = analyze_user_performance(user_message, simulation)
 
-    # 4. Analyse de performance
-    performance_analysis = analyze_user_performance(user_message, simulation)
+        # 4. Mise à jour du niveau d'intérêt
+        simulation["interest_level"] = calculate_interest_level(user_message, simulation)
+        simulation["conversation_score"] = calculate_conversation_score(simulation)
 
-    # 5. Mise à jour du niveau d'intérêt
-    simulation["interest_level"] = calculate_interest_level(user_message, simulation)
-    simulation["conversation_score"] = calculate_conversation_score(simulation)
+        # 5. Génération des suggestions et état figé pour ce tour
+        coaching_update = {
+            "type": "coaching_update",
+            "coaching": performance_analysis,
+            "interest_level": simulation["interest_level"],
+            "conversation_score": simulation["conversation_score"],
+            "suggestions": generate_response_suggestions(ia_response, simulation),
+            "scenario_status": get_scenario_status(simulation)
+        }
 
-    # 6. Génération des suggestions
-    response_suggestions = generate_response_suggestions(ia_response, simulation)
+    # 6. Streaming du texte
+    await stream_text_response(websocket, ia_response, "response")
 
     # 7. Envoyer le coaching et les stats
-    await websocket.send_json({
-        "type": "coaching_update",
-        "coaching": performance_analysis,
-        "interest_level": simulation["interest_level"],
-        "conversation_score": simulation["conversation_score"],
-        "suggestions": response_suggestions,
-        "scenario_status": get_scenario_status(simulation)
-    })
+    await send_ws_json(websocket, coaching_update)
 
     # 8. Streaming audio
-    await stream_audio_response(websocket, ia_response, simulation["date_profile"], "response")
+    await stream_audio_response(websocket, ia_response, simulation["date_profile"], "response", simulation.get("audio_mode", "complete"))
 
-    print(f"✅ Roleplay streaming complet | Intérêt: {simulation['interest_level']}% | Score: {simulation['conversation_score']}")
+    print(f"✅ Roleplay streaming complet | Intérêt: {coaching_update['interest_level']}% | Score: {coaching_update['conversation_score']}")
 
 async def stream_text_response(websocket: WebSocket, text: str, message_type: str):
     """Stream le texte mot par mot pour un effet réaliste"""
 
     # Début du streaming texte
-    await websocket.send_json({
+    await send_ws_json(websocket, {
         "type": f"text_start_{message_type}",
         "message": "💬 Réponse en cours..."
     })
@@ -1988,7 +6051,7 @@ async def stream_text_response(websocket: WebSocket, text: str, message_type: st
     for i, word in enumerate(words):
         current_text += word + " "
 
-        await websocket.send_json({
+        await send_ws_json(websocket, {
             "type": f"text_chunk_{message_type}",
             "content": word + " ",
             "full_text_so_far": current_text.strip(),
@@ -2000,16 +6063,16 @@ async def stream_text_response(websocket: WebSocket, text: str, message_type: st
         await asyncio.sleep(delay)
 
     # Texte complet
-    await websocket.send_json({
+    await send_ws_json(websocket, {
         "type": f"text_complete_{message_type}",
         "full_text": text.strip()
     })
 
-async def stream_audio_response(websocket: WebSocket, text: str, date_profile: dict, message_type: str):
+async def stream_audio_response(websocket: WebSocket, text: str, date_profile: dict, message_type: str, audio_mode: str = "complete"):
     """Stream la génération audio avec feedback"""
 
     # Début génération audio
-    await websocket.send_json({
+    await send_ws_json(websocket, {
         "type": f"audio_start_{message_type}",
         "message": f"🎵 {date_profile['name']} prépare sa voix..."
     })
@@ -2018,51 +6081,65 @@ async def stream_audio_response(websocket: WebSocket, text: str, date_profile: d
         # Sélectionner la voix selon le profil
         voice = get_voice_for_roleplay(date_profile)
 
-        # Générer l'audio
-        audio_data = await generate_audio(text, voice)
+        # Mode streaming : morceaux envoyés au fil de la synthèse
+        if audio_mode == "stream":
+            await stream_audio_chunks_ws(websocket, text, voice, f"_{message_type}")
+            return
 
-        if audio_data:
-            import base64
-            audio_b64 = base64.b64encode(audio_data).decode('utf-8')
+        # Mode phrases : un segment audio par phrase, la première part sans attendre les suivantes
+        if audio_mode == "sentences":
+            sentence_pipeline = SentenceTTSPipeline(websocket, voice, f"_{message_type}")
+            sentence_pipeline.feed(text)
+            await sentence_pipeline.finish()
+            return
 
-            await websocket.send_json({
+        # Générer l'audio (file TTS saturée → réponse en texte seul)
+        try:
+            audio_data = await generate_audio(text, voice)
+        except TTSQueueFull:
+            await send_audio_unavailable(websocket, f"_{message_type}")
+            return
+
+        if audio_data:
+            await get_audio_sender(websocket).send_audio({
                 "type": f"audio_complete_{message_type}",
-                "audio_data": audio_b64,
                 "voice_used": voice,
                 "audio_duration": len(audio_data) // 1000  # Estimation durée
-            })
+            }, audio_data)
         else:
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": f"audio_error_{message_type}",
                 "message": "Erreur génération audio"
             })
 
     except Exception as e:
         print(f"❌ Erreur audio streaming: {str(e)}")
-        await websocket.send_json({
+        await send_ws_json(websocket, {
             "type": f"audio_error_{message_type}",
             "message": f"Erreur audio: {str(e)}"
         })
 
-def get_voice_for_roleplay(date_profile: dict) -> str:
-    """Sélectionne une voix selon le profil du personnage"""
+def get_roleplay_persona(date_profile: dict) -> str:
+    """Type de personnage (clé de ROLEPLAY_PERSONA_VOICES) selon la personnalité et l'âge"""
     personality = date_profile.get("personality", "").lower()
     age = date_profile.get("age", 25)
-    name = date_profile.get("name", "").lower()
 
-    # Voix selon la personnalité et l'âge
     if "extravertie" in personality and age < 28:
-        return "fr-FR-EloiseNeural"  # Jeune et dynamique
+        return "jeune_extravertie"
     elif "timide" in personality or "douce" in personality:
-        return "fr-CH-ArianeNeural"  # Plus douce et romantique
+        return "douce"
     elif age > 30:
-        return "fr-FR-DeniseNeural"  # Plus mature et confiante
+        return "mature"
     elif "sophistiquee" in personality or "elegante" in personality:
-        return "fr-FR-JosephineNeural"  # Élégante et cultivée
+        return "sophistiquee"
     elif "chaleureuse" in personality:
-        return "fr-CA-SylvieNeural"  # Accent québécois chaleureux
+        return "chaleureuse"
     else:
-        return "fr-FR-CoralieNeural"  # Voix naturelle par défaut
+        return "default"
+
+def get_voice_for_roleplay(date_profile: dict) -> str:
+    """Sélectionne une voix selon le profil du personnage (voix validées par le registre)"""
+    return voice_registry.roleplay_voices[get_roleplay_persona(date_profile)]
 
 async def handle_get_status_ws(websocket: WebSocket, data: dict):
     """Récupère le statut d'une simulation via WebSocket"""
@@ -2072,7 +6149,7 @@ async def handle_get_status_ws(websocket: WebSocket, data: dict):
         if simulation_id in active_simulations:
             simulation = active_simulations[simulation_id]
 
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": "simulation_status",
                 "simulation": {
                     "id": simulation_id,
@@ -2085,13 +6162,13 @@ async def handle_get_status_ws(websocket: WebSocket, data: dict):
                 }
             })
         else:
-            await websocket.send_json({
+            await send_ws_json(websocket, {
                 "type": "error",
                 "message": "Simulation non trouvée"
             })
 
     except Exception as e:
-        await websocket.send_json({
+        await send_ws_json(websocket, {
             "type": "error",
             "message": str(e)
         })
@@ -2103,13 +6180,12 @@ async def reset_conversation(request: dict = None):
         # Récupération de l'ID de session (par défaut "default")
         session_id = request.get("session_id", "default") if request else "default"
 
-        # Vérification si la conversation existe
-        conversation_exists = session_id in conversation_memory
-        previous_length = len(conversation_memory.get(session_id, []))
+        # Reset de la mémoire conversationnelle (mémoire et stockage)
+        session = await conversation_store.preload(session_id)
+        previous_length = conversation_store.delete(session_id) if session else 0
+        conversation_exists = previous_length > 0
 
-        # Reset de la mémoire conversationnelle
-        if session_id in conversation_memory:
-            del conversation_memory[session_id]
+        if conversation_exists:
             print(f"🔄 Conversation reset pour session: {session_id} ({previous_length} messages supprimés)")
         else:
             print(f"🔄 Aucune conversation à reset pour session: {session_id}")
@@ -2131,20 +6207,18 @@ async def reset_conversation(request: dict = None):
 async def get_conversation_status(session_id: str = "default"):
     """Récupère l'état de la conversation actuelle"""
     try:
-        conversation_exists = session_id in conversation_memory
-        messages = conversation_memory.get(session_id, [])
-
-        # Statistiques de la conversation
-        user_messages = [msg for msg in messages if msg["role"] == "user"]
-        assistant_messages = [msg for msg in messages if msg["role"] == "assistant"]
+        session = await conversation_store.preload(session_id)
+        conversation_exists = session is not None
+        messages = session.messages if session else ConversationLog()
 
+        # Statistiques de la conversation (compteurs tenus à jour par le journal)
         return {
             "session_id": session_id,
             "conversation_exists": conversation_exists,
             "total_messages": len(messages),
-            "user_messages": len(user_messages),
-            "assistant_messages": len(assistant_messages),
-            "last_message_time": messages[-1].get("timestamp") if messages else None,
+            "user_messages": messages.role_counts.get("user", 0),
+            "assistant_messages": messages.role_counts.get("assistant", 0),
+            "last_message_time": messages.last_timestamp(),
             "conversation_preview": [
                 {
                     "role": msg["role"],
@@ -2153,6 +6227,13 @@ async def get_conversation_status(session_id: str = "default"):
                 }
                 for msg in messages[-3:]  # 3 derniers messages
             ],
+            "context": session.context.get_stats() if session else None,
+            "pending_turns": conversation_locks.pending(session_id),
+            "store": conversation_store.get_stats(),
+            "session_locks": {
+                "conversation": conversation_locks.get_stats(),
+                "simulation": simulation_locks.get_stats()
+            },
             "timestamp": datetime.now().isoformat()
         }
 
@@ -2166,8 +6247,8 @@ async def get_conversation_status(session_id: str = "default"):
 async def clear_conversation_memory(user_id: int):
     """Vide la mémoire conversationnelle d'un utilisateur"""
     session_id = f"user_{user_id}"
-    if session_id in conversation_memory:
-        del conversation_memory[session_id]
+    session = await conversation_store.preload(session_id)
+    if session and conversation_store.delete(session_id):
         return {"success": True, "message": f"Mémoire conversationnelle vidée pour l'utilisateur {user_id}"}
     else:
         return {"success": False, "message": f"Aucune conversation trouvée pour l'utilisateur {user_id}"}
@@ -2176,9 +6257,6 @@ async def clear_conversation_memory(user_id: int):
 # 🎭 JEU DE RÔLE IA - SIMULATION DE RENDEZ-VOUS
 # ================================
 
-import uuid
-from datetime import datetime, timedelta
-
 # Stockage des simulations actives
 active_simulations = {}
 
@@ -2277,44 +6355,46 @@ async def send_roleplay_message(request: RoleplayMessage):
         simulation = active_simulations[simulation_id]
         date_profile = simulation["date_profile"]
 
-        # Ajouter le message utilisateur
-        simulation["messages"].append({
-            "sender": "user",
-            "message": user_message,
-            "timestamp": datetime.now().isoformat()
-        })
+        # Un message à la fois par simulation (SessionBusy si trop de messages en attente)
+        async with simulation_locks.hold(simulation_id):
+            # Ajouter le message utilisateur
+            simulation["messages"].append({
+                "sender": "user",
+                "message": user_message,
+                "timestamp": datetime.now().isoformat()
+            })
 
-        # Générer la réponse IA
-        ia_response = await generate_roleplay_response(user_message, simulation)
+            # Générer la réponse IA
+            ia_response = await generate_roleplay_response(user_message, simulation, simulation_id)
 
-        # Ajouter la réponse IA
-        simulation["messages"].append({
-            "sender": "date",
-            "message": ia_response,
-            "timestamp": datetime.now().isoformat()
-        })
+            # Ajouter la réponse IA
+            simulation["messages"].append({
+                "sender": "date",
+                "message": ia_response,
+                "timestamp": datetime.now().isoformat()
+            })
 
-        # Analyser la performance de l'utilisateur
-        performance_analysis = analyze_user_performance(user_message, simulation)
+            # Analyser la performance de l'utilisateur
+            performance_analysis = analyze_user_performance(user_message, simulation)
 
-        # Mettre à jour le niveau d'intérêt
-        simulation["interest_level"] = calculate_interest_level(user_message, simulation)
-        simulation["conversation_score"] = calculate_conversation_score(simulation)
+            # Mettre à jour le niveau d'intérêt
+            simulation["interest_level"] = calculate_interest_level(user_message, simulation)
+            simulation["conversation_score"] = calculate_conversation_score(simulation)
 
-        # Générer des suggestions de réponse
-        response_suggestions = generate_response_suggestions(ia_response, simulation)
+            # Générer des suggestions de réponse
+            response_suggestions = generate_response_suggestions(ia_response, simulation)
 
-        print(f"🎭 Message échangé dans {simulation_id} | Intérêt: {simulation['interest_level']}%")
+            print(f"🎭 Message échangé dans {simulation_id} | Intérêt: {simulation['interest_level']}%")
 
-        return {
-            "success": True,
-            "date_response": ia_response,
-            "coaching": performance_analysis,
-            "interest_level": simulation["interest_level"],
-            "conversation_score": simulation["conversation_score"],
-            "suggestions": response_suggestions,
-            "scenario_status": get_scenario_status(simulation)
-        }
+            return {
+                "success": True,
+                "date_response": ia_response,
+                "coaching": performance_analysis,
+                "interest_level": simulation["interest_level"],
+                "conversation_score": simulation["conversation_score"],
+                "suggestions": response_suggestions,
+                "scenario_status": get_scenario_status(simulation)
+            }
 
     except Exception as e:
         print(f"❌ Erreur message roleplay: {str(e)}")
@@ -2355,7 +6435,7 @@ def get_scenario_description(scenario: str) -> str:
     }
     return descriptions.get(scenario, "Rendez-vous classique")
 
-async def generate_roleplay_response(user_message: str, simulation: dict) -> str:
+async def generate_roleplay_response(user_message: str, simulation: dict, simulation_id: str = None) -> str:
     """Génère la réponse de l'IA en tant que rendez-vous"""
     date_profile = simulation["date_profile"]
     messages_history = simulation["messages"]
@@ -2394,7 +6474,10 @@ async def generate_roleplay_response(user_message: str, simulation: dict) -> str
 
     try:
         # Utiliser l'IA existante pour générer la réponse
-        response = await generate_with_best_ai(roleplay_prompt, "amical")
+        usage = {}
+        response, service_used = await generate_with_best_ai(roleplay_prompt, "amical", usage, get_generation_budget("roleplay"))
+        if usage:
+            await record_ai_usage("amical", simulation_id, service_used, usage)
 
         # Nettoyer la réponse (enlever les préfixes comme "Sarah:")
         clean_response = response.strip()
@@ -2413,12 +6496,10 @@ def analyze_user_performance(user_message: str, simulation: dict) -> dict:
     question_count = user_message.count('?')
     exclamation_count = user_message.count('!')
 
-    # Mots positifs/négatifs
-    positive_words = ['super', 'génial', 'cool', 'sympa', 'bien', 'parfait', 'excellent', 'merci']
-    negative_words = ['nul', 'ennuyeux', 'bizarre', 'pas terrible', 'bof']
-
-    positive_score = sum(1 for word in positive_words if word in user_message.lower())
-    negative_score = sum(1 for word in negative_words if word in user_message.lower())
+    # Mots positifs/négatifs (nombre de mots distincts du lexique)
+    matches = keyword_matcher.scan(user_message)
+    positive_score = matches.count("roleplay:positive")
+    negative_score = matches.count("roleplay:negative")
 
     # Analyse
     analysis = {
@@ -2456,8 +6537,8 @@ def calculate_interest_level(user_message: str, simulation: dict) -> int:
         interest_boost += 5
 
     # Compliments (+8)
-    compliment_words = ['belle', 'jolie', 'sympa', 'cool', 'génial', 'super', 'parfait']
-    if any(word in user_message.lower() for word in compliment_words):
+    matches = keyword_matcher.scan(user_message)
+    if matches.has("roleplay:compliment"):
         interest_boost += 8
 
     # Humour/émojis (+3)
@@ -2465,8 +6546,7 @@ def calculate_interest_level(user_message: str, simulation: dict) -> int:
         interest_boost += 3
 
     # Partage personnel (+6)
-    personal_words = ['moi', 'je', 'mon', 'ma', 'mes']
-    if sum(1 for word in personal_words if word in user_message.lower()) >= 2:
+    if matches.count("roleplay:personal") >= 2:
         interest_boost += 6
 
     # Facteurs qui diminuent l'intérêt
@@ -2477,13 +6557,11 @@ def calculate_interest_level(user_message: str, simulation: dict) -> int:
         interest_penalty += 3
 
     # Réponses négatives (-10)
-    negative_words = ['non', 'pas vraiment', 'bof', 'mouais', 'pas terrible']
-    if any(word in user_message.lower() for word in negative_words):
+    if matches.has("roleplay:refusal"):
         interest_penalty += 10
 
     # Messages inappropriés (-15)
-    inappropriate_words = ['sexe', 'coucher', 'nue', 'corps']
-    if any(word in user_message.lower() for word in inappropriate_words):
+    if matches.has("roleplay:inappropriate"):
         interest_penalty += 15
 
     # Calcul final
@@ -2933,11 +7011,11 @@ class MicroSignalsRequest(BaseModel):
 @app.post("/micro-signals/analyze")
 async def analyze_conversation_micro_signals(request: MicroSignalsRequest):
     """Analyse les micro-signaux dans une conversation"""
-    try:
-        conversation_id = request.conversation_id
-        messages = request.messages
-        user_id = request.user_id
+    return analyze_micro_signals(request.conversation_id, request.messages)
 
+def analyze_micro_signals(conversation_id: str, messages: list) -> dict:
+    """Analyse des micro-signaux : messages envoyés par le client (dicts) ou journal d'une session lu tel quel"""
+    try:
         print(f"🔍 Analyse micro-signaux pour conversation {conversation_id}")
 
         if len(messages) < 3:
@@ -2990,27 +7068,11 @@ async def analyze_conversation_micro_signals(request: MicroSignalsRequest):
 async def get_conversation_insights(conversation_id: str):
     """Récupère les insights d'une conversation existante"""
     try:
-        # Récupérer depuis la mémoire conversationnelle
-        if conversation_id in conversation_memory:
-            messages = conversation_memory[conversation_id]
-
-            # Convertir en format attendu
-            formatted_messages = []
-            for i, msg in enumerate(messages):
-                formatted_messages.append({
-                    "content": msg,
-                    "timestamp": (datetime.now() - timedelta(minutes=len(messages)-i)).isoformat(),
-                    "sender": "user" if i % 2 == 0 else "assistant"
-                })
-
-            # Analyser avec les données formatées
-            request = MicroSignalsRequest(
-                conversation_id=conversation_id,
-                messages=formatted_messages,
-                user_id="default_user"
-            )
-
-            return await analyze_conversation_micro_signals(request)
+        # Journal de la conversation (vrais horodatages et rôles), analysé sans conversion
+        session = await conversation_store.preload(conversation_id)
+        messages = session.messages if session else []
+        if messages:
+            return analyze_micro_signals(conversation_id, messages)
         else:
             return {"success": False, "error": "Conversation non trouvée"}
 
@@ -3023,6 +7085,9 @@ async def get_conversation_insights(conversation_id: str):
 
 def calculate_response_times_microsignals(messages: List[dict]) -> List[float]:
     """Calcule les temps de réponse entre messages"""
+    if isinstance(messages, ConversationLog):
+        return messages.response_times()
+
     response_times = []
 
     for i in range(1, len(messages)):
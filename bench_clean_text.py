@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark du nettoyage Markdown → parole
+(ancienne version à 8 passes re.sub vs clean_text_for_speech précompilé et SpeechTextNormalizer incrémental)
+"""
+
+import argparse
+import random
+import re
+import timeit
+
+from app import SpeechTextNormalizer, clean_text_for_speech
+
+def legacy_clean_text_for_speech(text: str) -> str:
+    """Version historique de clean_text_for_speech (référence pour la vérification d'équivalence)"""
+    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    text = re.sub(r'\*(.*?)\*', r'\1', text)
+    text = re.sub(r'^[\s]*[-•*]\s*', '', text, flags=re.MULTILINE)
+    text = re.sub(r'(\s|^)(\d+)\.\s*', r'\1\2, ', text)
+    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    text = re.sub(r'`([^`]+)`', r'\1', text)
+    text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\n\s*\n', '. ', text)
+    return text.strip()
+
+# Réponse type du coach (~2000 caractères) : titres, gras, listes, liens
+COACH_ANSWER = """### 💡 Comment briser la glace au premier rendez-vous
+
+Salut ! C'est une **excellente question** et tu n'es pas le seul à te la poser. Le premier rendez-vous, c'est *toujours* un peu stressant, mais avec quelques repères tu vas être beaucoup plus à l'aise.
+
+**Avant le rendez-vous :**
+- Choisis un lieu où **tu te sens bien** (un café calme plutôt qu'un bar bruyant)
+- Prépare deux ou trois sujets *légers* : voyages, cuisine, séries du moment
+- Rappelle-toi que l'autre personne est probablement aussi nerveuse que toi
+
+**Pendant la conversation :**
+1. Pose des questions ouvertes : "Qu'est-ce qui t'a donné envie de faire ça ?"
+2. Écoute vraiment la réponse et **rebondis** dessus plutôt que de passer au sujet suivant
+3. Partage aussi un peu de toi, l'échange doit rester équilibré
+4. N'aie pas peur des petits silences, ils sont *normaux*
+
+### 🌟 Les erreurs à éviter
+• Parler de ton ex (même en bien !)
+• Regarder ton téléphone toutes les cinq minutes
+• Transformer la conversation en entretien d'embauche
+
+Si tu veux aller plus loin, tu peux relire notre guide [les bases de la confiance](https://meetvoice.fr/guides/confiance) ou tester l'exercice `respiration 4-7-8` avant de partir. Ça aide vraiment à calmer le stress.
+
+### 🧠 Et si le stress monte quand même ?
+C'est **normal** et ça se gère très bien :
+1. Respire lentement par le ventre pendant une minute avant d'entrer
+2. Rappelle-toi trois qualités que tes amis apprécient chez toi
+3. Concentre-toi sur *elle* ou *lui* plutôt que sur l'image que tu renvoies
+Plus tu pratiques, plus ça devient naturel. Chaque rendez-vous est un entraînement, pas un examen.
+
+**En résumé :** sois curieux, sois toi-même et amuse-toi. Le but n'est pas de *performer* mais de passer un bon moment et de voir si le courant passe. Tu as toutes les cartes en main ! 😊
+
+Et toi, qu'est-ce qui te stresse le plus à l'idée de ce rendez-vous ? Dis-le moi et on travaille dessus ensemble.
+"""
+
+# Briques utilisées pour générer des textes aléatoires riches en cas limites
+FUZZ_TOKENS = [
+    "**", "*", "-", "•", "#", "##", "1.", "12.", "3", ".", "[", "]", "(", ")", "](", "`", "``",
+    " ", "  ", "\n", "\n\n", "\t", "mot", "a", "Salut", "!", "?", "é", "😊", "http://x.fr"
+]
+
+def stream_clean(text: str, rng: random.Random) -> str:
+    """Nettoyage incrémental sur un découpage aléatoire du texte"""
+    normalizer = SpeechTextNormalizer()
+    output = []
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 12)
+        output.append(normalizer.feed(text[position:position + size]))
+        position += size
+    output.append(normalizer.flush())
+    return "".join(output)
+
+def check_equivalence(iterations: int, seed: int):
+    """Vérifie que les deux nouvelles implémentations donnent exactement la sortie historique"""
+    rng = random.Random(seed)
+    samples = [COACH_ANSWER] + ["".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(0, 150))) for _ in range(iterations)]
+
+    for text in samples:
+        expected = legacy_clean_text_for_speech(text)
+        assert clean_text_for_speech(text) == expected, f"Écart clean_text_for_speech: {text!r}"
+        streamed = stream_clean(text, rng)
+        assert streamed == expected, f"Écart SpeechTextNormalizer: {text!r}\n  attendu: {expected!r}\n  obtenu:  {streamed!r}"
+
+    print(f"✅ Équivalence vérifiée sur {len(samples)} textes")
+
+# Réponses dont une ligne garde un marqueur ouvert : le tampon retenu grossit jusqu'à la fin du texte
+HELD_BACK_ANSWERS = {
+    "astérisque seul": "Calcule 5 * 3 puis " + "on continue la phrase " * 90,
+    "code ouvert": "Lance `respiration " + "on continue la phrase " * 90,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du nettoyage Markdown → parole")
+    parser.add_argument("--number", type=int, default=2000, help="Nettoyages par mesure")
+    parser.add_argument("--fuzz", type=int, default=20000, help="Textes aléatoires pour la vérification d'équivalence")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    check_equivalence(args.fuzz, args.seed)
+
+    # Fragments de ~5 caractères comme un flux LLM
+    fragments = [COACH_ANSWER[i:i + 5] for i in range(0, len(COACH_ANSWER), 5)]
+
+    def incremental(fragments):
+        normalizer = SpeechTextNormalizer()
+        for fragment in fragments:
+            normalizer.feed(fragment)
+        normalizer.flush()
+
+    print(f"📊 Réponse de {len(COACH_ANSWER)} caractères, {args.number} nettoyages par mesure")
+    print("=" * 60)
+    results = {
+        "ancien (8 re.sub)": timeit.timeit(lambda: legacy_clean_text_for_speech(COACH_ANSWER), number=args.number),
+        "précompilé": timeit.timeit(lambda: clean_text_for_speech(COACH_ANSWER), number=args.number),
+        f"incrémental ({len(fragments)} fragments)": timeit.timeit(lambda: incremental(fragments), number=args.number)
+    }
+    baseline = results["ancien (8 re.sub)"]
+    for name, seconds in results.items():
+        print(f"⏱️ {name:<28} {seconds / args.number * 1e6:8.1f} µs/réponse  (x{baseline / seconds:.2f})")
+
+    # Tampon retenu : chaque fragment ne doit parcourir que le texte nouveau (coût linéaire, pas quadratique)
+    print("=" * 60)
+    for name, text in HELD_BACK_ANSWERS.items():
+        held_fragments = [text[i:i + 5] for i in range(0, len(text), 5)]
+        one_shot = timeit.timeit(lambda: clean_text_for_speech(text), number=args.number)
+        streamed = timeit.timeit(lambda: incremental(held_fragments), number=args.number)
+        print(f"⏱️ {name:<16} ({len(text)} car.) précompilé {one_shot / args.number * 1e6:8.1f} µs | "
+              f"incrémental {streamed / args.number * 1e6:8.1f} µs ({streamed / args.number * 1e6 / len(held_fragments):.2f} µs/fragment)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Taille du prompt et latence par tour sur une longue session IA Coach
+(ancien historique complet re-joint à chaque tour vs contexte borné + résumé en arrière-plan)
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+import app
+
+USER_MESSAGE = "J'ai encore repensé à notre discussion sur mon rendez-vous de samedi, je stresse toujours un peu à l'idée de la revoir. "
+COACH_MESSAGE = "C'est normal de ressentir ce stress, ça montre que ce rendez-vous compte pour toi. Essaie de te concentrer sur le plaisir de la revoir plutôt que sur la performance. " * 2
+
+async def fake_call_ai(ai_name: str, prompt: str, max_tokens: int, usage: dict = None) -> str:
+    """IA de résumé simulée (latence réseau, résumé court)"""
+    await asyncio.sleep(0.05)
+    if usage is not None:
+        usage.update({"prompt_tokens": len(prompt) // 4, "completion_tokens": 40, "estimated": False})
+    return "L'utilisateur prépare un rendez-vous samedi et gère son stress ; le coach l'encourage à se concentrer sur le plaisir."
+
+def legacy_context(messages: list) -> str:
+    """Version historique : tous les messages précédents re-joints à chaque tour"""
+    return "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
+
+async def run_session(turns: int, checkpoints: list) -> dict:
+    app.call_ai = fake_call_ai
+    session_id = "bench_context"
+    app.conversation_store.delete(session_id)
+    legacy_messages = []
+    results = {}
+
+    for turn in range(1, turns + 1):
+        started = time.perf_counter()
+        legacy = legacy_context(legacy_messages)
+        legacy_seconds = time.perf_counter() - started
+        legacy_messages.append({"role": "user", "content": USER_MESSAGE})
+        legacy_messages.append({"role": "assistant", "content": COACH_MESSAGE})
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            prepared = await app.prepare_ia_coach_turn(USER_MESSAGE, session_id, "psychology", "Léa")
+            prepare_seconds = time.perf_counter() - started
+            app.remember_message(session_id, "assistant", COACH_MESSAGE, "psychology")
+        # Temps de lecture/saisie entre deux messages : le résumé avance en arrière-plan
+        await asyncio.sleep(0.01)
+
+        if turn in checkpoints:
+            results[turn] = {
+                "legacy_tokens": app.token_estimator.estimate(None, legacy),
+                "legacy_us": legacy_seconds * 1e6,
+                "prompt_tokens": app.token_estimator.estimate(None, prepared["system_prompt"]),
+                "prepare_us": prepare_seconds * 1e6
+            }
+
+    await asyncio.sleep(0.2)
+    results["stats"] = app.conversation_store.get(session_id).context.get_stats()
+    return results
+
+async def main():
+    parser = argparse.ArgumentParser(description="Contexte conversationnel sur une longue session")
+    parser.add_argument("--turns", type=int, default=100, help="Tours utilisateur (2 messages par tour)")
+    args = parser.parse_args()
+
+    checkpoints = sorted({1, 10, args.turns // 4, args.turns // 2, args.turns})
+    results = await run_session(args.turns, checkpoints)
+
+    print(f"📊 Session de {args.turns * 2} messages | budget contexte: {app.CONTEXT_TOKEN_BUDGET} tokens")
+    print("=" * 60)
+    for turn in checkpoints:
+        r = results[turn]
+        print(f"💬 tour {turn:>4} | ancien contexte: {r['legacy_tokens']:>6} tokens ({r['legacy_us']:6.1f} µs)"
+              f" | prompt complet: {r['prompt_tokens']:>5} tokens, tour préparé en {r['prepare_us']:7.1f} µs")
+    print(f"📝 Contexte final: {results['stats']}")
+
+    bounded = app.CONTEXT_TOKEN_BUDGET + max(r["prompt_tokens"] for t, r in results.items() if t == 1)
+    assert all(results[turn]["prompt_tokens"] <= bounded for turn in checkpoints), "Prompt non borné"
+    assert results["stats"]["summaries_generated"] > 0, "Aucun résumé généré"
+    print("✅ Prompt borné par le budget de contexte sur toute la session")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Respect du budget mensuel avec plusieurs workers uvicorn
+(ancien cost_tracker en mémoire par processus vs registre SQLite WAL partagé avec réservations)
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+import app
+
+RESERVED_COST = 0.010  # coût maximal d'un appel (max_tokens atteint)
+
+def actual_cost() -> float:
+    """Coût réel d'un appel : en général inférieur au maximum réservé"""
+    return random.uniform(0.004, RESERVED_COST)
+
+def legacy_worker(limit: float, calls: int, results):
+    """Version historique : chaque worker compare sa propre dépense à la limite"""
+    random.seed(os.getpid())
+    spent = 0.0
+    premium_calls = 0
+    for _ in range(calls):
+        if spent >= limit:
+            continue  # bascule vers l'IA gratuite
+        time.sleep(0.001)  # appel fournisseur
+        spent += actual_cost()
+        premium_calls += 1
+    results.put((spent, premium_calls, 0.0))
+
+def ledger_worker(path: str, limit: float, calls: int, results):
+    """Nouvelle version : réservation dans le registre partagé avant l'appel, solde après"""
+    random.seed(os.getpid())
+    ledger = app.CostLedger(path, reservation_ttl=60)
+    spent = 0.0
+    premium_calls = 0
+    overhead = 0.0
+    for _ in range(calls):
+        started = time.perf_counter()
+        reservation_id = ledger.reserve("seduction", RESERVED_COST, limit)
+        overhead += time.perf_counter() - started
+        if not reservation_id:
+            continue
+        time.sleep(0.001)  # appel fournisseur
+        cost = actual_cost()
+        started = time.perf_counter()
+        ledger.settle("seduction", cost, reservation_id)
+        overhead += time.perf_counter() - started
+        spent += cost
+        premium_calls += 1
+    results.put((spent, premium_calls, overhead / calls))
+
+def run(target, workers: int, *args) -> list:
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=target, args=(*args, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return outcomes
+
+def main():
+    parser = argparse.ArgumentParser(description="Budget mensuel partagé entre workers")
+    parser.add_argument("--workers", type=int, default=4, help="Workers uvicorn simulés (processus)")
+    parser.add_argument("--calls", type=int, default=300, help="Appels IA par worker")
+    parser.add_argument("--limit", type=float, default=1.0, help="Budget mensuel de l'expertise ($)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "costs.db")
+        legacy = run(legacy_worker, args.workers, args.limit, args.calls)
+        shared = run(ledger_worker, args.workers, path, args.limit, args.calls)
+
+        ledger = app.CostLedger(path, reservation_ttl=60)
+        month = ledger.get_month()["seduction"]
+
+    print(f"📊 {args.workers} workers x {args.calls} appels | budget ${args.limit:.2f} | réservation ${RESERVED_COST:.3f}/appel")
+    print("=" * 60)
+    for name, outcomes in (("ancien (par worker)", legacy), ("registre partagé", shared)):
+        total = sum(spent for spent, _, _ in outcomes)
+        calls = sum(premium for _, premium, _ in outcomes)
+        print(f"💰 {name:<20} dépensé: ${total:6.3f} ({total / args.limit * 100:5.1f}% du budget) | appels premium: {calls}")
+    overhead = sum(o for _, _, o in shared) / len(shared)
+    print(f"⏱️ Réservation + solde: {overhead * 1e6:.0f} µs par appel")
+    print(f"🧾 Registre: {month}")
+
+    ledger_total = sum(spent for spent, _, _ in shared)
+    assert ledger_total <= args.limit + 1e-9, "Budget dépassé malgré les réservations"
+    assert abs(month["spent"] - ledger_total) < 1e-6 and month["open_reservations"] == 0, "Registre incohérent"
+    print("✅ Dépense globale bornée par le budget, toutes les réservations soldées")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de la classification des messages par mots-clés
+(anciens scans `any(k in message.lower())` par fonction vs un passage du détecteur multi-motifs partagé)
+"""
+
+import argparse
+import timeit
+
+import app
+
+# ---- Versions historiques (référence pour la vérification d'équivalence) ----
+
+def legacy_coach_analysis(user_prompt: str) -> dict:
+    simple_questions = [
+        "bonjour", "salut", "hello", "coucou", "bonsoir",
+        "comment ça va", "comment vas-tu", "ça va", "comment allez-vous",
+        "quelle heure", "quel jour", "quelle date",
+        "merci", "au revoir", "à bientôt", "bye"
+    ]
+    detailed_requests = [
+        "explique", "détaille", "développe", "peux-tu expliquer", "comment faire",
+        "dis-moi plus", "raconte-moi", "j'aimerais savoir", "peux-tu me dire",
+        "comment ça marche", "pourquoi", "donne-moi des conseils", "aide-moi",
+        "j'ai besoin", "peux-tu m'aider", "comment puis-je", "que faire"
+    ]
+    confidence_keywords = ["confiance", "estime de soi", "complexe", "timide", "sûr de moi"]
+    dating_keywords = ["rendez-vous", "premier rendez", "date", "sortir avec", "rencontrer"]
+    social_keywords = ["stress social", "anxiété sociale", "timidité", "parler en public", "groupe"]
+    communication_keywords = ["communication", "parler", "écouter", "conversation", "charisme"]
+    personal_dev_keywords = ["développement personnel", "motivation", "objectifs", "habitudes", "croissance", "bien-être", "bien-etre", "épanouissement", "epanouissement", "réussir", "améliorer ma vie", "changer ma vie", "personnel", "développement", "développer"]
+
+    topic_detected = None
+    if any(keyword in user_prompt.lower() for keyword in confidence_keywords):
+        topic_detected = "confiance"
+    elif any(keyword in user_prompt.lower() for keyword in dating_keywords):
+        topic_detected = "rendez-vous"
+    elif any(keyword in user_prompt.lower() for keyword in social_keywords):
+        topic_detected = "stress_social"
+    elif any(keyword in user_prompt.lower() for keyword in communication_keywords):
+        topic_detected = "communication"
+    elif any(keyword in user_prompt.lower() for keyword in personal_dev_keywords):
+        topic_detected = "developpement_personnel"
+
+    greeting_words = ["salut", "bonjour", "hello", "coucou", "bonsoir", "hey", "hi"]
+    return {
+        "topic_detected": topic_detected,
+        "is_simple_question": any(simple in user_prompt.lower() for simple in simple_questions),
+        "wants_detailed_explanation": any(detail in user_prompt.lower() for detail in detailed_requests),
+        "user_greeted": any(greeting in user_prompt.lower() for greeting in greeting_words)
+    }
+
+def legacy_multi_sentence_context(user_prompt: str) -> dict:
+    for delimiter in ['. ', '! ', '? ']:
+        user_prompt = user_prompt.replace(delimiter, '|SPLIT|')
+    sentences = [s.strip() for s in user_prompt.split('|SPLIT|') if s.strip()][:5]
+
+    emotional_keywords = {
+        "stress": ["stress", "stressé", "anxieux", "angoisse", "panique", "tendu"],
+        "tristesse": ["triste", "déprimé", "mal", "difficile", "dur", "peine"],
+        "colère": ["énervé", "furieux", "agacé", "irrité", "fâché"],
+        "joie": ["content", "heureux", "super", "génial", "parfait", "excellent"],
+        "confusion": ["comprends pas", "perdu", "confus", "compliqué", "bizarre"]
+    }
+    context_patterns = {
+        "relationship_context": ["copain", "copine", "relation", "couple", "ensemble"],
+        "work_context": ["travail", "boulot", "collègue", "patron", "bureau"],
+        "family_context": ["famille", "parents", "frère", "sœur", "enfant"],
+        "social_context": ["amis", "sortir", "soirée", "groupe", "social"]
+    }
+    full_text = " ".join(sentences).lower()
+    return {
+        "sentences": sentences,
+        "emotional_indicators": [e for e, keywords in emotional_keywords.items() if any(k in full_text for k in keywords)],
+        "context_clues": [c for c, keywords in context_patterns.items() if any(k in full_text for k in keywords)]
+    }
+
+def legacy_cacheable(user_prompt: str) -> bool:
+    prompt = user_prompt.lower()
+    return not any(keyword in prompt for keyword in ["image", "photo", "dessiner", "rechercher", "chercher", "profil", "organiser", "publier", "poster"])
+
+def legacy_actions(user_prompt: str) -> list:
+    actions = []
+    if "modifier profil" in user_prompt.lower() or "changer profil" in user_prompt.lower():
+        actions.append("profile_update")
+    if "créer événement" in user_prompt.lower() or "organiser" in user_prompt.lower():
+        actions.append("event_creation")
+    if "poster" in user_prompt.lower() or "publier" in user_prompt.lower():
+        actions.append("social_post")
+    if "chercher" in user_prompt.lower() and "profil" in user_prompt.lower():
+        actions.append("profile_search")
+    if "image" in user_prompt.lower() or "photo" in user_prompt.lower() or "dessiner" in user_prompt.lower():
+        actions.append("image_generation")
+    if "rechercher" in user_prompt.lower() or "chercher sur internet" in user_prompt.lower():
+        actions.append("internet_search")
+    return actions
+
+def legacy_roleplay(user_message: str) -> tuple:
+    positive_words = ['super', 'génial', 'cool', 'sympa', 'bien', 'parfait', 'excellent', 'merci']
+    negative_words = ['nul', 'ennuyeux', 'bizarre', 'pas terrible', 'bof']
+    positive_score = sum(1 for word in positive_words if word in user_message.lower())
+    negative_score = sum(1 for word in negative_words if word in user_message.lower())
+
+    compliment_words = ['belle', 'jolie', 'sympa', 'cool', 'génial', 'super', 'parfait']
+    personal_words = ['moi', 'je', 'mon', 'ma', 'mes']
+    refusal_words = ['non', 'pas vraiment', 'bof', 'mouais', 'pas terrible']
+    inappropriate_words = ['sexe', 'coucher', 'nue', 'corps']
+    return (
+        positive_score, negative_score,
+        any(word in user_message.lower() for word in compliment_words),
+        sum(1 for word in personal_words if word in user_message.lower()) >= 2,
+        any(word in user_message.lower() for word in refusal_words),
+        any(word in user_message.lower() for word in inappropriate_words)
+    )
+
+def legacy_turn(message: str) -> tuple:
+    """Classification complète d'un tour IA Coach + d'un tour de jeu de rôle (ancienne version)"""
+    multi = legacy_multi_sentence_context(message)
+    return (
+        legacy_coach_analysis(message),
+        multi["emotional_indicators"], multi["context_clues"],
+        legacy_cacheable(message), legacy_actions(message), legacy_roleplay(message)
+    )
+
+# ---- Nouvelle version (mêmes consommateurs, un passage partagé) ----
+
+def new_actions(user_prompt: str) -> list:
+    matches = app.keyword_matcher.scan(user_prompt)
+    actions = [
+        action for action in ("profile_update", "event_creation", "social_post")
+        if matches.has(f"action:{action}")
+    ]
+    if matches.has("search") and matches.has("profile"):
+        actions.append("profile_search")
+    actions += [action for action in ("image_generation", "internet_search") if matches.has(f"action:{action}")]
+    return actions
+
+def new_roleplay(user_message: str) -> tuple:
+    matches = app.keyword_matcher.scan(user_message)
+    return (
+        matches.count("roleplay:positive"), matches.count("roleplay:negative"),
+        matches.has("roleplay:compliment"), matches.count("roleplay:personal") >= 2,
+        matches.has("roleplay:refusal"), matches.has("roleplay:inappropriate")
+    )
+
+def new_turn(message: str) -> tuple:
+    multi = app.analyze_multi_sentence_context(message)
+    matches = app.keyword_matcher.scan(message)
+    return (
+        app.analyze_coach_prompt(message),
+        multi["emotional_indicators"], multi["context_clues"],
+        not any(matches.has(category) for category in app.RESPONSE_CACHE_EXCLUDED_CATEGORIES),
+        new_actions(message), new_roleplay(message)
+    )
+
+MESSAGES = [
+    "Salut !",
+    "Bonjour, comment ça va ?",
+    "Merci beaucoup, à bientôt",
+    "Comment aborder quelqu'un qui me plaît dans un bar sans paraître lourd ?",
+    "Peux-tu m'expliquer pourquoi je manque autant de confiance en moi au travail ?",
+    "J'ai un premier rendez-vous demain soir et je suis super stressé. Donne-moi des conseils ! Je ne veux pas tout gâcher.",
+    "Ma copine et moi on se dispute souvent. Je suis énervé et un peu perdu. Mes parents ne comprennent pas. "
+    "Au boulot c'est difficile aussi. Mes amis me disent de sortir plus. Bref je suis triste et tendu.",
+    "Tu peux dessiner une image de nous deux ? Et rechercher des idées de sortie sur internet",
+    "Je voudrais modifier profil et chercher un profil sympa pour organiser une soirée",
+    "Non pas vraiment, c'était bof et un peu nul",
+    "Tu es très belle, j'adore ton sourire, moi aussi je suis passionné de cuisine !",
+    "Je cherche la motivation pour changer ma vie et atteindre mes objectifs de bien-être"
+]
+
+# Variantes sans accents / apostrophe typographique : détectées par le lexique replié uniquement
+ACCENT_VARIANTS = [
+    ("Je suis deprime et stresse", "emotion:tristesse"),
+    ("Comment ca va ?", "simple_question"),
+    ("J’ai besoin d’aide", "detailed_request"),
+    ("Je veux etre plus sur de moi", "topic:confiance")
+]
+
+def check_equivalence():
+    """Sur des messages correctement accentués, la nouvelle classification est identique à l'ancienne"""
+    for message in MESSAGES:
+        expected = legacy_turn(message)
+        assert new_turn(message) == expected, f"Écart: {message!r}\n  attendu: {expected}\n  obtenu:  {new_turn(message)}"
+    print(f"✅ Classification identique sur {len(MESSAGES)} messages")
+
+    for message, category in ACCENT_VARIANTS:
+        assert app.keyword_matcher.scan(message).has(category), message
+    print(f"✅ {len(ACCENT_VARIANTS)} variantes sans accents reconnues (non détectées par l'ancienne version)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la détection des mots-clés")
+    parser.add_argument("--number", type=int, default=2000, help="Passes sur le corpus par mesure")
+    args = parser.parse_args()
+
+    check_equivalence()
+
+    # Messages tous différents (le détecteur mémorise les derniers messages analysés)
+    counter = iter(range(10 ** 9))
+
+    def run(classify):
+        suffix = f" #{next(counter)}"
+        for message in MESSAGES:
+            classify(message + suffix)
+
+    print(f"📊 {len(MESSAGES)} messages ({sum(map(len, MESSAGES)) // len(MESSAGES)} caractères en moyenne), "
+          f"{app.keyword_matcher.keyword_count} mots-clés, {args.number} passes")
+    print("=" * 60)
+    results = {
+        "ancien (scans any/in)": timeit.timeit(lambda: run(legacy_turn), number=args.number),
+        "détecteur multi-motifs": timeit.timeit(lambda: run(new_turn), number=args.number)
+    }
+    baseline = results["ancien (scans any/in)"]
+    for name, seconds in results.items():
+        print(f"⏱️ {name:<24} {seconds / (args.number * len(MESSAGES)) * 1e6:7.1f} µs/tour  (x{baseline / seconds:.2f})")
+
+    print(f"🔤 Détecteur: {app.keyword_matcher.get_stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de l'assemblage du prompt système de l'IA Coach
+(ancien f-string reconstruit à chaque tour vs gabarits compilés + champs dynamiques)
+"""
+
+import argparse
+import itertools
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import app
+
+def legacy_build_system_prompt(user_prompt: str, expertise: str, user_name: str, conversation_context: str,
+                               is_first_message: bool, specialized: bool, now: datetime) -> str:
+    """Version historique (détection par mots-clés + f-string complet à chaque tour)"""
+    simple_questions = [
+        "bonjour", "salut", "hello", "coucou", "bonsoir",
+        "comment ça va", "comment vas-tu", "ça va", "comment allez-vous",
+        "quelle heure", "quel jour", "quelle date",
+        "merci", "au revoir", "à bientôt", "bye"
+    ]
+    detailed_requests = [
+        "explique", "détaille", "développe", "peux-tu expliquer", "comment faire",
+        "dis-moi plus", "raconte-moi", "j'aimerais savoir", "peux-tu me dire",
+        "comment ça marche", "pourquoi", "donne-moi des conseils", "aide-moi",
+        "j'ai besoin", "peux-tu m'aider", "comment puis-je", "que faire"
+    ]
+    confidence_keywords = ["confiance", "estime de soi", "complexe", "timide", "sûr de moi"]
+    dating_keywords = ["rendez-vous", "premier rendez", "date", "sortir avec", "rencontrer"]
+    social_keywords = ["stress social", "anxiété sociale", "timidité", "parler en public", "groupe"]
+    communication_keywords = ["communication", "parler", "écouter", "conversation", "charisme"]
+    personal_dev_keywords = ["développement personnel", "motivation", "objectifs", "habitudes", "croissance", "bien-être", "bien-etre", "épanouissement", "epanouissement", "réussir", "améliorer ma vie", "changer ma vie", "personnel", "développement", "développer"]
+
+    topic_detected = None
+    if any(keyword in user_prompt.lower() for keyword in confidence_keywords):
+        topic_detected = "confiance"
+    elif any(keyword in user_prompt.lower() for keyword in dating_keywords):
+        topic_detected = "rendez-vous"
+    elif any(keyword in user_prompt.lower() for keyword in social_keywords):
+        topic_detected = "stress_social"
+    elif any(keyword in user_prompt.lower() for keyword in communication_keywords):
+        topic_detected = "communication"
+    elif any(keyword in user_prompt.lower() for keyword in personal_dev_keywords):
+        topic_detected = "developpement_personnel"
+
+    is_simple_question = any(simple in user_prompt.lower() for simple in simple_questions)
+    wants_detailed_explanation = any(detail in user_prompt.lower() for detail in detailed_requests)
+
+    greeting_words = ["salut", "bonjour", "hello", "coucou", "bonsoir", "hey", "hi"]
+    user_greeted = any(greeting in user_prompt.lower() for greeting in greeting_words)
+
+    greeting_instruction = ""
+    if user_greeted and is_first_message:
+        greeting_instruction = f"IMPORTANT: L'utilisateur te salue pour la première fois. Tu DOIS répondre par 'Salut{f' {user_name}' if user_name else ''} !' avant de continuer."
+    elif user_greeted and not is_first_message:
+        greeting_instruction = "INTERDICTION ABSOLUE: L'utilisateur te salue à nouveau mais vous êtes déjà en conversation. Ne commence PAS ta réponse par 'Bonjour !', 'Salut !' ou toute salutation. Réponds directement à sa demande sans répéter sa salutation."
+    elif not user_greeted:
+        greeting_instruction = "RÈGLE: L'utilisateur pose directement une question. Réponds directement à sa question sans aucune salutation."
+    expertise_focus = ""
+    if expertise == "psychology":
+        expertise_focus = "EXPERTISE RENFORCÉE: Psychologie, thérapie comportementale, développement personnel"
+    elif expertise == "sexology":
+        expertise_focus = "EXPERTISE RENFORCÉE: Sexologie, éducation sexuelle, intimité et bien-être sexuel"
+    elif expertise == "seduction":
+        expertise_focus = "EXPERTISE RENFORCÉE: Séduction, charisme, techniques de drague et attraction"
+    elif expertise == "development":
+        expertise_focus = "EXPERTISE RENFORCÉE: Développement personnel, motivation, objectifs et croissance"
+    elif expertise == "amical":
+        expertise_focus = """MODE AMICAL:
+- Réponses COURTES et naturelles (maximum 2-3 phrases)
+- Ton décontracté comme un ami proche
+- Évite les répétitions du prénom
+- Sois chaleureux mais concis"""
+
+    if specialized:
+        specialized_system = app.get_specialized_prompt_system(expertise, user_name)
+    else:
+        specialized_system = f"""Tu es un IA Coach expert en séduction, sexologie et psychologie. Tu es un ami bienveillant.
+PERSONNALITÉ: Chaleureux, empathique, sans jugement, expert relations/sexualité.
+{expertise_focus}"""
+
+    # Hors de l'expression de la f-string : antislash interdit dans une expression avant Python 3.12
+    context_section = f"CONTEXTE CONVERSATION RÉCENTE:\\n{conversation_context}\\n" if conversation_context else ""
+
+    return f"""{specialized_system}
+
+SUJETS DE SPÉCIALITÉ (reconnais ces thèmes et adapte tes réponses):
+💙 CONFIANCE EN SOI: Techniques d'estime de soi, affirmation personnelle, surmonter les complexes
+🗓️ PREMIER RENDEZ-VOUS: Comportement, conversation, gestion du stress, faire bonne impression
+👥 STRESS SOCIAL: Anxiété sociale, timidité, prise de parole, interactions sociales
+💬 COMMUNICATION: Écoute active, expression des émotions, langage corporel, charisme
+🌟 DÉVELOPPEMENT PERSONNEL: Motivation, objectifs, habitudes, croissance personnelle, bien-être
+😊 MODE AMICAL: Conversations décontractées, conseils bienveillants, écoute amicale
+
+STYLE DE RÉPONSE:
+{
+    "- RÉPONSE COURTE (1-2 phrases max) pour cette question simple" if is_simple_question
+    else "- RÉPONSE DÉTAILLÉE avec explications complètes, exemples et conseils pratiques" if wants_detailed_explanation
+    else "- Réponse COMPLÈTE mais concise (300-500 caractères) avec conseils utiles"
+}
+- Conversationnel et naturel
+- RÈGLE ABSOLUE: Ne salue (Salut/Bonjour) que si l'utilisateur salue ET que c'est le début de conversation
+- Si l'utilisateur pose directement une question, réponds directement sans aucune salutation
+- En cours de conversation, ne répète JAMAIS de salutation même si l'utilisateur re-salue
+- Ne commence JAMAIS ta réponse par "Bonjour !" ou "Salut !" si vous êtes déjà en conversation
+- Utilise le contexte de la conversation précédente pour maintenir la fluidité
+- Aucun tabou sur la sexualité (éducatif et respectueux)
+- DONNE des conseils CONCRETS et UTILES
+{"- DÉVELOPPE en détail avec exemples et conseils pratiques" if wants_detailed_explanation else "- EXPLIQUE suffisamment pour être utile, propose d'expliquer plus si besoin"}
+
+{f"🎯 SUJET DÉTECTÉ: {topic_detected.upper()} - Adapte ta réponse à ce domaine spécifique" if topic_detected else ""}
+
+{f"INSTRUCTION SALUTATION: {greeting_instruction}" if greeting_instruction else ""}
+
+{context_section}
+
+HEURE: {now.strftime('%H:%M')} | DATE: {now.strftime('%d/%m/%Y')}
+
+UTILISATEUR: {user_prompt}
+
+{"Réponds de manière courte et naturelle." if is_simple_question else "Réponds de manière empathique et détaillée."}"""
+
+def build_system_prompt(user_prompt: str, expertise: str, user_name: str, conversation_context: str,
+                        is_first_message: bool, specialized: bool, now: datetime) -> str:
+    """Nouvelle version : mêmes étapes que prepare_ia_coach_turn (analyse, gabarit compilé, assemblage)"""
+    analysis = app.analyze_coach_prompt(user_prompt)
+
+    greeting_instruction = ""
+    if analysis["user_greeted"] and is_first_message:
+        greeting_instruction = f"IMPORTANT: L'utilisateur te salue pour la première fois. Tu DOIS répondre par 'Salut{f' {user_name}' if user_name else ''} !' avant de continuer."
+    elif analysis["user_greeted"] and not is_first_message:
+        greeting_instruction = "INTERDICTION ABSOLUE: L'utilisateur te salue à nouveau mais vous êtes déjà en conversation. Ne commence PAS ta réponse par 'Bonjour !', 'Salut !' ou toute salutation. Réponds directement à sa demande sans répéter sa salutation."
+    elif not analysis["user_greeted"]:
+        greeting_instruction = "RÈGLE: L'utilisateur pose directement une question. Réponds directement à sa question sans aucune salutation."
+
+    template = app.system_prompt_templates.get(
+        expertise, user_name, specialized, analysis["is_simple_question"], analysis["wants_detailed_explanation"]
+    )
+    return app.assemble_system_prompt(template, analysis["topic_detected"], greeting_instruction, conversation_context, user_prompt, now)
+
+PROMPTS = [
+    "Salut !",
+    "Merci beaucoup, à bientôt",
+    "Comment aborder quelqu'un qui me plaît dans un bar sans paraître lourd ?",
+    "Peux-tu m'expliquer pourquoi je manque autant de confiance en moi au travail ?",
+    "J'ai un premier rendez-vous demain soir et je stresse, donne-moi des conseils",
+    "Bonjour, explique-moi comment améliorer ma communication avec mon copain"
+]
+
+HISTORY = "\n".join(
+    f"{'user' if i % 2 == 0 else 'assistant'}: {'Message de conversation assez long pour être réaliste. ' * 3}"
+    for i in range(12)
+)
+
+def check_equivalence():
+    """Vérifie que le nouvel assemblage produit exactement le prompt historique"""
+    now = datetime(2025, 3, 14, 21, 7)
+    expertises = ["psychology", "development", "sexology", "seduction", "amical", "default", None]
+    count = 0
+    for prompt, expertise, user_name, context, first, specialized in itertools.product(
+        PROMPTS, expertises, [None, "Léa"], ["", HISTORY], [True, False], [True, False]
+    ):
+        args = (prompt, expertise, user_name, context, first, specialized, now)
+        expected = legacy_build_system_prompt(*args)
+        assert build_system_prompt(*args) == expected, f"Écart pour {args[:2]}"
+        count += 1
+
+    print(f"✅ Prompt identique sur {count} combinaisons")
+
+def measure_allocations(build, turns: list) -> float:
+    """Pic de mémoire allouée (octets) pendant un tour, en moyenne"""
+    tracemalloc.start()
+    total = 0
+    for args in turns:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        prompt = build(*args)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+        del prompt
+    tracemalloc.stop()
+    return total / len(turns)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de l'assemblage du prompt système")
+    parser.add_argument("--number", type=int, default=5000, help="Tours par mesure")
+    args = parser.parse_args()
+
+    check_equivalence()
+
+    now = datetime.now()
+    turns = [
+        (prompt, expertise, "Léa", HISTORY if i % 2 else "", i == 0, True, now)
+        for i, (prompt, expertise) in enumerate(itertools.product(PROMPTS, ["psychology", "seduction", "amical"]))
+    ]
+
+    def run(build):
+        for turn in turns:
+            build(*turn)
+
+    # Gabarits déjà compilés (régime permanent d'une session)
+    run(build_system_prompt)
+
+    print(f"📊 {len(turns)} tours types, {args.number} passes par mesure")
+    print("=" * 60)
+    results = {
+        "ancien (f-string complet)": (legacy_build_system_prompt, timeit.timeit(lambda: run(legacy_build_system_prompt), number=args.number // len(turns))),
+        "gabarits compilés": (build_system_prompt, timeit.timeit(lambda: run(build_system_prompt), number=args.number // len(turns)))
+    }
+    baseline = results["ancien (f-string complet)"][1]
+    for name, (build, seconds) in results.items():
+        per_turn = seconds / (args.number // len(turns) * len(turns))
+        allocated = measure_allocations(build, turns)
+        print(f"⏱️ {name:<26} {per_turn * 1e6:7.1f} µs/tour (x{baseline / seconds:.2f}) | pic alloué: {allocated / 1024:6.1f} Ko/tour")
+
+    print(f"📦 Gabarits en cache: {app.system_prompt_templates.get_stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Vérifie qu'un appel IA lent ne bloque plus les autres sessions WebSocket
+(fournisseur simulé : réponse Groq qui met plusieurs secondes à arriver)
+"""
+
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+
+import app
+
+class FakeRawResponse:
+    """Réponse brute du SDK Groq (with_raw_response) : en-têtes + parse() asynchrone"""
+
+    def __init__(self, content: str):
+        self.headers = {}
+        self._content = content
+
+    async def parse(self):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self._content))])
+
+async def slow_async_create(delay: float, **kwargs):
+    """Client asynchrone : l'attente réseau rend la main à la boucle d'événements"""
+    await asyncio.sleep(delay)
+    return FakeRawResponse("Réponse lente mais non bloquante")
+
+async def slow_blocking_create(delay: float, **kwargs):
+    """Ancien comportement : appel synchrone exécuté directement dans la coroutine"""
+    time.sleep(delay)
+    return FakeRawResponse("Réponse lente et bloquante")
+
+async def streaming_session(stop: asyncio.Event, interval: float) -> dict:
+    """Session simulée qui envoie un morceau de texte toutes les `interval` secondes"""
+    chunks = 0
+    max_gap = 0.0
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        max_gap = max(max_gap, now - last)
+        last = now
+        chunks += 1
+    return {"chunks": chunks, "max_gap": max_gap}
+
+async def run_scenario(create, delay: float, sessions: int, interval: float) -> list:
+    app.groq_client.chat.completions.with_raw_response.create = lambda **kwargs: create(delay, **kwargs)
+
+    stop = asyncio.Event()
+    streams = [asyncio.create_task(streaming_session(stop, interval)) for _ in range(sessions)]
+    await asyncio.sleep(interval * 2)
+
+    response, ai_used = await app.generate_with_best_ai("Comment aborder quelqu'un ?", "groq")
+    assert ai_used == "groq", ai_used
+
+    stop.set()
+    return await asyncio.gather(*streams)
+
+async def main():
+    parser = argparse.ArgumentParser(description="Sessions concurrentes pendant un appel IA lent")
+    parser.add_argument("--delay", type=float, default=2.0, help="Durée de l'appel fournisseur simulé (s)")
+    parser.add_argument("--sessions", type=int, default=20, help="Sessions en streaming pendant l'appel")
+    parser.add_argument("--interval", type=float, default=0.05, help="Intervalle entre deux morceaux (s)")
+    args = parser.parse_args()
+
+    print(f"🧪 Appel Groq simulé de {args.delay:.1f} s pendant que {args.sessions} sessions streament")
+    print("=" * 60)
+
+    results = {}
+    for name, create in (("bloquant (ancien)", slow_blocking_create), ("asynchrone", slow_async_create)):
+        stats = await run_scenario(create, args.delay, args.sessions, args.interval)
+        worst_gap = max(s["max_gap"] for s in stats)
+        total_chunks = sum(s["chunks"] for s in stats)
+        results[name] = worst_gap
+        print(f"⏱️ {name:<18} pire écart entre deux morceaux: {worst_gap * 1000:7.0f} ms | morceaux envoyés: {total_chunks}")
+
+    # Les autres sessions ne doivent jamais attendre la fin de l'appel lent
+    assert results["asynchrone"] < args.delay / 2, "La boucle d'événements a été bloquée pendant l'appel IA"
+    print("✅ Les autres sessions continuent de streamer pendant l'appel IA")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Tours concurrents sur une même session IA Coach (plusieurs connexions / relances rapides)
+(ancien tour sans verrou vs tours sérialisés par verrous rayés + limite de file par session)
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+import time
+
+import app
+
+async def fake_generate(prompt: str, preferred_ai: str = "groq", usage: dict = None, budget: dict = None) -> tuple[str, str]:
+    """IA simulée : latence variable, la réponse reprend le message utilisateur du prompt"""
+    await asyncio.sleep(random.uniform(0.02, 0.08))
+    asked = prompt.rsplit("UTILISATEUR: ", 1)[1].split("\n", 1)[0]
+    return f"Réponse à [{asked}]", "groq"
+
+async def legacy_ia_coach_response(user_prompt: str, session_id: str, expertise: str) -> tuple[str, dict]:
+    """Version historique : historique lu et complété de part et d'autre de l'appel IA, sans verrou"""
+    turn = await app.prepare_ia_coach_turn(user_prompt, session_id, expertise, None)
+    response, service_used = await app.generate_with_best_ai(turn["system_prompt"], turn["best_ai"], {}, turn["generation_budget"])
+    return await app.finalize_ia_coach_turn(turn, response, service_used)
+
+def interleaved_pairs(session_id: str) -> int:
+    """Messages utilisateur qui ne sont pas immédiatement suivis de leur propre réponse"""
+    messages = app.conversation_store.get_messages(session_id)
+    broken = 0
+    for i, message in enumerate(messages):
+        if message["role"] != "user":
+            continue
+        following = messages[i + 1] if i + 1 < len(messages) else None
+        if not following or following["role"] != "assistant" or following["content"] != f"Réponse à [{message['content']}]":
+            broken += 1
+    return broken
+
+async def run_burst(respond, session_id: str, turns: int) -> dict:
+    app.conversation_store.delete(session_id)
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(respond(f"message {i} de la rafale", session_id, "seduction") for i in range(turns)),
+        return_exceptions=True
+    )
+    return {
+        "seconds": time.perf_counter() - started,
+        "answered": sum(not isinstance(r, Exception) for r in results),
+        "rejected": sum(isinstance(r, app.SessionBusy) for r in results),
+        "interleaved": interleaved_pairs(session_id)
+    }
+
+async def run_parallel_sessions(sessions: int) -> float:
+    """Sessions différentes : elles ne doivent pas s'attendre entre elles"""
+    started = time.perf_counter()
+    await asyncio.gather(*(app.ia_coach_response("message unique", f"bench_parallel_{i}", "seduction") for i in range(sessions)))
+    return time.perf_counter() - started
+
+async def main():
+    parser = argparse.ArgumentParser(description="Sérialisation des tours par session")
+    parser.add_argument("--turns", type=int, default=3, help="Messages simultanés sur la même session")
+    parser.add_argument("--spam", type=int, default=20, help="Messages d'une rafale abusive")
+    parser.add_argument("--sessions", type=int, default=200, help="Sessions différentes en parallèle")
+    args = parser.parse_args()
+
+    app.generate_with_best_ai = fake_generate
+    app.RESPONSE_CACHE_ENABLED = False
+    random.seed(7)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        legacy = await run_burst(legacy_ia_coach_response, "bench_lock_legacy", args.turns)
+        locked = await run_burst(app.ia_coach_response, "bench_lock_new", args.turns)
+        spam = await run_burst(app.ia_coach_response, "bench_lock_spam", args.spam)
+        parallel_seconds = await run_parallel_sessions(args.sessions)
+
+    print(f"📊 {args.turns} messages simultanés | rafale de {args.spam} | {args.sessions} sessions parallèles "
+          f"| {app.SESSION_LOCK_STRIPES} verrous, file max {app.SESSION_MAX_QUEUED_TURNS}")
+    print("=" * 60)
+    for name, result in (("ancien (sans verrou)", legacy), ("verrous rayés", locked), ("rafale abusive", spam)):
+        print(f"💬 {name:<20} répondus: {result['answered']:>3} | refusés: {result['rejected']:>3} | "
+              f"tours entremêlés: {result['interleaved']:>3} | {result['seconds'] * 1000:6.0f} ms")
+    print(f"⚡ {args.sessions} sessions différentes traitées en {parallel_seconds * 1000:.0f} ms")
+    print(f"🔒 Verrous: {app.conversation_locks.get_stats()}")
+
+    assert locked["interleaved"] == 0 and spam["interleaved"] == 0, "Historique entremêlé malgré le verrou de session"
+    assert spam["rejected"] == args.spam - app.SESSION_MAX_QUEUED_TURNS - 1, "Limite de file par session non appliquée"
+    # Collisions de bandes possibles (quelques sessions partagent un verrou), loin d'une exécution en série
+    assert parallel_seconds < 0.08 * 8, "Les sessions différentes ont été sérialisées"
+    print("✅ Un tour à la fois par session, rafales bornées, sessions différentes en parallèle")
+
+if __name__ == "__main__":
+    asyncio.run(main())
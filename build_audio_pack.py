@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Script pour pré-générer l'audio des questions d'inscription dans un pack indexé
+(servi ensuite par GET /inscription/question/{numero} sans appeler Edge TTS)
+"""
+
+import argparse
+import asyncio
+
+from app import AUDIO_PACK_PATH, FRENCH_VOICES, QUESTIONS, build_inscription_audio_pack
+
+async def main():
+    parser = argparse.ArgumentParser(description="Construit le pack audio des questions d'inscription")
+    parser.add_argument("--output", default=AUDIO_PACK_PATH, help=f"Fichier pack à écrire (défaut: {AUDIO_PACK_PATH})")
+    parser.add_argument("--voice", action="append", dest="voices", help="Voix à inclure (répétable, défaut: toutes)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Synthèses Edge TTS en parallèle")
+    args = parser.parse_args()
+
+    voices = args.voices or FRENCH_VOICES
+
+    print(f"📦 Construction du pack audio: {len(QUESTIONS)} questions x {len(voices)} voix")
+    print("=" * 60)
+
+    result = await build_inscription_audio_pack(args.output, voices, args.concurrency)
+
+    print("=" * 60)
+    print(f"✅ Pack écrit: {result['path']}")
+    print(f"   Entrées: {result['entries']}")
+    print(f"   Audio: {result['audio_bytes'] / 1024 / 1024:.1f} Mo")
+
+if __name__ == "__main__":
+    asyncio.run(main())
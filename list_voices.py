@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 """
 Script pour lister toutes les voix Edge TTS disponibles
+(--snapshot : écrit l'instantané du catalogue chargé au démarrage par l'application)
 """
 
+import argparse
 import asyncio
 import edge_tts
 
@@ -40,7 +42,24 @@ async def test_voice(voice_name: str, text: str = "Bonjour, ceci est un test de
     except Exception as e:
         print(f"❌ Erreur avec {voice_name}: {str(e)}")
 
+async def write_snapshot(path: str):
+    """Écrit l'instantané du catalogue des voix françaises lu par VoiceRegistry"""
+    from app import fetch_voice_catalog, save_voice_catalog
+
+    voices = await fetch_voice_catalog()
+    save_voice_catalog(path, voices)
+    print(f"✅ Instantané écrit: {path} ({len(voices)} voix françaises)")
+
 async def main():
+    parser = argparse.ArgumentParser(description="Liste et teste les voix Edge TTS")
+    parser.add_argument("--snapshot", nargs="?", const="voices_catalog.json", metavar="PATH",
+                        help="Écrit l'instantané du catalogue (défaut: voices_catalog.json) au lieu de tester les voix")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        await write_snapshot(args.snapshot)
+        return
+
     # Lister toutes les voix françaises
     await list_french_voices()
     